@@ -0,0 +1,78 @@
+import os
+
+# Number of rows parsed and loaded at a time when streaming the input file
+READ_CHUNK_SIZE = int(os.environ.get("READ_CHUNK_SIZE", "10000"))
+
+# Parsed copies of input files are cached here, so an unchanged file is only parsed once
+PARSE_CACHE_DIR = os.environ.get("PARSE_CACHE_DIR", "/app/databases/.parse_cache")
+PARSE_CACHE_MAX_ENTRIES = int(os.environ.get("PARSE_CACHE_MAX_ENTRIES", "5"))
+
+# Log SQLite's query plan for every ingest DML statement
+LOG_QUERY_PLANS = os.environ.get("LOG_QUERY_PLANS", "1") == "1"
+
+# Resolve fact surrogate keys through in-process key caches and batched inserts
+FACT_KEY_CACHE = os.environ.get("FACT_KEY_CACHE", "0") == "1"
+# Most natural keys held per dimension by the key caches
+KEY_CACHE_MAX_SIZE = int(os.environ.get("KEY_CACHE_MAX_SIZE", "1000000"))
+# Rows written per executemany batch
+INSERT_BATCH_SIZE = int(os.environ.get("INSERT_BATCH_SIZE", "5000"))
+
+# Where the staging table lives: "temp" (SQLite's TEMP schema), "memory" (an attached
+# in-memory DB) or "main" (the orders DB file itself)
+STAGING_SCHEMA = os.environ.get("STAGING_SCHEMA", "temp")
+
+# SQLite connection profile (see init_db_connection.SQLITE_PROFILES) for ingest runs
+# and for read/query connections
+SQLITE_PROFILE = os.environ.get("SQLITE_PROFILE", "bulk_load")
+SQLITE_READ_PROFILE = os.environ.get("SQLITE_READ_PROFILE", "read_optimized")
+
+# Where each run's metrics are emitted as a JSON line: "stdout", a file path to
+# append to, or "" to turn them off
+METRICS_OUTPUT = os.environ.get("METRICS_OUTPUT", "stdout")
+
+# Skip input files loaded by an earlier run, and only stage the new or modified rows
+# of changed ones (see manifest.py)
+INCREMENTAL_INGEST = os.environ.get("INCREMENTAL_INGEST", "1") == "1"
+
+# Parser processes used when ingesting several input files at once
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", str(os.cpu_count() or 1)))
+
+# Largest fraction of an input file's rows that may fail the data quality checks and
+# be quarantined in rejected_orders while the rest are loaded. 0 rejects the whole
+# file if any row fails
+MAX_REJECTED_FRACTION = float(os.environ.get("MAX_REJECTED_FRACTION", "0"))
+
+# Input rows staged, transformed and committed at a time, with a checkpoint after each
+# commit that a rerun resumes from. Smaller chunks hold the write lock for less time,
+# bigger ones load faster. 0 loads each file in a single transaction. Can't be used
+# with SHADOW_PUBLISH, whose shadow copy (and the checkpoints in it) a crash discards
+INGEST_COMMIT_ROWS = int(os.environ.get("INGEST_COMMIT_ROWS", "0"))
+
+# Most query results each queries.OrdersQueries keeps cached between ingests
+QUERY_CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", "1024"))
+
+# Drop the read indexes (see ddl.READ_INDEXES) during a load whose batch is at least
+# this many times the rows already in fact_orders, and rebuild them after. 0 keeps
+# them in place
+READ_INDEX_DEFER_RATIO = float(os.environ.get("READ_INDEX_DEFER_RATIO", "2"))
+
+# Move the facts of each ingest out of fact_orders into one SQLite file per payment
+# month, next to the orders DB (see partitions.py). fact_orders then only holds the
+# facts of the current load, and queries read the partitions through a TEMP view
+FACT_PARTITIONS = os.environ.get("FACT_PARTITIONS", "0") == "1"
+
+# Build each ingest in a shadow copy of the orders DB, seeded through SQLite's online
+# backup API, and swap it in over the live file with a rename once it has committed
+# (see shadow.py). Readers never wait on the load, and a failed run leaves the live
+# file as it was. Runs with INGEST_COMMIT_ROWS or FACT_PARTITIONS set are refused, and
+# the inbox service ignores it and writes in place
+SHADOW_PUBLISH = os.environ.get("SHADOW_PUBLISH", "0") == "1"
+
+# Inbox service (see inbox.py): the directory it watches, how often it looks at it,
+# how long a file's size and modification time must stay unchanged before it counts
+# as fully written, and the most settled files queued for ingest. While the queue is
+# full, no more files are picked up
+INBOX_DIR = os.environ.get("INBOX_DIR", "/app/inbox")
+INBOX_POLL_SECONDS = float(os.environ.get("INBOX_POLL_SECONDS", "0.5"))
+INBOX_SETTLE_SECONDS = float(os.environ.get("INBOX_SETTLE_SECONDS", "2"))
+INBOX_QUEUE_SIZE = int(os.environ.get("INBOX_QUEUE_SIZE", "100"))
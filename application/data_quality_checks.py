@@ -1,8 +1,14 @@
-import logging
+from datetime import date
 from pprint import pformat
+from typing import Iterable, Iterator, Set, Union
+import logging
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import bindparam, create_engine, text
 from sqlalchemy.engine.base import Connection
+import numpy as np
+import pandas as pd
+
+from metrics import execute_with_plan
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
@@ -65,6 +71,41 @@ def price_calculation_check(conn: Connection) -> bool:
     return bool(result)
 
 
+NON_NULL_COLUMNS = [
+    "OrderNumber",
+    "ProductName",
+    "ProductType",
+    "UnitPrice",
+    "ProductQuantity",
+    "TotalPrice",
+    "Currency",
+    "ClientName",
+    "DeliveryAddress",
+    "DeliveryPostcode",
+    "PaymentType",
+    "PaymentBillingCode",
+    "PaymentDate",
+]
+
+COLUMN_TYPES = {
+    "ClientName": "TEXT",
+    "OrderNumber": "TEXT",
+    "ProductName": "TEXT",
+    "ProductType": "TEXT",
+    "Currency": "TEXT",
+    "DeliveryAddress": "TEXT",
+    "DeliveryCity": "TEXT",
+    "DeliveryPostcode": "TEXT",
+    "DeliveryCountry": "TEXT",
+    "PaymentType": "TEXT",
+    "PaymentBillingCode": "TEXT",
+    "PaymentDate": "DATE",
+}
+
+# Python types that pandas' to_sql stores under each of the declared SQL types above
+_PYTHON_TYPES = {"TEXT": str, "DATE": date}
+
+
 def run_all_data_quality_checks(conn: Connection) -> dict:
     """
     Runs the data quality checks for every applicable columns. Outputs
@@ -75,33 +116,10 @@ def run_all_data_quality_checks(conn: Connection) -> dict:
     return {
         "all_values_unique": {"OrderNumber": unique_check(conn, "OrderNumber")},
         "all_values_nonnull": {
-            "OrderNumber": no_nulls_check(conn, "OrderNumber"),
-            "ProductName": no_nulls_check(conn, "ProductName"),
-            "ProductType": no_nulls_check(conn, "ProductType"),
-            "UnitPrice": no_nulls_check(conn, "UnitPrice"),
-            "ProductQuantity": no_nulls_check(conn, "ProductQuantity"),
-            "TotalPrice": no_nulls_check(conn, "TotalPrice"),
-            "Currency": no_nulls_check(conn, "Currency"),
-            "ClientName": no_nulls_check(conn, "ClientName"),
-            "DeliveryAddress": no_nulls_check(conn, "DeliveryAddress"),
-            "DeliveryPostcode": no_nulls_check(conn, "DeliveryPostcode"),
-            "PaymentType": no_nulls_check(conn, "PaymentType"),
-            "PaymentBillingCode": no_nulls_check(conn, "PaymentBillingCode"),
-            "PaymentDate": no_nulls_check(conn, "PaymentDate"),
+            col: no_nulls_check(conn, col) for col in NON_NULL_COLUMNS
         },
         "column_is_correct_type": {
-            "ClientName": type_check(conn, "ClientName", "TEXT"),
-            "OrderNumber": type_check(conn, "OrderNumber", "TEXT"),
-            "ProductName": type_check(conn, "ProductName", "TEXT"),
-            "ProductType": type_check(conn, "ProductType", "TEXT"),
-            "Currency": type_check(conn, "Currency", "TEXT"),
-            "DeliveryAddress": type_check(conn, "DeliveryAddress", "TEXT"),
-            "DeliveryCity": type_check(conn, "DeliveryCity", "TEXT"),
-            "DeliveryPostcode": type_check(conn, "DeliveryPostcode", "TEXT"),
-            "DeliveryCountry": type_check(conn, "DeliveryCountry", "TEXT"),
-            "PaymentType": type_check(conn, "PaymentType", "TEXT"),
-            "PaymentBillingCode": type_check(conn, "PaymentBillingCode", "TEXT"),
-            "PaymentDate": type_check(conn, "PaymentDate", "DATE"),
+            col: type_check(conn, col, dtype) for col, dtype in COLUMN_TYPES.items()
         },
         "column_is_multiplied_correctly": {
             "TotalPrice": f"{price_calculation_check(conn)}"
@@ -109,6 +127,186 @@ def run_all_data_quality_checks(conn: Connection) -> dict:
     }
 
 
+def _wrong_type_mask(series: pd.Series, dtype: str) -> pd.Series:
+    python_type = _PYTHON_TYPES[dtype]
+    if python_type is date and pd.api.types.is_datetime64_dtype(series):
+        # Fast path, a datetime64 column only holds dates (or NaT)
+        return pd.Series(False, index=series.index)
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Checks each category once, and hands the result to its rows
+        categories = pd.Series(series.cat.categories)
+        wrong = _wrong_type_mask(categories, dtype).to_numpy()
+        codes = series.cat.codes.to_numpy()
+        return pd.Series(np.append(wrong, False)[codes], index=series.index)
+
+    if pd.api.types.infer_dtype(series, skipna=True) in (
+        "string" if python_type is str else "date",
+        "empty",
+    ):
+        # Fast path, the whole column already has the right type
+        return pd.Series(False, index=series.index)
+
+    return series.notna() & ~series.map(lambda value: isinstance(value, python_type))
+
+
+def _failing_row_masks(chunk: pd.DataFrame, seen_order_numbers: set) -> dict:
+    """
+    Boolean masks of the rows of a chunk that fail each check, keyed by (check, column).
+    OrderNumbers seen in earlier chunks are passed in, and the chunk's are added
+    """
+
+    order_numbers = chunk["OrderNumber"]
+    masks = {
+        ("all_values_unique", "OrderNumber"): order_numbers.notna()
+        & (order_numbers.duplicated() | order_numbers.isin(seen_order_numbers))
+    }
+    seen_order_numbers.update(order_numbers.dropna())
+
+    for col in NON_NULL_COLUMNS:
+        masks[("all_values_nonnull", col)] = chunk[col].isna()
+
+    for col, dtype in COLUMN_TYPES.items():
+        masks[("column_is_correct_type", col)] = _wrong_type_mask(chunk[col], dtype)
+
+    # As float64 like SQLite's REAL, so downcast prices multiply the same way
+    unit_price, quantity, total_price = (
+        pd.to_numeric(chunk[col], errors="coerce").astype("float64")
+        for col in ("UnitPrice", "ProductQuantity", "TotalPrice")
+    )
+    # NULLs never compare unequal in SQL, so they aren't counted here either
+    masks[("column_is_multiplied_correctly", "TotalPrice")] = (
+        (unit_price * quantity) != total_price
+    ).where(unit_price.notna() & quantity.notna() & total_price.notna(), False)
+
+    return masks
+
+
+def run_vectorized_data_quality_checks(
+    dataframe: Union[pd.DataFrame, Iterable[pd.DataFrame]]
+) -> dict:
+    """
+    Runs the same checks as run_all_data_quality_checks straight on the parsed
+    DataFrame (or its chunks), in a single vectorized pass and without loading it
+    into SQLite. The report has the same shape, plus a bad_row_counts section
+    with the number of rows failing each check, and a row_counts section with
+    the number of rows in total and failing any check
+    """
+
+    chunks = [dataframe] if isinstance(dataframe, pd.DataFrame) else dataframe
+
+    seen_order_numbers = set()
+    bad_row_counts = {
+        "all_values_unique": {"OrderNumber": 0},
+        "all_values_nonnull": dict.fromkeys(NON_NULL_COLUMNS, 0),
+        "column_is_correct_type": dict.fromkeys(COLUMN_TYPES, 0),
+        "column_is_multiplied_correctly": {"TotalPrice": 0},
+    }
+    total_rows = failing_rows = 0
+
+    for chunk in chunks:
+        masks = _failing_row_masks(chunk, seen_order_numbers)
+        for (check, col), mask in masks.items():
+            bad_row_counts[check][col] += int(mask.sum())
+
+        total_rows += len(chunk)
+        failing_rows += int(pd.concat(masks, axis=1).any(axis=1).sum())
+
+    report = {
+        check: {col: count == 0 for col, count in counts.items()}
+        for check, counts in bad_row_counts.items()
+    }
+    report["bad_row_counts"] = bad_row_counts
+    report["row_counts"] = {"total": total_rows, "failing": failing_rows}
+
+    return report
+
+
+def iter_valid_rows(
+    chunks: Iterable[pd.DataFrame], rejected: list
+) -> Iterator[pd.DataFrame]:
+    """
+    Passes through the rows of each chunk that pass every check, and appends the
+    other rows to `rejected`, with the checks they failed in a RejectReasons column.
+    Of rows sharing an OrderNumber, the first passes and the rest are rejected
+    """
+
+    seen_order_numbers = set()
+    for chunk in chunks:
+        failed = pd.DataFrame(
+            {
+                f"{check}:{col}": mask
+                for (check, col), mask in _failing_row_masks(
+                    chunk, seen_order_numbers
+                ).items()
+            },
+            index=chunk.index,
+        )
+        failing = failed.any(axis=1)
+        if failing.any():
+            # Built a column at a time: each failed check appends "check:col; "
+            reasons = pd.Series("", index=failed.index[failing])
+            for name, mask in failed[failing].items():
+                reasons += np.where(mask, f"{name}; ", "")
+            rejected.append(chunk[failing].assign(RejectReasons=reasons.str[:-2]))
+
+        if not failing.all():
+            yield chunk[~failing]
+
+
+def loaded_order_numbers(
+    conn: Connection, order_numbers: Iterable[str], batch_size: int = 500
+) -> Set[str]:
+    """
+    The OrderNumbers that earlier ingests already loaded: in fact_orders, or routed
+    to a fact partition (see partitions.py). Probed in batches through the primary
+    keys of fact_orders and partitioned_orders
+    """
+
+    probe = text(
+        """
+        SELECT OrderNumber FROM fact_orders WHERE OrderNumber IN :orders
+        UNION
+        SELECT OrderNumber FROM partitioned_orders WHERE OrderNumber IN :orders;
+        """
+    ).bindparams(bindparam("orders", expanding=True))
+    order_numbers = list(order_numbers)
+    known = set()
+    for i in range(0, len(order_numbers), batch_size):
+        known.update(conn.execute(probe, {"orders": order_numbers[i : i + batch_size]}).scalars())
+
+    return known
+
+
+# Staging rows whose OrderNumber an earlier ingest already loaded, found through the
+# primary keys of fact_orders and partitioned_orders
+LOADED_ORDER = """
+    EXISTS (SELECT 1 FROM fact_orders f WHERE f.OrderNumber = staging.OrderNumber)
+    OR EXISTS (SELECT 1 FROM partitioned_orders o WHERE o.OrderNumber = staging.OrderNumber)
+"""
+
+
+def drop_loaded_orders(conn: Connection) -> Set[str]:
+    """
+    The history-aware half of the OrderNumber uniqueness check: drops the staged
+    orders that earlier ingests already loaded from staging, and reports them. Run
+    it before the DML, so a re-sent order makes no dim changes and costs no dim
+    work, rather than being ignored by the fact insert at the end. Both statements
+    are a single pass over staging with a primary key probe per row. Returns the
+    OrderNumbers dropped
+    """
+
+    known = set(
+        conn.execute(text(f"SELECT OrderNumber FROM staging WHERE {LOADED_ORDER};")).scalars()
+    )
+    if known:
+        execute_with_plan(conn, "drop loaded orders", f"DELETE FROM staging WHERE {LOADED_ORDER};")
+        logging.warning(
+            f"Dropping {len(known)} orders already loaded by earlier ingests, "
+            f"e.g. {', '.join(sorted(known)[:5])}"
+        )
+    return known
+
+
 def generate_log_message(report: dict) -> str:
     return (
         f"Data quality check has failed. Here's the report for the checks + columns:\n"
@@ -118,10 +316,27 @@ def generate_log_message(report: dict) -> str:
     )
 
 
-def data_quality_check(report: dict):
+def data_quality_check(report: dict, max_rejected_fraction: float = 0.0):
+    """
+    Raises if any check failed. If at most max_rejected_fraction of the rows failed,
+    the report passes instead, so the failing rows can be quarantined (see
+    iter_valid_rows) and the rest loaded
+    """
+
+    checks = {
+        k: v for k, v in report.items() if k not in ("bad_row_counts", "row_counts")
+    }
     if any(
-        False in v.values() if isinstance(v, dict) else not v for v in report.values()
+        False in v.values() if isinstance(v, dict) else not v for v in checks.values()
     ):
+        rows = report.get("row_counts", {})
+        if rows.get("total") and rows["failing"] / rows["total"] <= max_rejected_fraction:
+            logging.warning(
+                f"{rows['failing']} of {rows['total']} rows failed the data quality "
+                f"checks and will be quarantined in rejected_orders"
+            )
+            return
+
         log_message = generate_log_message(report)
         logging.error(log_message)
         raise ValueError("Data quality check failed!")
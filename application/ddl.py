@@ -1,6 +1,239 @@
-from datetime import date
+import hashlib
+import logging
 
-from sqlalchemy import MetaData, Table, Column, String, Float, Integer, Date, ForeignKey
+from sqlalchemy import (
+    MetaData,
+    Table,
+    Column,
+    String,
+    Float,
+    Integer,
+    Date,
+    ForeignKey,
+    Index,
+    func,
+    text,
+)
+from sqlalchemy.schema import CreateIndex
+import pandas as pd
+
+from manifest import row_hashes
+from metrics import execute_with_plan
+from rollups import ROLLUPS, backfill_rollups, max_fact_rowid
+
+
+def natural_key(column):
+    """
+    The normalized form of a natural key column. The ingest DML compares keys
+    with exactly this expression, so the expression indexes below can serve it
+    """
+
+    return func.trim(func.lower(column))
+
+
+# SQLite's LOWER only folds ASCII letters and TRIM only strips spaces
+_ASCII_LOWER = str.maketrans(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz"
+)
+
+
+def normalize_key(value):
+    """Python equivalent of natural_key, i.e. SQLite's TRIM(LOWER(value))"""
+
+    if value is None:
+        return None
+    return str(value).translate(_ASCII_LOWER).strip(" ")
+
+
+def row_fingerprint(*values) -> str:
+    """A short, stable hash of the normalized values"""
+
+    keys = ("\x00" if key is None else key for key in map(normalize_key, values))
+    return hashlib.blake2b("\x1f".join(keys).encode(), digest_size=8).hexdigest()
+
+
+def iso_date(column: str) -> str:
+    """
+    SQL for the date in a column as ISO yyyy-mm-dd text, the one format dates are
+    stored in. Also converts dd/mm/yyyy text, the format of the ValidFrom column
+    default of older schemas
+    """
+
+    return (
+        f"DATE(CASE WHEN {column} GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]' "
+        f"THEN SUBSTR({column}, 7, 4) || '-' || SUBSTR({column}, 4, 2) || '-' || SUBSTR({column}, 1, 2) "
+        f"ELSE {column} END)"
+    )
+
+
+def date_key(column: str) -> str:
+    """SQL for the dim_date key (the integer yyyymmdd) of an ISO date column"""
+
+    return f"CAST(STRFTIME('%Y%m%d', {column}) AS INTEGER)"
+
+
+def extend_dim_date(conn, start: str, end: str):
+    """Adds the days from start to end (ISO dates) that dim_date doesn't have yet"""
+
+    execute_with_plan(
+        conn,
+        "extend dim_date",
+        f"""
+        INSERT OR IGNORE INTO dim_date (DateKey, Date, Year, Quarter, Month, YearMonth, Day, DayOfWeek, IsWeekend)
+        WITH RECURSIVE days(day) AS (
+            SELECT DATE(:start)
+            UNION ALL
+            SELECT DATE(day, '+1 day') FROM days WHERE day < DATE(:end)
+        )
+        SELECT
+            {date_key("day")},
+            day,
+            CAST(STRFTIME('%Y', day) AS INTEGER),
+            (CAST(STRFTIME('%m', day) AS INTEGER) + 2) / 3,
+            CAST(STRFTIME('%m', day) AS INTEGER),
+            SUBSTR(day, 1, 7),
+            CAST(STRFTIME('%d', day) AS INTEGER),
+            CAST(STRFTIME('%w', day) AS INTEGER),
+            STRFTIME('%w', day) IN ('0', '6')
+        FROM days;
+        """,
+        {"start": start, "end": end},
+    )
+
+
+def _migrate_dates(conn):
+    """
+    Brings DBs from before dim_date to the current date storage: converts any
+    dd/mm/yyyy dates to ISO (see iso_date), then adds and fills in
+    fact_orders.DateKey. Only runs while fact_orders has no DateKey column
+    """
+
+    columns = [row.name for row in conn.execute(text("PRAGMA table_info(fact_orders);"))]
+    if "DateKey" in columns:
+        return
+
+    logging.info("Migrating dates to ISO format and adding fact_orders.DateKey")
+    for table, column in [
+        ("dim_delivery_details", "ValidFrom"),
+        ("dim_delivery_details", "ValidTo"),
+        ("dim_payment_details", "PaymentDate"),
+    ]:
+        conn.execute(
+            text(
+                f"UPDATE {table} SET {column} = {iso_date(column)} WHERE {column} IS NOT {iso_date(column)};"
+            )
+        )
+
+    conn.execute(
+        text("ALTER TABLE fact_orders ADD COLUMN DateKey INTEGER REFERENCES dim_date (DateKey);")
+    )
+    start, end = conn.execute(
+        text("SELECT MIN(PaymentDate), MAX(PaymentDate) FROM dim_payment_details;")
+    ).first()
+    if start:
+        extend_dim_date(conn, start, end)
+    conn.execute(
+        text(
+            f"""
+            UPDATE fact_orders
+            SET DateKey = {date_key("pay.PaymentDate")}
+            FROM dim_payment_details pay
+            WHERE pay.PaymentId = fact_orders.PaymentId;
+            """
+        )
+    )
+    # The rollups are rebuilt from the converted dates by backfill_rollups
+    for table in ROLLUPS:
+        conn.execute(text(f"DELETE FROM {table};"))
+
+
+def _backfill_delivery_row_hashes(conn):
+    """
+    Adds the RowHash column to dim_delivery_details tables created before it
+    existed, and fills it in for any rows that don't have one
+    """
+
+    columns = [
+        row.name for row in conn.execute(text("PRAGMA table_info(dim_delivery_details);"))
+    ]
+    if "RowHash" not in columns:
+        conn.execute(text("ALTER TABLE dim_delivery_details ADD COLUMN RowHash VARCHAR;"))
+
+    rows = conn.execute(
+        text(
+            """
+            SELECT DeliveryId, ClientName, DeliveryAddress, DeliveryPostcode
+            FROM dim_delivery_details
+            WHERE RowHash IS NULL;
+            """
+        )
+    ).fetchall()
+    if rows:
+        conn.execute(
+            text("UPDATE dim_delivery_details SET RowHash = :RowHash WHERE DeliveryId = :DeliveryId;"),
+            [
+                {"DeliveryId": row.DeliveryId, "RowHash": row_fingerprint(*row[1:])}
+                for row in rows
+            ],
+        )
+
+
+def _backfill_rejected_row_hashes(conn):
+    """
+    Adds the RowHash column to rejected_orders tables created before it existed and
+    fills it in, dropping the copies of rows that reruns of a file quarantined again
+    """
+
+    columns = [row.name for row in conn.execute(text("PRAGMA table_info(rejected_orders);"))]
+    if "RowHash" in columns:
+        return
+
+    conn.execute(text("ALTER TABLE rejected_orders ADD COLUMN RowHash INTEGER;"))
+    names = [column.name for column in input_columns()]
+    rows = pd.read_sql(text(f"SELECT RejectId, {', '.join(names)} FROM rejected_orders;"), conn)
+    if rows.empty:
+        return
+
+    conn.execute(
+        text("UPDATE rejected_orders SET RowHash = :RowHash WHERE RejectId = :RejectId;"),
+        [
+            {"RejectId": int(reject_id), "RowHash": int(row_hash)}
+            for reject_id, row_hash in zip(rows["RejectId"], row_hashes(rows[names]))
+        ],
+    )
+    conn.execute(
+        text(
+            """
+            DELETE FROM rejected_orders
+            WHERE RejectId NOT IN (
+                SELECT MIN(RejectId) FROM rejected_orders GROUP BY FileName, RowHash
+            );
+            """
+        )
+    )
+
+
+def input_columns() -> list:
+    """The columns of the input workbooks, as staged"""
+
+    return [
+        Column("OrderNumber", String),
+        Column("ClientName", String),
+        Column("ProductName", String),
+        Column("ProductType", String),
+        Column("UnitPrice", Float),
+        Column("ProductQuantity", Integer),
+        Column("TotalPrice", Float),
+        Column("Currency", String),
+        Column("DeliveryAddress", String),
+        Column("DeliveryCity", String),
+        Column("DeliveryPostcode", String),
+        Column("DeliveryCountry", String),
+        Column("DeliveryContactNumber", String),
+        Column("PaymentType", String),
+        Column("PaymentBillingCode", String),
+        Column("PaymentDate", Date),
+    ]
 
 
 def create_orders_tables(conn):
@@ -31,9 +264,26 @@ def create_orders_tables(conn):
         Column("TotalPrice", Float, nullable=False),
         Column("Currency", String, nullable=False),
         Column("ProductQuantity", Integer, nullable=False),
+        # The payment's date, i.e. the integer yyyymmdd
+        Column("DateKey", Integer, ForeignKey("dim_date.DateKey")),
     )
 
+    # A calendar covering every payment date, generated by extend_dim_date
     Table(
+        "dim_date",
+        metadata,
+        Column("DateKey", Integer, primary_key=True, autoincrement=False),
+        Column("Date", String, unique=True, nullable=False),  # ISO yyyy-mm-dd
+        Column("Year", Integer, nullable=False),
+        Column("Quarter", Integer, nullable=False),
+        Column("Month", Integer, nullable=False),
+        Column("YearMonth", String, nullable=False),  # yyyy-mm
+        Column("Day", Integer, nullable=False),
+        Column("DayOfWeek", Integer, nullable=False),  # 0 is Sunday
+        Column("IsWeekend", Integer, nullable=False),
+    )
+
+    dim_delivery_details = Table(
         "dim_delivery_details",
         metadata,
         Column("DeliveryId", Integer, primary_key=True, autoincrement=True),
@@ -43,12 +293,14 @@ def create_orders_tables(conn):
         Column("DeliveryCity", String),
         Column("DeliveryCountry", String),
         Column("DeliveryContactNumber", String),
-        Column("ValidFrom", Date, default=date.today().strftime("%d/%m/%Y")),
+        Column("ValidFrom", Date, server_default=text("CURRENT_DATE")),
         Column("ValidTo", Date),
         Column("MostRecent", Integer, nullable=False, default=0),
+        # Fingerprint of the normalized ClientName, DeliveryAddress and DeliveryPostcode
+        Column("RowHash", String),
     )
 
-    Table(
+    dim_product_details = Table(
         "dim_product_details",
         metadata,
         Column(
@@ -62,7 +314,7 @@ def create_orders_tables(conn):
         Column("UnitPrice", Float, nullable=False),
     )
 
-    Table(
+    dim_payment_details = Table(
         "dim_payment_details",
         metadata,
         Column(
@@ -76,4 +328,246 @@ def create_orders_tables(conn):
         Column("PaymentDate", Date),
     )
 
+    Table(
+        "ingest_manifest_files",
+        metadata,
+        Column("FileFingerprint", String, primary_key=True),
+        Column("FileName", String, nullable=False),
+        Column("NewRows", Integer, nullable=False),
+        Column("LoadedAt", String, nullable=False),
+    )
+
+    Table(
+        "ingest_manifest_rows",
+        metadata,
+        # 64-bit content hash of a loaded input row (INTEGER PRIMARY KEY, i.e. the rowid)
+        Column("RowHash", Integer, primary_key=True, autoincrement=False),
+        Column("FileFingerprint", String, nullable=False),
+    )
+
+    # Aggregates of fact_orders for dashboards, kept up to date by the fact inserts
+    # (see rollups.py)
+    rollup_daily_product_revenue = Table(
+        "rollup_daily_product_revenue",
+        metadata,
+        Column("PaymentDate", Date, primary_key=True),
+        Column(
+            "ProductId",
+            Integer,
+            ForeignKey("dim_product_details.ProductId"),
+            primary_key=True,
+        ),
+        Column("TotalPrice", Float, nullable=False),
+        Column("ProductQuantity", Integer, nullable=False),
+        Column("Orders", Integer, nullable=False),
+    )
+
+    rollup_monthly_client_revenue = Table(
+        "rollup_monthly_client_revenue",
+        metadata,
+        Column("PaymentMonth", String, primary_key=True),  # YYYY-MM
+        Column("ClientKey", String, primary_key=True),  # Normalized ClientName
+        Column("TotalPrice", Float, nullable=False),
+        Column("ProductQuantity", Integer, nullable=False),
+        Column("Orders", Integer, nullable=False),
+    )
+
+    # A single row, counting the ingests that changed the DB (see manifest.bump_generation)
+    Table(
+        "ingest_generation",
+        metadata,
+        Column("Id", Integer, primary_key=True, autoincrement=False),
+        Column("Generation", Integer, nullable=False),
+        Column("UpdatedAt", String, nullable=False),
+    )
+
+    # How far a chunked ingest (see config.INGEST_COMMIT_ROWS) of a file has got
+    Table(
+        "ingest_checkpoints",
+        metadata,
+        Column("FileFingerprint", String, primary_key=True),
+        Column("InputRows", Integer, nullable=False),
+        Column("NewRows", Integer, nullable=False),
+        Column("UpdatedAt", String, nullable=False),
+    )
+
+    # The monthly fact partitions (see partitions.py), by payment month
+    Table(
+        "fact_partitions",
+        metadata,
+        Column("PaymentMonth", String, primary_key=True),  # YYYY-MM
+        Column("FileName", String, nullable=False),
+        Column("Facts", Integer, nullable=False, server_default=text("0")),
+        Column("ArchivedTo", String),  # Set once archive_partitions has moved it
+        Column("ArchivedAt", String),
+    )
+
+    # The payment month of every fact routed to a partition, so an OrderNumber stays
+    # unique across the partitions (see data_quality_checks.drop_loaded_orders)
+    Table(
+        "partitioned_orders",
+        metadata,
+        Column("OrderNumber", String, primary_key=True),
+        Column("PaymentMonth", String, nullable=False),  # YYYY-MM
+    )
+
+    # Input rows that failed the data quality checks, as they were read
+    rejected_orders = Table(
+        "rejected_orders",
+        metadata,
+        Column("RejectId", Integer, primary_key=True, autoincrement=True),
+        *input_columns(),
+        Column("RejectReasons", String, nullable=False),
+        Column("FileFingerprint", String, nullable=False),
+        Column("FileName", String, nullable=False),
+        Column("RejectedAt", String, nullable=False),
+        Column("RowHash", Integer),  # manifest.row_hashes of the input columns
+    )
+
+    indexes = [
+        Index(
+            "ix_dim_delivery_details_location_key",
+            natural_key(dim_delivery_details.c.DeliveryAddress),
+            natural_key(dim_delivery_details.c.DeliveryPostcode),
+            natural_key(dim_delivery_details.c.ClientName),
+        ),
+        Index(
+            "ix_dim_delivery_details_client_key",
+            natural_key(dim_delivery_details.c.ClientName),
+        ),
+        Index("ix_dim_delivery_details_row_hash", dim_delivery_details.c.RowHash),
+        Index(
+            "ix_dim_product_details_product_key",
+            natural_key(dim_product_details.c.ProductName),
+        ),
+        Index(
+            "ix_dim_payment_details_billing_code_key",
+            natural_key(dim_payment_details.c.PaymentBillingCode),
+        ),
+        # A row is quarantined once per file, however often the file is rerun
+        Index(
+            "ux_rejected_orders_file_row",
+            rejected_orders.c.FileName,
+            rejected_orders.c.RowHash,
+            unique=True,
+        ),
+        Index(
+            "ix_rollup_daily_product_revenue_product",
+            rollup_daily_product_revenue.c.ProductId,
+        ),
+        Index(
+            "ix_rollup_monthly_client_revenue_client",
+            rollup_monthly_client_revenue.c.ClientKey,
+        ),
+    ]
+
     metadata.create_all(conn, checkfirst=True)
+    _backfill_delivery_row_hashes(conn)
+    _migrate_dates(conn)
+    _backfill_rejected_row_hashes(conn)
+    for index in indexes:  # create_all skips indexes of tables that already exist
+        conn.execute(CreateIndex(index, if_not_exists=True))
+    create_read_indexes(conn)
+    backfill_rollups(conn)
+
+
+# Indexes for the read path (star joins and date filters), by name: (table, columns).
+# The ingest DML doesn't use them, so large loads drop them and rebuild them after
+READ_INDEXES = {
+    "ix_fact_orders_delivery_id": ("fact_orders", ["DeliveryId"]),
+    "ix_fact_orders_product_id": ("fact_orders", ["ProductId"]),
+    "ix_fact_orders_payment_id": ("fact_orders", ["PaymentId"]),
+    "ix_dim_payment_details_payment_date": ("dim_payment_details", ["PaymentDate"]),
+    "ix_fact_orders_date_key": ("fact_orders", ["DateKey"]),
+    # For "as of" lookups of a client's delivery details
+    "ix_dim_delivery_details_client_valid_from": (
+        "dim_delivery_details",
+        ["TRIM(LOWER(ClientName))", "ValidFrom"],
+    ),
+}
+
+
+def create_read_indexes(conn):
+    for name, (table, columns) in READ_INDEXES.items():
+        conn.execute(
+            text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)});")
+        )
+
+
+def drop_read_indexes(conn):
+    for name in READ_INDEXES:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name};"))
+
+
+def defer_read_indexes(conn, incoming_rows: int, ratio: float) -> bool:
+    """
+    Drops the read indexes if the incoming batch is at least `ratio` times the facts
+    already loaded, as building them once after the load is then cheaper than
+    updating them row by row. Returns whether they were dropped, i.e. whether
+    rebuild_read_indexes is due once the batch is in
+    """
+
+    existing_rows = max_fact_rowid(conn)  # Facts are append-only, so ~ COUNT(*)
+    existing_rows += conn.execute(  # Plus those moved into monthly partitions
+        text("SELECT COALESCE(SUM(Facts), 0) FROM fact_partitions WHERE ArchivedAt IS NULL;")
+    ).scalar()
+    if not ratio or not incoming_rows or incoming_rows < ratio * existing_rows:
+        return False
+
+    logging.info(
+        f"Dropping the read indexes while loading {incoming_rows} rows into "
+        f"{existing_rows} facts"
+    )
+    drop_read_indexes(conn)
+    return True
+
+
+def rebuild_read_indexes(conn):
+    """Recreates the read indexes, then refreshes the planner statistics of their tables"""
+
+    create_read_indexes(conn)
+    conn.execute(text("PRAGMA analysis_limit = 1000;"))
+    for table in sorted({table for table, _ in READ_INDEXES.values()}):
+        conn.execute(text(f"ANALYZE {table};"))
+
+
+def create_staging_table(conn, table_name: str = "staging", schema: str = "temp"):
+    """
+    Creates the staging table with a fixed schema, replacing any previous one. The schema
+    can be "main" (the DB file itself), "temp" or an attached (e.g. in-memory) database
+    """
+
+    table = Table(
+        table_name,
+        MetaData(),
+        *input_columns(),
+        Column("RowHash", Integer),  # Set by manifest.iter_new_rows
+        schema=schema,
+    )
+
+    table.drop(conn, checkfirst=True)
+    table.create(conn)
+
+    return table
+
+
+def create_staging_indexes(conn, table_name: str = "staging", schema: str = "main"):
+    """
+    Indexes the normalized natural keys of the staging table, for the DML steps
+    that look staging rows up from the dimension side
+    """
+
+    key_columns = {
+        "location_key": ["DeliveryAddress", "DeliveryPostcode", "ClientName"],
+        "client_key": ["ClientName"],
+        "product_key": ["ProductName"],
+        "billing_code_key": ["PaymentBillingCode"],
+    }
+
+    for name, columns in key_columns.items():
+        keys = ", ".join(f"TRIM(LOWER({col}))" for col in columns)
+        conn.execute(
+            text(
+                f"CREATE INDEX IF NOT EXISTS {schema}.ix_{table_name}_{name} ON {table_name} ({keys});"
+            )
+        )
@@ -0,0 +1,214 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import time
+
+from sqlalchemy import Engine
+
+from config import (
+    INBOX_DIR,
+    INBOX_POLL_SECONDS,
+    INBOX_QUEUE_SIZE,
+    INBOX_SETTLE_SECONDS,
+    INGEST_WORKERS,
+    PARSE_CACHE_MAX_ENTRIES,
+    SHADOW_PUBLISH,
+)
+from init_db_connection import prune_parse_cache
+from main import expand_inputs, load_parsed_file, open_db, parse_and_validate
+import metrics
+
+# Where ingested files are moved to, in the inbox, by outcome
+OUTCOME_DIRS = {"succeeded": "done", "skipped": "done", "failed": "failed"}
+
+
+def settled_files(
+    inbox_dir: str, seen: Dict[str, tuple], settle_seconds: float, now: float
+) -> List[Tuple[str, float]]:
+    """
+    The input files in the inbox whose size and modification time haven't changed
+    for settle_seconds, i.e. that are no longer being written, with the time they
+    were first seen. seen keeps track of the files between calls. A file is only
+    returned once, until it changes again
+    """
+
+    settled = []
+    files = expand_inputs([inbox_dir])
+    for path in files:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:  # Moved away since it was listed
+            continue
+        signature = (stat.st_size, stat.st_mtime_ns)
+        previous = seen.get(path)
+        if previous is None or previous[0] != signature:
+            seen[path] = (signature, now, previous[2] if previous else now)
+        elif now - previous[1] >= settle_seconds:
+            settled.append((path, previous[2]))
+            seen[path] = (signature, math.inf, previous[2])
+
+    for path in set(seen) - set(files):
+        del seen[path]
+
+    return settled
+
+
+def _ingest_parsed_file(
+    engine: Engine, result: dict, inbox_dir: str, arrived: float, keep_parsed: int
+) -> dict:
+    """
+    Runs on the writer thread: writes the parsed file, moves it out of the inbox by
+    outcome and reports its latency, from being first seen to its facts committed.
+    Then prunes the parse cache down to keep_parsed files
+    """
+
+    metrics.start_run(input_file=result["file"], db_path=engine.url.database)
+    load_parsed_file(engine, result)
+    prune_parse_cache(keep_parsed)
+    result["latency_seconds"] = round(time.monotonic() - arrived, 6)
+    metrics.finish_run(result["status"], latency_seconds=result["latency_seconds"])
+
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    target = os.path.join(
+        inbox_dir, OUTCOME_DIRS[result["status"]], f"{stamp}-{os.path.basename(result['file'])}"
+    )
+    try:
+        os.replace(result["file"], target)
+        result["moved_to"] = target
+    except FileNotFoundError:
+        logging.warning(f"{result['file']} was removed from the inbox while it was ingested")
+
+    logging.info(
+        f"{result['file']} {result['status']} {result['latency_seconds']:.2f}s after it arrived"
+    )
+    return result
+
+
+async def _watch(
+    inbox_dir: str, queue: asyncio.Queue, settle_seconds: float, poll_seconds: float
+):
+    seen = {}
+    while True:
+        for path, arrived in settled_files(inbox_dir, seen, settle_seconds, time.monotonic()):
+            await queue.put((path, arrived))  # Waits while the queue is full
+        await asyncio.sleep(poll_seconds)
+
+
+async def _parse(
+    queue: asyncio.Queue, parsed: asyncio.Queue, parsers: ProcessPoolExecutor, db_path: str
+):
+    loop = asyncio.get_running_loop()
+    while True:
+        path, arrived = await queue.get()
+        future = loop.run_in_executor(parsers, parse_and_validate, path, db_path)
+        await parsed.put((arrived, future))  # Bounded, so only a few parse ahead
+
+
+async def _write(
+    parsed: asyncio.Queue,
+    writer: ThreadPoolExecutor,
+    engine: Engine,
+    inbox_dir: str,
+    results: List[dict],
+):
+    loop = asyncio.get_running_loop()
+    # Enough for the files parsed ahead of the writer, which it hasn't read yet
+    keep_parsed = max(PARSE_CACHE_MAX_ENTRIES, parsed.maxsize + 1)
+    while True:
+        arrived, future = await parsed.get()
+        result = await future
+        # Shielded, so a stop lets the file being written commit
+        results.append(
+            await asyncio.shield(
+                loop.run_in_executor(
+                    writer, _ingest_parsed_file, engine, result, inbox_dir, arrived, keep_parsed
+                )
+            )
+        )
+
+
+async def watch_inbox(
+    inbox_dir: str = INBOX_DIR,
+    db_path: str = "/app/databases/orders.db",
+    workers: int = INGEST_WORKERS,
+    settle_seconds: float = INBOX_SETTLE_SECONDS,
+    poll_seconds: float = INBOX_POLL_SECONDS,
+    queue_size: int = INBOX_QUEUE_SIZE,
+    stop: Optional[asyncio.Event] = None,
+) -> List[dict]:
+    """
+    Ingests the input files arriving in the inbox directory until stop is set, as a
+    long-running service. Files are picked up once they've stopped changing, and go
+    through a bounded queue to a pool of parser processes, then to a single writer
+    thread that loads them through one warm engine, in the order they settled.
+    Ingested files are moved to the inbox's done/ (or failed/) directory, and each
+    file's metrics line has its latency from arrival. Files still queued when
+    stopped stay in the inbox for the next start. Files are always written in
+    place, whatever SHADOW_PUBLISH says. Returns the outcome of every file
+    """
+
+    for directory in set(OUTCOME_DIRS.values()):
+        os.makedirs(os.path.join(inbox_dir, directory), exist_ok=True)
+    stop = stop or asyncio.Event()
+    if SHADOW_PUBLISH:
+        logging.warning("SHADOW_PUBLISH is ignored by the inbox service, which writes in place")
+    engine = open_db(db_path)
+    results = []
+
+    # Parser processes are spawned, so they don't inherit this process's connections
+    parsers = ProcessPoolExecutor(
+        max_workers=max(1, workers), mp_context=multiprocessing.get_context("spawn")
+    )
+    writer = ThreadPoolExecutor(max_workers=1)  # SQLite only allows one writer at a time
+    queue, parsed = asyncio.Queue(queue_size), asyncio.Queue(max(1, workers))
+    tasks = [
+        asyncio.create_task(_watch(inbox_dir, queue, settle_seconds, poll_seconds)),
+        asyncio.create_task(_parse(queue, parsed, parsers, db_path)),
+        asyncio.create_task(_write(parsed, writer, engine, inbox_dir, results)),
+    ]
+    logging.info(f"Watching {inbox_dir} for input files")
+    try:
+        stopped = asyncio.create_task(stop.wait())
+        await asyncio.wait([stopped, *tasks], return_when=asyncio.FIRST_COMPLETED)
+        stopped.cancel()
+        for task in tasks:
+            if task.done():
+                task.result()  # Raises what stopped the service
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        writer.shutdown(wait=True)
+        parsers.shutdown(cancel_futures=True)
+        engine.dispose()
+
+    return results
+
+
+async def _serve(args: argparse.Namespace):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await watch_inbox(args.inbox, args.db_path, args.workers, stop=stop)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ingests the orders files arriving in an inbox directory"
+    )
+    parser.add_argument("inbox", nargs="?", default=INBOX_DIR)
+    parser.add_argument("--db-path", default="/app/databases/orders.db")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS)
+    asyncio.run(_serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,53 +1,153 @@
-from sqlalchemy import text
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Iterable, Tuple
+
+from sqlalchemy import bindparam, text
+
+from config import INSERT_BATCH_SIZE
+from ddl import date_key, extend_dim_date, iso_date, normalize_key, row_fingerprint
+from init_db_connection import with_date_objects
+from manifest import row_hashes
+from metrics import execute_with_plan
+from rollups import max_fact_rowid, update_rollups
+import metrics
+
+
+def _batched(values, size: int = 500):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i : i + size]
+
+
+def _fetch_current_deliveries(conn, client_keys, address_keys) -> dict:
+    """
+    Looks up the current (MostRecent = 1) delivery rows sharing a client name or
+    an address with staging, as batched probes on the natural key indexes
+    """
+
+    probes = {
+        "TRIM(LOWER(ClientName))": client_keys,
+        "TRIM(LOWER(DeliveryAddress))": address_keys,
+    }
+
+    current = {}
+    for key_expr, keys in probes.items():
+        statement = text(
+            f"""
+            SELECT DeliveryId, ClientName, DeliveryAddress, DeliveryPostcode
+            FROM dim_delivery_details
+            WHERE MostRecent = 1 AND {key_expr} IN :keys;
+            """
+        ).bindparams(bindparam("keys", expanding=True))
+
+        for batch in _batched(keys):
+            for row in conn.execute(statement, {"keys": batch}):
+                current[row.DeliveryId] = tuple(map(normalize_key, row[1:]))
+
+    return current
+
+
+def delivery_details_changes(conn, rows: Iterable) -> Tuple[dict, list]:
+    """
+    Works out the slowly changing dimension changes that the staged delivery rows
+    (named tuples of ClientName, DeliveryAddress, DeliveryPostcode, DeliveryCity,
+    DeliveryCountry and DeliveryContactNumber) make to dim_delivery_details: the
+    current rows they expire, as {DeliveryId: their normalized name, address and
+    postcode}, and the (RowHash, row) pairs to insert, in insert order. Only reads
+    the DB, so ingest plans (see plan.py) run it on a read-only connection
+    """
+
+    staging_rows = {}  # RowHash -> first staging row with that fingerprint
+    names_by_location = defaultdict(set)
+    locations_by_name = defaultdict(set)
+
+    for row in rows:
+        name, address, postcode = map(normalize_key, row[:3])
+        staging_rows.setdefault(row_fingerprint(*row[:3]), (row, address, postcode, name))
+        if None not in (name, address, postcode):
+            names_by_location[(address, postcode)].add(name)
+            locations_by_name[name].add((address, postcode))
+
+    # Changed: the same address and postcode with a different client name, or the
+    # same client name with both a different address and postcode
+    expired = {
+        delivery_id: (name, address, postcode)
+        for delivery_id, (name, address, postcode) in _fetch_current_deliveries(
+            conn, locations_by_name, {address for address, _ in names_by_location}
+        ).items()
+        if names_by_location.get((address, postcode), set()) - {name}
+        or any(
+            other_address != address and other_postcode != postcode
+            for other_address, other_postcode in locations_by_name.get(name, ())
+        )
+    }
+
+    # New: fingerprints that no delivery row (current or expired) has yet
+    existing_hashes = set()
+    statement = text(
+        "SELECT RowHash FROM dim_delivery_details WHERE RowHash IN :hashes;"
+    ).bindparams(bindparam("hashes", expanding=True))
+    for batch in _batched(staging_rows):
+        existing_hashes.update(conn.execute(statement, {"hashes": batch}).scalars())
+
+    new_rows = sorted(
+        (
+            (row_hash, staging_row)
+            for row_hash, staging_row in staging_rows.items()
+            if row_hash not in existing_hashes
+        ),
+        # Same order as grouping by the normalized address, postcode and name in SQL
+        key=lambda item: [(key is not None, key) for key in item[1][1:]],
+    )
+
+    return expired, [(row_hash, row) for row_hash, (row, *_) in new_rows]
 
 
 def insert_into_dim_delivery_details(conn):
     """
     Insert DML for the delivery dim table. SQL handles slowly changing dimensions by
-    maintain an old record if the clients businessname or postcode/address changes
+    maintain an old record if the clients businessname or postcode/address changes.
+
+    Every row stores a fingerprint (RowHash) of its normalized client name, address
+    and postcode, so new, changed and unchanged rows are told apart with set lookups
+    in one pass over staging rather than comparing every dim row with every staging row
     """
 
-    conn.execute(
-        text(
+    expired, new_rows = delivery_details_changes(
+        conn,
+        conn.execute(
+            text(
+                """
+                SELECT ClientName, DeliveryAddress, DeliveryPostcode, DeliveryCity, DeliveryCountry, DeliveryContactNumber
+                FROM staging;
+                """
+            )
+        ),
+    )
+    if expired:
+        execute_with_plan(
+            conn,
+            "expire dim_delivery_details",
             """
             UPDATE dim_delivery_details
             SET MostRecent = 0, ValidTo = CURRENT_DATE
-            WHERE MostRecent = 1
-            AND EXISTS (
-                SELECT 1 
-                FROM staging s
-                WHERE 
-                    (TRIM(LOWER(s.DeliveryAddress)) = TRIM(LOWER(dim_delivery_details.DeliveryAddress)) AND
-                    TRIM(LOWER(s.DeliveryPostcode)) = TRIM(LOWER(dim_delivery_details.DeliveryPostcode)) AND
-                    TRIM(LOWER(s.ClientName)) != TRIM(LOWER(dim_delivery_details.ClientName))) 
-                    OR
-                    (TRIM(LOWER(s.DeliveryAddress)) != TRIM(LOWER(dim_delivery_details.DeliveryAddress)) AND
-                    TRIM(LOWER(s.DeliveryPostcode)) != TRIM(LOWER(dim_delivery_details.DeliveryPostcode)) AND
-                    TRIM(LOWER(s.ClientName)) = TRIM(LOWER(dim_delivery_details.ClientName)))
-            );
-            """
+            WHERE DeliveryId = :DeliveryId;
+            """,
+            [{"DeliveryId": delivery_id} for delivery_id in expired],
         )
-    )
 
-    conn.execute(
-        text(
-            """
-            INSERT OR IGNORE INTO dim_delivery_details 
-                (ClientName, DeliveryAddress, DeliveryPostcode, DeliveryCity, DeliveryCountry, DeliveryContactNumber, MostRecent, ValidFrom)
-            SELECT 
-                s.ClientName, s.DeliveryAddress, s.DeliveryPostcode, s.DeliveryCity, s.DeliveryCountry, s.DeliveryContactNumber, 1 AS MostRecent, CURRENT_DATE AS ValidFrom
-            FROM staging s
-            LEFT JOIN dim_delivery_details d ON TRIM(LOWER(s.DeliveryAddress)) = TRIM(LOWER(d.DeliveryAddress)) AND TRIM(LOWER(s.DeliveryPostcode)) = TRIM(LOWER(d.DeliveryPostcode)) AND TRIM(LOWER(s.ClientName)) = TRIM(LOWER(d.ClientName)) AND d.MostRecent = 1
-            WHERE d.DeliveryId IS NULL AND NOT EXISTS (
-                SELECT 1 FROM dim_delivery_details dd
-                WHERE TRIM(LOWER(dd.DeliveryAddress)) = TRIM(LOWER(s.DeliveryAddress))
-                AND TRIM(LOWER(dd.DeliveryPostcode)) = TRIM(LOWER(s.DeliveryPostcode)) 
-                AND TRIM(LOWER(dd.ClientName)) = TRIM(LOWER(s.ClientName))
-            )
-            GROUP BY TRIM(LOWER(s.DeliveryAddress)), TRIM(LOWER(s.DeliveryPostcode)), TRIM(LOWER(s.ClientName));
+    if new_rows:
+        execute_with_plan(
+            conn,
+            "insert dim_delivery_details",
             """
+            INSERT INTO dim_delivery_details
+                (ClientName, DeliveryAddress, DeliveryPostcode, DeliveryCity, DeliveryCountry, DeliveryContactNumber, MostRecent, ValidFrom, RowHash)
+            VALUES
+                (:ClientName, :DeliveryAddress, :DeliveryPostcode, :DeliveryCity, :DeliveryCountry, :DeliveryContactNumber, 1, CURRENT_DATE, :RowHash);
+            """,
+            [{**row._asdict(), "RowHash": row_hash} for row_hash, row in new_rows],
         )
-    )
 
 
 def insert_into_dim_product_details(conn):
@@ -56,66 +156,187 @@ def insert_into_dim_product_details(conn):
     updating the record (not inserting) if the price changes
     """
 
-    conn.execute(
-        text(
-            """
-            UPDATE dim_product_details
-            SET 
-                UnitPrice = (SELECT MAX(UnitPrice) FROM staging WHERE 
-                             TRIM(LOWER(dim_product_details.ProductName)) = TRIM(LOWER(staging.ProductName)))
-            WHERE EXISTS (
-                SELECT 1 FROM staging 
-                WHERE TRIM(LOWER(dim_product_details.ProductName)) = TRIM(LOWER(staging.ProductName))
-            );
-            """
-        )
+    execute_with_plan(
+        conn,
+        "update dim_product_details",
+        """
+        UPDATE dim_product_details
+        SET UnitPrice = s.UnitPrice
+        FROM (
+            SELECT TRIM(LOWER(ProductName)) AS ProductNameKey, MAX(UnitPrice) AS UnitPrice
+            FROM staging
+            GROUP BY TRIM(LOWER(ProductName))
+        ) s
+        WHERE TRIM(LOWER(dim_product_details.ProductName)) = s.ProductNameKey;
+        """,
     )
 
-    conn.execute(
-        text(
-            """
-            INSERT OR IGNORE INTO dim_product_details (ProductName, ProductType, UnitPrice)
-            SELECT staging.ProductName, staging.ProductType, MAX(staging.UnitPrice) as UnitPrice
-            FROM staging
-            LEFT JOIN dim_product_details ON 
-                TRIM(LOWER(dim_product_details.ProductName)) = TRIM(LOWER(staging.ProductName))
-            WHERE dim_product_details.ProductId IS NULL
-            GROUP BY TRIM(LOWER(staging.ProductName));
-            """
-        )
+    execute_with_plan(
+        conn,
+        "insert dim_product_details",
+        """
+        INSERT OR IGNORE INTO dim_product_details (ProductName, ProductType, UnitPrice)
+        SELECT staging.ProductName, staging.ProductType, MAX(staging.UnitPrice) as UnitPrice
+        FROM staging
+        LEFT JOIN dim_product_details ON 
+            TRIM(LOWER(dim_product_details.ProductName)) = TRIM(LOWER(staging.ProductName))
+        WHERE dim_product_details.ProductId IS NULL
+        GROUP BY TRIM(LOWER(staging.ProductName));
+        """,
     )
 
 
 def insert_into_dim_payment_details(conn):
-    conn.execute(
+    execute_with_plan(
+        conn,
+        "insert dim_payment_details",
+        f"""
+        INSERT OR IGNORE INTO dim_payment_details (PaymentBillingCode, PaymentType, PaymentDate)
+        SELECT PaymentBillingCode, PaymentType, {iso_date("PaymentDate")}
+        FROM staging
+        GROUP BY TRIM(LOWER(PaymentBillingCode)), TRIM(LOWER(PaymentType)), TRIM(LOWER(PaymentDate));
+        """,
+    )
+
+
+def insert_into_dim_date(conn):
+    """
+    Extends the dim_date calendar to cover the staged payment dates, without gaps
+    between them and the days it already has
+    """
+
+    start, end = conn.execute(
         text(
-            """
-            INSERT OR IGNORE INTO dim_payment_details (PaymentBillingCode, PaymentType, PaymentDate)
-            SELECT PaymentBillingCode, PaymentType, PaymentDate
-            FROM staging
-            GROUP BY TRIM(LOWER(PaymentBillingCode)), TRIM(LOWER(PaymentType)), TRIM(LOWER(PaymentDate));
+            f"""
+            SELECT MIN(day), MAX(day)
+            FROM (
+                SELECT {iso_date("PaymentDate")} AS day FROM staging
+                UNION ALL
+                SELECT Date FROM dim_date WHERE DateKey IN ((SELECT MIN(DateKey) FROM dim_date), (SELECT MAX(DateKey) FROM dim_date))
+            );
             """
         )
-    )
+    ).first()
+    if start:
+        extend_dim_date(conn, start, end)
 
 
 def insert_into_fact_orders(conn):
-    conn.execute(
+    """
+    Insert DML for the fact table. The rollups are updated with the new facts in the
+    same transaction
+    """
+
+    after_rowid = max_fact_rowid(conn)
+    execute_with_plan(
+        conn,
+        "insert fact_orders",
+        f"""
+        INSERT OR IGNORE INTO fact_orders (OrderNumber, DeliveryId, ProductId, PaymentId, TotalPrice, Currency, ProductQuantity, DateKey)
+        SELECT
+            s.OrderNumber,
+            d.DeliveryId,
+            p.ProductId,
+            pay.PaymentId,
+            s.TotalPrice,
+            s.Currency,
+            s.ProductQuantity,
+            {date_key("pay.PaymentDate")}
+        FROM staging s
+        JOIN dim_delivery_details d ON TRIM(LOWER(s.ClientName)) = TRIM(LOWER(d.ClientName)) AND TRIM(LOWER(s.DeliveryAddress)) = TRIM(LOWER(d.DeliveryAddress)) AND TRIM(LOWER(s.DeliveryPostcode)) = TRIM(LOWER(d.DeliveryPostcode))
+        JOIN dim_product_details p ON TRIM(LOWER(s.ProductName)) = TRIM(LOWER(p.ProductName))
+        JOIN dim_payment_details pay ON TRIM(LOWER(s.PaymentBillingCode)) = TRIM(LOWER(pay.PaymentBillingCode));
+        """,
+    )
+    update_rollups(conn, after_rowid)
+
+
+def insert_into_fact_orders_cached(
+    conn, key_caches: dict, batch_size: int = INSERT_BATCH_SIZE
+):
+    """
+    Same result as insert_into_fact_orders, but the DeliveryId, ProductId and PaymentId
+    of each staging row are resolved in Python through the in-memory key caches (see
+    key_cache.build_key_caches) and the facts are written with batched executemany
+    """
+
+    for cache in key_caches.values():
+        cache.refresh(conn)  # Picks up the rows the dim inserts just added
+
+    after_rowid = max_fact_rowid(conn)
+
+    staging = conn.execute(
         text(
             """
-            INSERT OR IGNORE INTO fact_orders (OrderNumber, DeliveryId, ProductId, PaymentId, TotalPrice, Currency, ProductQuantity)
-            SELECT
-                s.OrderNumber,
-                d.DeliveryId,
-                p.ProductId,
-                pay.PaymentId,
-                s.TotalPrice,
-                s.Currency,
-                s.ProductQuantity
-            FROM staging s
-            JOIN dim_delivery_details d ON TRIM(LOWER(s.ClientName)) = TRIM(LOWER(d.ClientName)) AND TRIM(LOWER(s.DeliveryAddress)) = TRIM(LOWER(d.DeliveryAddress)) AND TRIM(LOWER(s.DeliveryPostcode)) = TRIM(LOWER(d.DeliveryPostcode))
-            JOIN dim_product_details p ON TRIM(LOWER(s.ProductName)) = TRIM(LOWER(p.ProductName))
-            JOIN dim_payment_details pay ON TRIM(LOWER(s.PaymentBillingCode)) = TRIM(LOWER(pay.PaymentBillingCode));
+            SELECT OrderNumber, ClientName, DeliveryAddress, DeliveryPostcode, ProductName, PaymentBillingCode, TotalPrice, Currency, ProductQuantity
+            FROM staging;
             """
         )
-    )
+    ).mappings()
+
+    for rows in staging.partitions(batch_size):
+        keys = {
+            id_column: [cache.staging_key(row) for row in rows]
+            for id_column, cache in key_caches.items()
+        }
+        surrogate_ids = {
+            id_column: cache.resolve(conn, keys[id_column])
+            for id_column, cache in key_caches.items()
+        }
+
+        facts = []
+        for i, row in enumerate(rows):
+            fact = {
+                "OrderNumber": row["OrderNumber"],
+                "TotalPrice": row["TotalPrice"],
+                "Currency": row["Currency"],
+                "ProductQuantity": row["ProductQuantity"],
+            }
+            for id_column in key_caches:
+                fact[id_column] = surrogate_ids[id_column].get(keys[id_column][i])
+            if None not in (fact[id_column] for id_column in key_caches):  # Inner join
+                facts.append(fact)
+
+        if facts:
+            result = conn.execute(
+                text(
+                    f"""
+                    INSERT OR IGNORE INTO fact_orders (OrderNumber, DeliveryId, ProductId, PaymentId, TotalPrice, Currency, ProductQuantity, DateKey)
+                    VALUES (
+                        :OrderNumber, :DeliveryId, :ProductId, :PaymentId, :TotalPrice, :Currency, :ProductQuantity,
+                        (SELECT {date_key("PaymentDate")} FROM dim_payment_details WHERE PaymentId = :PaymentId)
+                    );
+                    """
+                ),
+                facts,
+            )
+            metrics.add_rows(result.rowcount)
+
+    update_rollups(conn, after_rowid)
+
+
+def insert_into_rejected_orders(conn, rejected: list, fingerprint: str, file_name: str):
+    """
+    Inserts the rows quarantined by data_quality_checks.iter_valid_rows, with the
+    file they came from, so they can be fixed and reloaded on their own. A row is
+    keyed by its file and content hash, so rerunning the file doesn't store it twice
+    """
+
+    rejected_at = datetime.now(timezone.utc).isoformat()
+    for frame in rejected:
+        frame = frame.drop(columns="RowHash", errors="ignore")
+        frame = with_date_objects(frame).assign(
+            FileFingerprint=fingerprint,
+            FileName=file_name,
+            RejectedAt=rejected_at,
+            RowHash=row_hashes(frame.drop(columns="RejectReasons")),
+        )
+        frame = frame.astype(object).where(frame.notna(), None)
+        columns = ", ".join(frame.columns)
+        values = ", ".join(f":{col}" for col in frame.columns)
+        execute_with_plan(
+            conn,
+            "insert rejected_orders",
+            f"INSERT OR IGNORE INTO rejected_orders ({columns}) VALUES ({values});",
+            frame.to_dict("records"),
+        )
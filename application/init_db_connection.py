@@ -1,36 +1,560 @@
-from typing import Generator
+from itertools import islice
+from typing import Generator, Iterable, Iterator, List, Union
 import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
 
-from sqlalchemy import Engine, MetaData, Table
+from openpyxl import load_workbook
+from pandas.api.types import union_categoricals
+from sqlalchemy import Engine, String, create_engine, event, text
 from sqlalchemy.engine.base import Connection
+import numpy as np
 import pandas as pd
 
+from config import (
+    PARSE_CACHE_DIR,
+    PARSE_CACHE_MAX_ENTRIES,
+    READ_CHUNK_SIZE,
+    SQLITE_PROFILE,
+    STAGING_SCHEMA,
+)
+from ddl import create_staging_indexes, create_staging_table, input_columns
+import metrics
+
+
+# PRAGMAs applied to every new connection of an engine, by profile name
+SQLITE_PROFILES = {
+    "default": {},
+    # Ingest runs: WAL lets readers carry on during the load and only needs
+    # synchronous=NORMAL to stay consistent, plus a big page cache and mmap
+    "bulk_load": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -262144,  # KiB, i.e. 256 MiB
+        "mmap_size": 1073741824,
+        "temp_store": "MEMORY",
+    },
+    # Query connections: no writes, so just caching and mmap for fast reads
+    "read_optimized": {
+        "query_only": "ON",
+        "cache_size": -65536,
+        "mmap_size": 1073741824,
+        "temp_store": "MEMORY",
+    },
+}
+
+
+def create_sqlite_engine(db_path: str, profile: str = SQLITE_PROFILE) -> Engine:
+    """
+    Creates an engine for a SQLite DB whose connections are all set up with the
+    PRAGMAs of the named profile, through a SQLAlchemy connect event
+    """
+
+    pragmas = SQLITE_PROFILES[profile]
+    engine = create_engine(f"sqlite:///{db_path}")
+
+    @event.listens_for(engine, "connect")
+    def apply_profile(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value};")
+        cursor.close()
+
+    return engine
+
+
+def optimize_database(conn: Connection):
+    """
+    Refreshes the query planner statistics after a load. analysis_limit keeps
+    ANALYZE to a sample of each index, so it stays cheap on large tables
+    """
+
+    conn.execute(text("PRAGMA analysis_limit = 1000;"))
+    conn.execute(text("ANALYZE;"))
+    conn.execute(text("PRAGMA optimize;"))
+
+
+def _convert_cell(value):
+    """
+    Mirrors pandas' openpyxl reader, which turns whole-number floats into ints
+    and empty cells into NaN
+    """
+
+    if value is None:
+        return np.nan
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+# The columns read from the inputs, in order, and those read as text
+INPUT_COLUMNS = [column.name for column in input_columns()]
+TEXT_COLUMNS = [
+    column.name for column in input_columns() if isinstance(column.type, String)
+]
+# Text columns with few distinct values, repeated on most rows. They're held as
+# categoricals, i.e. an integer code per row into a single copy of each value
+CATEGORICAL_COLUMNS = [
+    "ClientName",
+    "ProductName",
+    "ProductType",
+    "Currency",
+    "DeliveryCity",
+    "DeliveryCountry",
+    "PaymentType",
+]
+
+
+def _downcast(series: pd.Series) -> pd.Series:
+    """The numeric column in the smallest dtype that holds exactly the same values"""
+
+    if pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast="integer")
+
+    as_float32 = series.astype("float32")
+    if ((as_float32.astype("float64") == series) | series.isna()).all():
+        return as_float32
+    return series  # e.g. prices with more significant digits than float32 has
+
+
+def _normalize_orders_chunk(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Brings a chunk read by any input adapter to the same compact shape: the known
+    input columns in order, NaN for empty cells, the low-cardinality text columns
+    as categoricals, numbers downcast and PaymentDate as a datetime64 array of days
+    """
+
+    df = df[[col for col in INPUT_COLUMNS if col in df.columns]]
+    text_columns = [col for col in TEXT_COLUMNS if col in df.columns]
+    df[text_columns] = df[text_columns].where(df[text_columns].notna(), np.nan)
+    df["PaymentDate"] = pd.to_datetime(df["PaymentDate"]).dt.normalize()
+
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    for col in df.select_dtypes("number").columns:
+        df[col] = _downcast(df[col])
+
+    return df
+
+
+def with_date_objects(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The DataFrame with its datetime64 columns as datetime.date objects, which
+    to_sql stores as DATE columns of ISO dates rather than as timestamps
+    """
+
+    dates = {col: df[col].dt.date for col in df.select_dtypes("datetime").columns}
+    return df.assign(**dates) if dates else df
+
+
+def concat_chunks(chunks: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenates chunks like pd.concat, but keeps the categorical columns categorical
+    when the chunks have different categories, rather than expanding them to objects
+    """
+
+    df = pd.concat(chunks, ignore_index=True)
+    for col in df.columns:
+        parts = [chunk[col] for chunk in chunks]
+        if not isinstance(df[col].dtype, pd.CategoricalDtype) and all(
+            isinstance(part.dtype, pd.CategoricalDtype) for part in parts
+        ):
+            df[col] = union_categoricals(parts, sort_categories=True)
+
+    return df
+
+
+def iter_excel_chunks(
+    filename: str, chunk_size: int = READ_CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    """
+    Streams the first sheet of an Excel file as DataFrames of at most chunk_size rows.
+    The workbook is opened in openpyxl's read-only mode, so only the current chunk
+    is ever held in memory
+    """
+
+    workbook = load_workbook(filename, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+
+        columns = list(header)
+        records = (
+            [_convert_cell(value) for value in row]
+            for row in rows
+            if any(value is not None for value in row)  # Skip blank rows
+        )
+
+        while chunk := list(islice(records, chunk_size)):
+            yield _normalize_orders_chunk(
+                pd.DataFrame.from_records(chunk, columns=columns)
+            )
+    finally:
+        workbook.close()
+
+
+def _typed_like_excel(series: pd.Series) -> pd.Series:
+    """
+    A column of CSV strings with its cells typed the way the xlsx reader types the
+    same data: cells that read as numbers become numbers (whole ones ints, see
+    _convert_cell), the rest stay strings. So a numeric-looking billing code or
+    postcode is a number in either format, and the data quality checks treat a
+    dataset the same whichever format it comes in
+    """
+
+    numbers = pd.to_numeric(series, errors="coerce")
+    is_number = numbers.notna()
+    if not is_number.any():
+        return series
+    if is_number.equals(series.notna()):
+        return numbers  # A numeric column
+    typed = series.astype(object)
+    typed[is_number] = [_convert_cell(float(value)) for value in numbers[is_number]]
+    return typed
+
+
+def iter_csv_chunks(
+    filename: str, chunk_size: int = READ_CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    """
+    Streams a CSV file as DataFrames of at most chunk_size rows. Cells are read as
+    strings, then typed like the xlsx reader types them (see _typed_like_excel)
+    """
+
+    with pd.read_csv(
+        filename,
+        chunksize=chunk_size,
+        usecols=lambda col: col in INPUT_COLUMNS,
+        dtype=str,
+    ) as reader:
+        for chunk in reader:
+            yield _normalize_orders_chunk(
+                chunk.assign(
+                    **{
+                        col: _typed_like_excel(chunk[col])
+                        for col in chunk.columns
+                        if col != "PaymentDate"
+                    }
+                )
+            )
+
+
+def iter_parquet_chunks(
+    filename: str, chunk_size: int = READ_CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    """
+    Streams a Parquet file as DataFrames of at most chunk_size rows, a row group at a
+    time, only reading the input columns. Needs the optional pyarrow package
+    """
+
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Reading Parquet inputs needs pyarrow installed") from e
+
+    parquet_file = pq.ParquetFile(filename)
+    columns = [col for col in parquet_file.schema_arrow.names if col in INPUT_COLUMNS]
+    try:
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield _normalize_orders_chunk(batch.to_pandas())
+    finally:
+        parquet_file.close()
+
+
+# Input adapters by file extension. Each streams a file as DataFrames of at most
+# chunk_size rows, normalized by _normalize_orders_chunk
+INPUT_ADAPTERS = {
+    ".xlsx": iter_excel_chunks,
+    ".csv": iter_csv_chunks,
+    ".parquet": iter_parquet_chunks,
+}
+
+
+def iter_input_chunks(
+    filename: str, chunk_size: int = READ_CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    """Streams an input file with the adapter for its extension"""
+
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in INPUT_ADAPTERS:
+        raise ValueError(
+            f"Unsupported input file {filename}, expected one of {', '.join(INPUT_ADAPTERS)}"
+        )
+
+    return INPUT_ADAPTERS[extension](filename, chunk_size)
+
+
+def file_fingerprint(filename: str, cache_dir: str = PARSE_CACHE_DIR) -> str:
+    """
+    Returns the SHA-256 of a file's contents. Hashes are remembered against the
+    file's size and mtime, so an untouched file isn't read again to fingerprint it
+    """
+
+    stat = os.stat(filename)
+    index_path = os.path.join(cache_dir, "fingerprints.json")
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+
+    key = os.path.abspath(filename)
+    entry = index.get(key)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+
+    index[key] = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": digest.hexdigest(),
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{index_path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)  # Parser processes may update it concurrently
+
+    return digest.hexdigest()
+
+
+def prune_parse_cache(
+    keep: int = PARSE_CACHE_MAX_ENTRIES, cache_dir: str = PARSE_CACHE_DIR
+):
+    """
+    Removes all but the keep most recently used parsed files from the parse cache.
+    Only the writer calls it, between files (see iter_cached_input_chunks)
+    """
+
+    if not os.path.isdir(cache_dir):
+        return
+    entries = sorted(
+        (
+            entry
+            for entry in os.scandir(cache_dir)
+            if entry.is_dir() and ".tmp-" not in entry.name
+        ),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True,
+    )
+    for entry in entries[keep:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+# The layout of the chunks the parse cache holds (dtypes, date representation). It's
+# part of each entry's name, so entries in another layout are never read, just
+# parsed again and pruned. Bump it whenever _normalize_orders_chunk's output changes
+CACHE_FORMAT_VERSION = 2
+
+
+def iter_cached_input_chunks(
+    filename: str,
+    chunk_size: int = READ_CHUNK_SIZE,
+    cache_dir: str = PARSE_CACHE_DIR,
+) -> Iterator[pd.DataFrame]:
+    """
+    Streams an input file like iter_input_chunks, keeping a columnar (pickled) copy
+    of every parsed chunk on disk. The copy is keyed by the file's fingerprint and
+    the CACHE_FORMAT_VERSION, so later reads of an unchanged file skip the parse
+    entirely, and copies in an older layout are missed. Never prunes the
+    cache, as parser processes fill it with files the writer hasn't read yet: the
+    writer prunes it once they're loaded (see prune_parse_cache)
+    """
+
+    entry_dir = os.path.join(
+        cache_dir,
+        f"{file_fingerprint(filename, cache_dir)}-{chunk_size}-v{CACHE_FORMAT_VERSION}",
+    )
+    if os.path.isdir(entry_dir):
+        logging.info(f"Reading parsed copy of {filename} from {entry_dir}")
+        os.utime(entry_dir)  # Marks the entry as recently used for pruning
+        for chunk_file in sorted(os.listdir(entry_dir)):
+            yield pd.read_pickle(os.path.join(entry_dir, chunk_file))
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f"{os.path.basename(entry_dir)}.tmp-", dir=cache_dir)
+    try:
+        for i, chunk in enumerate(iter_input_chunks(filename, chunk_size)):
+            chunk.to_pickle(os.path.join(tmp_dir, f"{i:08d}.pkl"))
+            yield chunk
+        try:
+            os.replace(tmp_dir, entry_dir)  # Only fully parsed files are published
+        except OSError:
+            # Another parser published a file with the same contents first
+            if not os.path.isdir(entry_dir):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def iter_row_ranges(
+    chunks: Iterable[pd.DataFrame], size: int, start: int = 0
+) -> Iterator[pd.DataFrame]:
+    """
+    Re-slices a stream of chunks into consecutive ranges of `size` rows (the last one
+    may be shorter), after skipping the first `start` rows
+    """
+
+    buffer, buffered = [], 0
+    for chunk in chunks:
+        if start:
+            skipped = min(start, len(chunk))
+            chunk, start = chunk.iloc[skipped:], start - skipped
+        buffer.append(chunk)
+        buffered += len(chunk)
+
+        while buffered >= size:
+            rows = concat_chunks(buffer)
+            yield rows.iloc[:size]
+            buffer, buffered = [rows.iloc[size:]], buffered - size
+
+    if buffered:
+        yield concat_chunks(buffer)
+
 
 def read_excel_to_dataframe(filename: str) -> pd.DataFrame:
     """Reads an Excel file into a Pandas DataFrame."""
 
-    df = pd.read_excel(filename, engine="openpyxl")
-    df["PaymentDate"] = pd.to_datetime(
-        df["PaymentDate"]
-    ).dt.date  # Else it changes to datetime
+    chunks = list(iter_excel_chunks(filename))
+    if not chunks:
+        return pd.DataFrame()
 
-    return df
+    return concat_chunks(chunks)
 
 
 @contextlib.contextmanager
 def init_engine_and_load_data(
-    engine: Engine, table_name: str, dataframe: pd.DataFrame
+    engine: Engine,
+    table_name: str,
+    dataframe: Union[pd.DataFrame, Iterable[pd.DataFrame]],
 ) -> Generator[Connection, None, None]:
-    """Initializes the engine and loads the DataFrame into a staging table."""
+    """
+    Initializes the engine and loads the DataFrame into a staging table. An iterable
+    of DataFrames (e.g. from iter_excel_chunks) is loaded one chunk at a time
+    """
+
+    chunks = [dataframe] if isinstance(dataframe, pd.DataFrame) else dataframe
 
     connection = None
     try:
-        dataframe.to_sql(table_name, con=engine, index=False, if_exists="replace")
+        if_exists = "replace"
+        for chunk in chunks:
+            with_date_objects(chunk).to_sql(table_name, con=engine, index=False, if_exists=if_exists)
+            if_exists = "append"
         connection = engine.connect()
         yield connection
     finally:
         if connection:
             connection.close()
         # Drop the staging table
-        Table(table_name, MetaData(), autoload_with=engine).drop(engine)
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
         engine.dispose()
+
+
+def _sql_values(series: pd.Series) -> list:
+    """
+    A column as the Python values sqlite3 binds, with None for missing values and
+    dates as ISO strings. Categorical and date columns convert each distinct value
+    once and hand out the same object for every row, through their codes
+    """
+
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes, labels = series.cat.codes.to_numpy(), series.cat.categories.to_numpy(dtype=object)
+    elif pd.api.types.is_datetime64_dtype(series):
+        codes, uniques = pd.factorize(series)
+        labels = uniques.strftime("%Y-%m-%d").to_numpy(dtype=object)
+    else:
+        return series.astype(object).where(series.notna(), None).tolist()
+
+    return np.append(labels, None)[codes].tolist()  # Missing values have code -1
+
+
+def _sql_rows(chunk: pd.DataFrame) -> list:
+    """Rows of the chunk as tuples, with NaN as None and dates as ISO strings"""
+
+    return list(zip(*(_sql_values(chunk[col]) for col in chunk.columns)))
+
+
+def load_staging_table(
+    conn: Connection,
+    dataframe: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+    table_name: str = "staging",
+    schema: str = STAGING_SCHEMA,
+) -> int:
+    """
+    Bulk loads the DataFrame (or its chunks) into a staging table with a predeclared
+    schema, using one executemany per chunk inside a single transaction. With the
+    "temp" or "memory" schema, the staging pages never reach the main DB file.
+    Returns the number of rows loaded
+    """
+
+    chunks = [dataframe] if isinstance(dataframe, pd.DataFrame) else dataframe
+
+    if schema == "memory":
+        conn.execute(text("ATTACH DATABASE ':memory:' AS staging_mem;"))
+        schema = "staging_mem"
+    create_staging_table(conn, table_name, schema)
+
+    start, rows_loaded = time.perf_counter(), 0
+    for chunk in chunks:
+        columns = ", ".join(chunk.columns)
+        placeholders = ", ".join("?" for _ in chunk.columns)
+        rows = _sql_rows(chunk)
+        conn.exec_driver_sql(
+            f"INSERT INTO {schema}.{table_name} ({columns}) VALUES ({placeholders});",
+            rows,
+        )
+        rows_loaded += len(rows)
+        metrics.add_rows(len(rows))
+
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"Loaded {rows_loaded} rows into {schema}.{table_name} in {elapsed:.2f}s "
+        f"({rows_loaded / elapsed if elapsed else 0:.0f} rows/sec)"
+    )
+
+    return rows_loaded
+
+
+@contextlib.contextmanager
+def init_engine_and_load_staging(
+    engine: Engine,
+    dataframe: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+    schema: str = STAGING_SCHEMA,
+) -> Generator[Connection, None, None]:
+    """
+    Like init_engine_and_load_data, but loads the staging table with the bulk loader.
+    A TEMP or in-memory staging table only exists on the yielded connection, which
+    is cleaned up and returned to the engine's pool after, so a long-running
+    process can keep reusing the engine's warm connections
+    """
+
+    connection = engine.connect()
+    try:
+        load_staging_table(connection, dataframe, schema=schema)
+        create_staging_indexes(
+            connection, schema="staging_mem" if schema == "memory" else schema
+        )
+        yield connection
+    finally:
+        connection.rollback()
+        if schema == "memory":
+            connection.execute(text("DETACH DATABASE staging_mem;"))
+        else:
+            connection.execute(text(f"DROP TABLE IF EXISTS {schema}.staging;"))
+            connection.commit()
+        connection.close()
@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from typing import Callable, Iterable
+
+from sqlalchemy import bindparam, text
+
+from config import KEY_CACHE_MAX_SIZE
+from ddl import normalize_key, row_fingerprint
+
+
+class SurrogateKeyCache:
+    """
+    A size-bounded, least-recently-used map of normalized natural key -> surrogate
+    key for one dimension table. Keys that aren't cached (never loaded, or evicted)
+    are looked up in the DB in batches through the natural key index, so the bound
+    only costs extra lookups, never wrong or missing keys
+    """
+
+    def __init__(
+        self,
+        table: str,
+        id_column: str,
+        key_expr: str,
+        staging_key: Callable[[dict], str],
+        max_size: int = KEY_CACHE_MAX_SIZE,
+    ):
+        self.table = table
+        self.id_column = id_column
+        self.key_expr = key_expr  # SQL expression for the key, as indexed in ddl
+        self.staging_key = staging_key  # Python equivalent, for a staging row
+        self.max_size = max_size
+        self.max_seen_id = 0
+        self.hits = self.misses = 0
+        self._keys = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _put(self, key, surrogate_id):
+        self._keys[key] = surrogate_id
+        self._keys.move_to_end(key)
+        if len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+
+    def _load(self, conn, where: str, params: dict):
+        # Newest rows first, keeping the lowest id where two rows share a key like the SQL join
+        for key, surrogate_id in conn.execute(
+            text(
+                f"""
+                SELECT {self.key_expr} AS key, {self.id_column} AS id
+                FROM {self.table}
+                WHERE {where}
+                ORDER BY {self.id_column} DESC
+                LIMIT :limit;
+                """
+            ),
+            {"limit": self.max_size, **params},
+        ):
+            if key not in self._keys or surrogate_id < self._keys[key]:
+                self._put(key, surrogate_id)
+            self.max_seen_id = max(self.max_seen_id, surrogate_id)
+
+    def warm(self, conn):
+        """Loads the newest max_size rows of the dimension"""
+
+        self._load(conn, "1 = 1", {})
+
+    def refresh(self, conn):
+        """Adds the rows inserted into the dimension since the last warm/refresh"""
+
+        self._load(conn, f"{self.id_column} > :max_seen_id", {"max_seen_id": self.max_seen_id})
+
+    def resolve(self, conn, keys: Iterable) -> dict:
+        """Returns the surrogate keys for the given natural keys that exist"""
+
+        resolved, missing = {}, set()
+        for key in keys:
+            if key in resolved or key in missing:
+                continue
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                resolved[key] = self._keys[key]
+                self.hits += 1
+            else:
+                missing.add(key)
+                self.misses += 1
+
+        statement = text(
+            f"""
+            SELECT {self.key_expr} AS key, MIN({self.id_column}) AS id
+            FROM {self.table}
+            WHERE {self.key_expr} IN :keys
+            GROUP BY {self.key_expr};
+            """
+        ).bindparams(bindparam("keys", expanding=True))
+        missing = list(missing)
+        for i in range(0, len(missing), 500):
+            for key, surrogate_id in conn.execute(
+                statement, {"keys": missing[i : i + 500]}
+            ):
+                self._put(key, surrogate_id)
+                resolved[key] = surrogate_id
+
+        return resolved
+
+
+def build_key_caches(conn, max_size: int = KEY_CACHE_MAX_SIZE) -> dict:
+    """Creates and warms a key cache for each dimension the fact table references"""
+
+    caches = {
+        "DeliveryId": SurrogateKeyCache(
+            "dim_delivery_details",
+            "DeliveryId",
+            "RowHash",
+            lambda row: row_fingerprint(
+                row["ClientName"], row["DeliveryAddress"], row["DeliveryPostcode"]
+            ),
+            max_size,
+        ),
+        "ProductId": SurrogateKeyCache(
+            "dim_product_details",
+            "ProductId",
+            "TRIM(LOWER(ProductName))",
+            lambda row: normalize_key(row["ProductName"]),
+            max_size,
+        ),
+        "PaymentId": SurrogateKeyCache(
+            "dim_payment_details",
+            "PaymentId",
+            "TRIM(LOWER(PaymentBillingCode))",
+            lambda row: normalize_key(row["PaymentBillingCode"]),
+            max_size,
+        ),
+    }
+
+    for cache in caches.values():
+        cache.warm(conn)
+
+    return caches
@@ -1,60 +1,600 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Generator, Iterable, List, Optional, Set
+import argparse
+import contextlib
+import glob
 import logging
+import multiprocessing
 import os
+import sys
 
-from init_db_connection import init_engine_and_load_data, read_excel_to_dataframe
+from sqlalchemy import Engine, text
+from sqlalchemy.engine.base import Connection
+
+from init_db_connection import (
+    INPUT_ADAPTERS,
+    create_sqlite_engine,
+    file_fingerprint,
+    init_engine_and_load_staging,
+    iter_cached_input_chunks,
+    iter_row_ranges,
+    optimize_database,
+    prune_parse_cache,
+)
 from data_quality_checks import (
-    create_engine,
     data_quality_check,
-    run_all_data_quality_checks,
+    drop_loaded_orders,
+    iter_valid_rows,
+    run_vectorized_data_quality_checks,
 )
-from ddl import create_orders_tables
+from ddl import create_orders_tables, defer_read_indexes, rebuild_read_indexes
 from ingest_orders_dml import (
     insert_into_dim_delivery_details,
     insert_into_dim_product_details,
     insert_into_dim_payment_details,
+    insert_into_dim_date,
     insert_into_fact_orders,
+    insert_into_fact_orders_cached,
+    insert_into_rejected_orders,
+)
+from key_cache import build_key_caches
+from manifest import (
+    bump_generation,
+    clear_checkpoint,
+    is_file_ingested,
+    iter_new_rows,
+    publish_generation,
+    read_checkpoint,
+    read_generation,
+    record_ingest,
+    record_ingest_rows,
+    write_checkpoint,
+)
+from partitions import backfill_partitioned_orders, route_facts_to_partitions
+from plan import run_ingest_plan
+from shadow import shadow_build
+import metrics
+from config import (
+    FACT_KEY_CACHE,
+    FACT_PARTITIONS,
+    INCREMENTAL_INGEST,
+    INGEST_COMMIT_ROWS,
+    INGEST_WORKERS,
+    MAX_REJECTED_FRACTION,
+    READ_INDEX_DEFER_RATIO,
+    SHADOW_PUBLISH,
+    SQLITE_PROFILE,
+    SQLITE_READ_PROFILE,
 )
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 
-def run_data_ingest():
-    """
-    Runs orders data ingestion in these steps:
-        1. Creates a db if doesn't exist (if it isn't past in via a docker volume mount)
-        2. Runs data quality checks on in memory db
-        3. Creates DDL for on-disk orders db
-        4. Inserts data into that db
-    """
-
-    db_path = "/app/databases/orders.db"
+def _create_db(db_path: str):
     if not os.path.exists(db_path):
         open(
             db_path, "a"
         ).close()  # Create an empty SQLite database if it doesn't exist
 
-    with init_engine_and_load_data(
-        create_engine("sqlite:///:memory:"),
-        "orders",
-        read_excel_to_dataframe("input_data.xlsx"),
-    ) as conn:
-        data_quality_check(run_all_data_quality_checks(conn))
 
-    with init_engine_and_load_data(
-        create_engine(f"sqlite:///{db_path}"),
-        "staging",
-        read_excel_to_dataframe("input_data.xlsx"),
-    ) as conn:
+@contextlib.contextmanager
+def _staged_and_transformed(
+    engine: Engine, chunks: Iterable, input_file: str, fingerprint: str
+) -> Generator[Connection, None, None]:
+    """
+    Loads the new and valid rows of the chunks into staging, drops the orders
+    already loaded by earlier ingests, then runs the DML and quarantines the rows
+    that failed the checks. The read indexes are dropped for
+    the DML and rebuilt after if the batch is large next to the facts already
+    loaded. The transaction is left open on the yielded connection, for the caller
+    to record the rows in the manifest and commit
+    """
+
+    rejected = []
+    if MAX_REJECTED_FRACTION:
+        chunks = iter_valid_rows(chunks, rejected)
+    if INCREMENTAL_INGEST:
+        chunks = iter_new_rows(engine, chunks)
+
+    with contextlib.ExitStack() as stack:
+        with metrics.stage("load_staging"):
+            conn = stack.enter_context(init_engine_and_load_staging(engine, chunks))
+            key_caches = build_key_caches(conn) if FACT_KEY_CACHE else None
+
+        with metrics.stage("drop_loaded_orders"):
+            drop_loaded_orders(conn)
+
+        with metrics.stage("drop_read_indexes"):
+            staged_rows = conn.execute(text("SELECT COUNT(*) FROM staging;")).scalar()
+            deferred = defer_read_indexes(conn, staged_rows, READ_INDEX_DEFER_RATIO)
+
+        with metrics.stage("dim_delivery_details"):
+            insert_into_dim_delivery_details(conn)
+        with metrics.stage("dim_product_details"):
+            insert_into_dim_product_details(conn)
+        with metrics.stage("dim_payment_details"):
+            insert_into_dim_payment_details(conn)
+        with metrics.stage("dim_date"):
+            insert_into_dim_date(conn)
+
+        with metrics.stage("fact_orders"):
+            if key_caches:
+                insert_into_fact_orders_cached(conn, key_caches)
+            else:
+                insert_into_fact_orders(conn)
+
+        with metrics.stage("rejected_orders"):
+            insert_into_rejected_orders(conn, rejected, fingerprint, input_file)
+
+        if deferred:
+            with metrics.stage("rebuild_read_indexes"):
+                rebuild_read_indexes(conn)
+
+        yield conn
+
+
+def _create_tables(engine: Engine, publish: bool = True):
+    """
+    Creates the DDL, and republishes the ingest generation in case an earlier run
+    stopped between committing and publishing it. Indexes the OrderNumbers of fact
+    partitions made before partitioned_orders existed
+    """
+
+    with engine.begin() as conn:
         create_orders_tables(conn)
+        if publish:
+            publish_generation(engine.url.database, read_generation(conn))
+    backfill_partitioned_orders(engine)
+
+
+def _publish(engine: Engine, generation: int):
+    """
+    Moves the new facts into their monthly partitions if FACT_PARTITIONS is set,
+    then publishes the generation so that the query caches (see queries.py) drop
+    their results. Publishing last means no cache keeps a result read while the
+    facts were being moved
+    """
+
+    if FACT_PARTITIONS:
+        with metrics.stage("route_partitions"):
+            metrics.add_rows(route_facts_to_partitions(engine))
 
-        insert_into_dim_delivery_details(conn)
-        insert_into_dim_product_details(conn)
-        insert_into_dim_payment_details(conn)
+    publish_generation(engine.url.database, generation)
 
-        insert_into_fact_orders(conn)
 
+def _commit_ingest(
+    conn: Connection,
+    input_file: str,
+    fingerprint: str,
+    new_rows: Optional[int] = None,
+    publish: bool = True,
+):
+    """
+    Records the file in the ingest manifest and bumps the ingest generation, in the
+    transaction of the load, commits and publishes it (see _publish), then refreshes
+    the planner statistics. A shadow build leaves publishing until its copy is the
+    orders DB
+    """
+
+    with metrics.stage("commit"):
+        record_ingest(conn, fingerprint, input_file, new_rows)
+        generation = bump_generation(conn)
+        conn.commit()
+    if publish:
+        _publish(conn.engine, generation)
+
+    with metrics.stage("optimize"):
+        optimize_database(conn)
         conn.commit()
 
 
+def _publish_shadow_build(db_path: str):
+    """
+    Publishes the generation of a shadow build swapped in over the orders DB (see
+    _publish). Its connection leaves the DB in the rollback journal mode the shadow
+    build published it in
+    """
+
+    engine = create_sqlite_engine(db_path, "default")
+    try:
+        with engine.connect() as conn:
+            generation = read_generation(conn)
+        _publish(engine, generation)
+    finally:
+        engine.dispose()
+
+
+def _write_parsed_file(
+    engine: Engine, input_file: str, fingerprint: str, publish: bool = True
+):
+    """
+    Loads the already parsed and validated file and records it in the ingest
+    manifest, in one transaction, or in chunks if INGEST_COMMIT_ROWS is set
+    """
+
+    if INGEST_COMMIT_ROWS:
+        _write_parsed_file_in_chunks(engine, input_file, fingerprint, publish)
+        return
+
+    with _staged_and_transformed(
+        engine, iter_cached_input_chunks(input_file), input_file, fingerprint
+    ) as conn:
+        _commit_ingest(conn, input_file, fingerprint, publish=publish)
+
+
+def _write_parsed_file_in_chunks(
+    engine: Engine, input_file: str, fingerprint: str, publish: bool = True
+):
+    """
+    Loads the file INGEST_COMMIT_ROWS input rows at a time, committing each range
+    together with a checkpoint of the input rows done so far. The write lock is only
+    held for one range, and a rerun after a crash resumes after the last checkpoint.
+    As a range's dims, facts, manifest rows and checkpoint commit (or roll back)
+    together, no range is loaded twice or half loaded
+    """
+
+    with engine.connect() as conn:
+        input_rows, new_rows = read_checkpoint(conn, fingerprint)
+    if input_rows:
+        logging.info(f"Resuming {input_file} after its first {input_rows} rows")
+
+    for rows in iter_row_ranges(
+        iter_cached_input_chunks(input_file), INGEST_COMMIT_ROWS, start=input_rows
+    ):
+        with _staged_and_transformed(engine, [rows], input_file, fingerprint) as conn:
+            with metrics.stage("commit"):
+                new_rows += record_ingest_rows(conn, fingerprint)
+                input_rows += len(rows)
+                write_checkpoint(conn, fingerprint, input_rows, new_rows)
+                conn.commit()
+
+    with engine.connect() as conn:
+        clear_checkpoint(conn, fingerprint)
+        _commit_ingest(conn, input_file, fingerprint, new_rows, publish)
+
+
+def run_data_ingest(
+    input_file: str = "input_data.xlsx", db_path: str = "/app/databases/orders.db"
+):
+    """
+    Runs orders data ingestion in these steps:
+        1. Creates a db if doesn't exist (if it isn't past in via a docker volume mount)
+        2. Creates DDL for on-disk orders db
+        3. Skips the file if the ingest manifest shows it was already loaded
+        4. Runs data quality checks on the parsed data. The input is parsed once here,
+           the ingest step (and later runs on the same file) read the cached copy.
+           Up to MAX_REJECTED_FRACTION of the rows may fail them, and are then
+           quarantined in rejected_orders rather than failing the whole file
+        5. Inserts the rows that are new since earlier runs into that db, then
+           refreshes the planner statistics
+
+    With SHADOW_PUBLISH set, steps 2 to 5 run on a shadow copy of the db, which is
+    then renamed over it (see shadow.py). Step 3 is checked against the live db
+    first, so a file that was already ingested doesn't cost a copy of it.
+
+    The wall time, rows affected, peak memory and query plans of every stage are
+    emitted as a JSON line at the end of the run (see metrics.py)
+    """
+
+    _check_shadow_publish()
+    _create_db(db_path)
+
+    metrics.start_run(input_file=input_file, db_path=db_path)
+    status = "failed"
+    try:
+        if SHADOW_PUBLISH and _ingested_files(db_path, [input_file]):
+            logging.info(f"{input_file} was already ingested, skipping it")
+            status = "skipped"
+        elif SHADOW_PUBLISH:
+            with shadow_build(db_path) as shadow_path:
+                status = _ingest_file(input_file, shadow_path, publish=False)
+            if status == "succeeded":
+                _publish_shadow_build(db_path)
+        else:
+            status = _ingest_file(input_file, db_path)
+    finally:
+        metrics.finish_run(status)
+
+
+def _check_shadow_publish():
+    """
+    Rejects SHADOW_PUBLISH with INGEST_COMMIT_ROWS, as the checkpoints of a chunked
+    ingest would be committed to the shadow copy, which a crash throws away, so a
+    rerun could never resume from them. And with FACT_PARTITIONS, as the facts
+    would be routed either after the swap, in place on the live file, or before it,
+    into the partition files the live file shares and its readers already see
+    """
+
+    if SHADOW_PUBLISH and INGEST_COMMIT_ROWS:
+        raise ValueError(
+            "SHADOW_PUBLISH can't be combined with INGEST_COMMIT_ROWS, as the "
+            "checkpoints would only be written to the shadow copy of the DB"
+        )
+    if SHADOW_PUBLISH and FACT_PARTITIONS:
+        raise ValueError(
+            "SHADOW_PUBLISH can't be combined with FACT_PARTITIONS, as the facts "
+            "would be routed into partitions the live DB shares, outside the shadow copy"
+        )
+
+
+def _ingested_files(db_path: str, files: Iterable[str]) -> Set[str]:
+    """
+    The files the manifest of the live DB shows were already ingested, looked up
+    before a shadow build seeds its copy of it. Empty unless INCREMENTAL_INGEST is set
+    """
+
+    if not INCREMENTAL_INGEST:
+        return set()
+
+    engine = create_sqlite_engine(db_path, SQLITE_READ_PROFILE)
+    try:
+        with engine.connect() as conn:
+            has_manifest = conn.execute(
+                text(
+                    "SELECT 1 FROM sqlite_master "
+                    "WHERE type = 'table' AND name = 'ingest_manifest_files';"
+                )
+            ).first()
+            if not has_manifest:
+                return set()
+            return {
+                file for file in files if is_file_ingested(conn, file_fingerprint(file))
+            }
+    finally:
+        engine.dispose()
+
+
+def _ingest_file(input_file: str, db_path: str, publish: bool = True) -> str:
+    """Steps 2 to 5 of run_data_ingest, returning whether the file succeeded or was skipped"""
+
+    engine = create_sqlite_engine(db_path, SQLITE_PROFILE)
+    try:
+        with metrics.stage("ddl"):
+            _create_tables(engine, publish)
+
+        fingerprint = file_fingerprint(input_file)
+        if INCREMENTAL_INGEST:
+            with engine.connect() as conn:
+                if is_file_ingested(conn, fingerprint):
+                    logging.info(f"{input_file} was already ingested, skipping it")
+                    return "skipped"
+
+        with metrics.stage("data_quality"):
+            data_quality_check(
+                run_vectorized_data_quality_checks(
+                    metrics.timed_iter("parse", iter_cached_input_chunks(input_file))
+                ),
+                MAX_REJECTED_FRACTION,
+            )
+
+        _write_parsed_file(engine, input_file, fingerprint, publish)
+        prune_parse_cache()
+        return "succeeded"
+    finally:
+        engine.dispose()
+
+
+def expand_inputs(inputs: Iterable[str]) -> List[str]:
+    """
+    Expands directories (to the input files in them, of any format there is an input
+    adapter for) and glob patterns into a sorted list of input files. Files are
+    written in this order
+    """
+
+    files = set()
+    for pattern in inputs:
+        patterns = (
+            [os.path.join(pattern, f"*{extension}") for extension in INPUT_ADAPTERS]
+            if os.path.isdir(pattern)
+            else [pattern]
+        )
+        for pattern in patterns:
+            files.update(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+    return sorted(files)
+
+
+def parse_and_validate(input_file: str, db_path: str) -> dict:
+    """
+    Runs in a parser process. Fingerprints the file and, unless it was already
+    ingested, parses it into the parse cache and runs the data quality checks on it.
+    Never raises, so one bad file can't take down the batch
+    """
+
+    try:
+        fingerprint = file_fingerprint(input_file)
+        if INCREMENTAL_INGEST:
+            engine = create_sqlite_engine(db_path, SQLITE_READ_PROFILE)
+            try:
+                with engine.connect() as conn:
+                    if is_file_ingested(conn, fingerprint):
+                        return {"file": input_file, "status": "skipped"}
+            finally:
+                engine.dispose()
+
+        data_quality_check(
+            run_vectorized_data_quality_checks(iter_cached_input_chunks(input_file)),
+            MAX_REJECTED_FRACTION,
+        )
+        return {"file": input_file, "status": "parsed", "fingerprint": fingerprint}
+    except Exception as e:
+        logging.exception(f"Failed to parse and validate {input_file}")
+        return {"file": input_file, "status": "failed", "error": repr(e)}
+
+
+def open_db(db_path: str, publish: bool = True) -> Engine:
+    """
+    Creates the DB if it doesn't exist and its DDL, and returns the engine the
+    parsed files are written through
+    """
+
+    _create_db(db_path)
+    engine = create_sqlite_engine(db_path, SQLITE_PROFILE)
+    _create_tables(engine, publish)
+    return engine
+
+
+def load_parsed_file(engine: Engine, result: dict, publish: bool = True) -> dict:
+    """
+    Writes a file that parse_and_validate parsed, unless a file with the same
+    contents was ingested since, and updates its result with the outcome. Never
+    raises, so one bad file can't take down the others. publish=False leaves
+    publishing the ingest to a shadow build
+    """
+
+    if result["status"] != "parsed":
+        return result
+
+    try:
+        with engine.connect() as conn:
+            # The same contents may be in another file of the batch
+            ingested = INCREMENTAL_INGEST and is_file_ingested(conn, result["fingerprint"])
+        if ingested:
+            result["status"] = "skipped"
+        else:
+            _write_parsed_file(engine, result["file"], result["fingerprint"], publish)
+            result["status"] = "succeeded"
+    except Exception as e:
+        logging.exception(f"Failed to load {result['file']}")
+        result.update(status="failed", error=repr(e))
+
+    return result
+
+
+def run_parallel_ingest(
+    inputs: Iterable[str],
+    db_path: str = "/app/databases/orders.db",
+    workers: int = INGEST_WORKERS,
+) -> List[dict]:
+    """
+    Ingests many input files, e.g. one workbook per store. The files are parsed and
+    validated in parallel in a pool of parser processes, while this process is the
+    only writer: it loads staging and runs the DML for each parsed file in turn, in
+    file name order, as SQLite only allows one writer at a time.
+
+    A file that fails to parse, validate or load is rolled back and reported,
+    without stopping the other files. Returns the outcome of every file, and emits
+    a metrics line for each of them. With SHADOW_PUBLISH set, the whole batch is
+    written to one shadow copy of the DB, published once the last file is done, and
+    no copy is made at all if the live DB already has every file
+    """
+
+    _check_shadow_publish()
+    files = expand_inputs(inputs)
+    _create_db(db_path)
+
+    if SHADOW_PUBLISH:
+        # Files the live DB already has are skipped without seeding a shadow copy
+        ingested = _ingested_files(db_path, files)
+        pending = [file for file in files if file not in ingested]
+        loaded = {}
+        if pending:
+            with shadow_build(db_path) as shadow_path:
+                for result in _ingest_files(
+                    pending, shadow_path, db_path, workers, publish=False
+                ):
+                    loaded[result["file"]] = result
+            if any(result["status"] == "succeeded" for result in loaded.values()):
+                _publish_shadow_build(db_path)
+
+        results = []
+        for file in files:
+            if file in ingested:
+                metrics.start_run(input_file=file, db_path=db_path)
+                metrics.finish_run("skipped")
+                loaded[file] = {"file": file, "status": "skipped"}
+            results.append(loaded[file])
+    else:
+        results = _ingest_files(files, db_path, db_path, workers)
+
+    failed = [result for result in results if result["status"] == "failed"]
+    logging.info(
+        f"Ingested {sum(result['status'] == 'succeeded' for result in results)} of "
+        f"{len(results)} files, skipped "
+        f"{sum(result['status'] == 'skipped' for result in results)}, "
+        f"{len(failed)} failed"
+    )
+    for result in failed:
+        logging.error(f"{result['file']}: {result['error']}")
+
+    return results
+
+
+def _parse_result(file: str, future: Future) -> dict:
+    """
+    The result of a parse_and_validate future, or a failed result if its parser
+    process died (e.g. killed for running out of memory, which also breaks the pool
+    for the files after it) or its error couldn't be sent back
+    """
+
+    try:
+        return future.result()
+    except Exception as e:
+        logging.exception(f"Failed to parse and validate {file}")
+        return {"file": file, "status": "failed", "error": repr(e)}
+
+
+def _ingest_files(
+    files: List[str], build_path: str, db_path: str, workers: int, publish: bool = True
+) -> List[dict]:
+    """The batch of run_parallel_ingest, written to build_path (the DB or its shadow copy)"""
+
+    engine = open_db(build_path, publish)  # Before the parsers look at the manifest
+
+    results = []
+    try:
+        # Parser processes are spawned, so they don't inherit this process's connections
+        with ProcessPoolExecutor(
+            max_workers=max(1, min(workers, len(files))),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            futures = [pool.submit(parse_and_validate, file, build_path) for file in files]
+            for file, future in zip(files, futures):
+                metrics.start_run(input_file=file, db_path=db_path)
+                with metrics.stage("wait_for_parse"):
+                    result = _parse_result(file, future)
+
+                load_parsed_file(engine, result, publish)
+                metrics.finish_run(result["status"])
+                results.append(result)
+    finally:
+        engine.dispose()
+
+    prune_parse_cache()  # Not before, as it could drop files the batch still needs
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingests orders workbooks")
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        help="Input files, directories or glob patterns (default input_data.xlsx)",
+    )
+    parser.add_argument("--db-path", default="/app/databases/orders.db")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS)
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print what ingesting the inputs would change in the DB, without writing to it",
+    )
+    parser.add_argument(
+        "--plan-diff", help="With --plan, also write the changes row by row to this CSV file"
+    )
+    args = parser.parse_args()
+
+    if args.plan:
+        run_ingest_plan(expand_inputs(args.inputs or ["input_data.xlsx"]), args.db_path, args.plan_diff)
+        return
+
+    if not args.inputs:
+        run_data_ingest(db_path=args.db_path)
+        return
+
+    results = run_parallel_ingest(args.inputs, args.db_path, args.workers)
+    if any(result["status"] == "failed" for result in results):
+        sys.exit(1)
+
+
 if __name__ == "__main__":
-    run_data_ingest()
+    main()
@@ -0,0 +1,212 @@
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, Optional, Tuple
+import logging
+import os
+
+from sqlalchemy import Engine, bindparam, text
+from sqlalchemy.engine.base import Connection
+import numpy as np
+import pandas as pd
+
+
+def row_hashes(chunk: pd.DataFrame) -> np.ndarray:
+    """
+    64-bit content hashes of the rows of a chunk. Numbers are hashed as floats,
+    dates as ISO strings and columns in name order, so the hash doesn't depend on
+    how a chunk was typed
+    """
+
+    columns = sorted(col for col in chunk.columns if col != "RowHash")
+    canonical = chunk[columns].copy()
+    for col in columns:
+        if pd.api.types.is_datetime64_dtype(canonical[col]):
+            canonical[col] = canonical[col].dt.strftime("%Y-%m-%d")
+        elif pd.api.types.is_numeric_dtype(canonical[col]):
+            canonical[col] = canonical[col].astype("float64")
+
+    return pd.util.hash_pandas_object(canonical, index=False).to_numpy().view(np.int64)
+
+
+def is_file_ingested(conn: Connection, fingerprint: str) -> bool:
+    return (
+        conn.execute(
+            text(
+                "SELECT 1 FROM ingest_manifest_files WHERE FileFingerprint = :fingerprint;"
+            ),
+            {"fingerprint": fingerprint},
+        ).scalar()
+        is not None
+    )
+
+
+def iter_new_rows(
+    engine: Engine, chunks: Iterable[pd.DataFrame], batch_size: int = 500
+) -> Iterator[pd.DataFrame]:
+    """
+    Adds a RowHash column to every chunk and drops the rows whose hash is already in
+    the manifest, i.e. rows loaded by an earlier run. Probes the manifest's primary
+    key in batches, on a connection of its own
+    """
+
+    statement = text(
+        "SELECT RowHash FROM ingest_manifest_rows WHERE RowHash IN :hashes;"
+    ).bindparams(bindparam("hashes", expanding=True))
+
+    seen = new = 0
+    with engine.connect() as conn:
+        for chunk in chunks:
+            chunk = chunk.assign(RowHash=row_hashes(chunk))
+            hashes = chunk["RowHash"].tolist()
+            known = set()
+            for i in range(0, len(hashes), batch_size):
+                known.update(
+                    conn.execute(
+                        statement, {"hashes": hashes[i : i + batch_size]}
+                    ).scalars()
+                )
+
+            chunk = chunk[~chunk["RowHash"].isin(known)]
+            seen += len(hashes)
+            new += len(chunk)
+            if len(chunk):
+                yield chunk
+
+    logging.info(f"{new} of {seen} input rows are new or modified since earlier runs")
+
+
+def record_ingest_rows(conn: Connection, fingerprint: str) -> int:
+    """Adds the staged rows to the manifest, returning how many weren't in it yet"""
+
+    return conn.execute(
+        text(
+            """
+            INSERT OR IGNORE INTO ingest_manifest_rows (RowHash, FileFingerprint)
+            SELECT RowHash, :fingerprint FROM staging WHERE RowHash IS NOT NULL;
+            """
+        ),
+        {"fingerprint": fingerprint},
+    ).rowcount
+
+
+def record_ingest(
+    conn: Connection, fingerprint: str, file_name: str, new_rows: Optional[int] = None
+):
+    """
+    Adds the file and the staged rows to the manifest. Run it in the same transaction
+    as the DML, so the manifest never claims rows that weren't loaded. A chunked
+    ingest records the rows of each chunk as it goes, and passes their total here
+    """
+
+    if new_rows is None:
+        new_rows = record_ingest_rows(conn, fingerprint)
+
+    conn.execute(
+        text(
+            """
+            INSERT OR REPLACE INTO ingest_manifest_files (FileFingerprint, FileName, NewRows, LoadedAt)
+            VALUES (:fingerprint, :file_name, :new_rows, :loaded_at);
+            """
+        ),
+        {
+            "fingerprint": fingerprint,
+            "file_name": file_name,
+            "new_rows": new_rows,
+            "loaded_at": datetime.now(timezone.utc).isoformat(),
+        },
+    )
+
+
+def read_checkpoint(conn: Connection, fingerprint: str) -> Tuple[int, int]:
+    """
+    Returns the input rows of the file that a chunked ingest has committed so far,
+    and how many of them were new, or (0, 0) if it hasn't started
+    """
+
+    row = conn.execute(
+        text(
+            "SELECT InputRows, NewRows FROM ingest_checkpoints WHERE FileFingerprint = :fingerprint;"
+        ),
+        {"fingerprint": fingerprint},
+    ).first()
+
+    return tuple(row) if row else (0, 0)
+
+
+def write_checkpoint(conn: Connection, fingerprint: str, input_rows: int, new_rows: int):
+    """Records a chunked ingest's progress. Run it in the transaction of the chunk"""
+
+    conn.execute(
+        text(
+            """
+            INSERT OR REPLACE INTO ingest_checkpoints (FileFingerprint, InputRows, NewRows, UpdatedAt)
+            VALUES (:fingerprint, :input_rows, :new_rows, :updated_at);
+            """
+        ),
+        {
+            "fingerprint": fingerprint,
+            "input_rows": input_rows,
+            "new_rows": new_rows,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        },
+    )
+
+
+def clear_checkpoint(conn: Connection, fingerprint: str):
+    conn.execute(
+        text("DELETE FROM ingest_checkpoints WHERE FileFingerprint = :fingerprint;"),
+        {"fingerprint": fingerprint},
+    )
+
+
+def bump_generation(conn: Connection) -> int:
+    """
+    Counts one more ingest that changed the DB, returning the new generation. Run it
+    in the transaction of the ingest, then publish_generation once committed
+    """
+
+    return conn.execute(
+        text(
+            """
+            INSERT INTO ingest_generation (Id, Generation, UpdatedAt)
+            VALUES (1, 1, :updated_at)
+            ON CONFLICT (Id) DO UPDATE SET
+                Generation = Generation + 1,
+                UpdatedAt = excluded.UpdatedAt
+            RETURNING Generation;
+            """
+        ),
+        {"updated_at": datetime.now(timezone.utc).isoformat()},
+    ).scalar()
+
+
+def read_generation(conn: Connection) -> int:
+    return conn.execute(
+        text("SELECT COALESCE(MAX(Generation), 0) FROM ingest_generation;")
+    ).scalar()
+
+
+def generation_path(db_path: str) -> str:
+    """The file next to the DB that the committed generation is published to"""
+
+    return f"{db_path}.generation"
+
+
+def publish_generation(db_path: str, generation: int):
+    """
+    Writes the generation to the file next to the DB, for readers to notice a new
+    ingest with a stat instead of a query. Replaced atomically, so it's never torn,
+    and left alone if it's already up to date
+    """
+
+    path = generation_path(db_path)
+    try:
+        with open(path) as f:
+            if f.read() == str(generation):
+                return
+    except OSError:
+        pass
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        f.write(str(generation))
+    os.replace(tmp_path, path)
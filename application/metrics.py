@@ -0,0 +1,225 @@
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, List, Optional, Union
+import contextlib
+import json
+import logging
+import os
+import resource
+import sys
+import time
+import uuid
+
+from sqlalchemy import text
+
+from config import LOG_QUERY_PLANS, METRICS_OUTPUT
+
+# The run being recorded, if any. The ingest job runs one ingest at a time per process
+_run: Optional[dict] = None
+_stage: Optional[dict] = None
+_open_stages: List[dict] = []
+
+# Whether the kernel lets the process reset its resident memory high-water mark
+# (VmHWM), so each stage can read its own peak. Where it can't, stages fall back to
+# the highest resident memory seen at their boundaries
+_resets_peak = True
+
+
+def _peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def _rss_mb() -> float:
+    """The process's current resident memory, or its peak where /proc doesn't have it"""
+
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return _peak_rss_mb()
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def _peak_since_reset_mb() -> float:
+    """The process's peak resident memory since the high-water mark was last reset"""
+
+    global _resets_peak
+    if _resets_peak:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024  # kB
+        except OSError:
+            pass
+        _resets_peak = False
+    return _rss_mb()
+
+
+def _reset_peak():
+    global _resets_peak
+    if _resets_peak:
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")  # Resets VmHWM to the current resident memory
+        except OSError:
+            _resets_peak = False
+
+
+def _note_peak(*records: dict):
+    """
+    Folds the peak resident memory since the last reset into the run, the open
+    stages and the given records, then resets it for what runs next
+    """
+
+    peak = _peak_since_reset_mb()
+    for record in [*_open_stages, *records]:
+        record["peak_rss_mb"] = round(max(record["peak_rss_mb"], peak), 1)
+    if _run is not None:
+        _run["_peak_rss_mb"] = max(_run["_peak_rss_mb"], peak)
+    _reset_peak()
+
+
+def start_run(**labels):
+    """Starts recording a run. The labels (e.g. the input file) are emitted with it"""
+
+    global _run
+    _run = {
+        "run_id": uuid.uuid4().hex,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        **labels,
+        "stages": [],
+        "_start": time.perf_counter(),
+        "_peak_rss_mb": 0.0,
+    }
+    _reset_peak()
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Records the wall time, rows affected and peak resident memory of a stage of the
+    current run. A stage entered more than once (e.g. once per commit chunk) adds up
+    into one record, with the highest of its peaks. The peak comes from resetting
+    the kernel's high-water mark as the stage starts and reading it as it ends,
+    which costs a few small /proc reads and writes, so it's always on
+    """
+
+    global _stage
+    if _run is None:
+        yield
+        return
+
+    record = next((record for record in _run["stages"] if record["stage"] == name), None)
+    if record is None:
+        record = {"stage": name, "seconds": 0.0, "rows": 0, "peak_rss_mb": 0.0, "query_plans": {}}
+        _run["stages"].append(record)
+    _note_peak()  # The enclosing stages' peak so far
+    outer, _stage = _stage, record
+    _open_stages.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(record["seconds"] + time.perf_counter() - start, 6)
+        _note_peak()
+        _open_stages.pop()
+        _stage = outer
+
+
+def timed_iter(name: str, iterable: Iterable) -> Iterator:
+    """
+    Passes the items through, recording the time spent producing them, and the peak
+    memory while doing so, as a stage. Used for the input parse, which is
+    interleaved with the stage consuming it
+    """
+
+    if _run is None:
+        yield from iterable
+        return
+
+    record = {"stage": name, "seconds": 0.0, "rows": 0, "peak_rss_mb": 0.0, "query_plans": {}}
+    _run["stages"].append(record)
+    iterator = iter(iterable)
+    while True:
+        _note_peak()  # The consuming stage's peak so far
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            record["seconds"] = round(record["seconds"] + time.perf_counter() - start, 6)
+            _note_peak(record)
+        record["rows"] += len(item) if hasattr(item, "__len__") else 1
+        yield item
+
+
+def add_rows(rows: int):
+    """Adds to the rows affected by the current stage"""
+
+    if _stage is not None and rows > 0:
+        _stage["rows"] += rows
+
+
+def add_query_plan(step: str, plan: list):
+    """Keeps a statement's EXPLAIN QUERY PLAN output with the current stage"""
+
+    if _stage is not None:
+        _stage["query_plans"][step] = plan
+
+
+def execute_with_plan(conn, step: str, statement: str, params: Union[dict, list, None] = None):
+    """
+    Executes a DML statement, first capturing SQLite's query plan for it so the run
+    log and metrics show whether each lookup is an index seek (SEARCH) or a full
+    scan (SCAN). Planning without running is cheap, so the plan is always captured.
+    A list of parameter sets is run as an executemany, planned with the first set
+    """
+
+    sample = params[0] if isinstance(params, list) else params
+    plan = [
+        row.detail
+        for row in conn.execute(text(f"EXPLAIN QUERY PLAN {statement}"), sample or {})
+    ]
+    add_query_plan(step, plan)
+    if LOG_QUERY_PLANS:
+        details = "\n".join(f"    {detail}" for detail in plan)
+        logging.info(f"Query plan for {step}:\n{details}")
+
+    result = conn.execute(text(statement), params or {})
+    add_rows(result.rowcount)
+
+    return result
+
+
+def finish_run(
+    status: str = "succeeded", output: str = METRICS_OUTPUT, **labels
+) -> Optional[dict]:
+    """
+    Ends the current run and emits it as one JSON line, to stdout or appended to a
+    metrics file, for monitoring to scrape. Labels only known at the end (e.g. the
+    inbox service's latency) are emitted with it
+    """
+
+    global _run
+    if _run is None:
+        return None
+    _note_peak()
+    _open_stages.clear()
+    run, _run = _run, None
+
+    run.update(labels)
+    run["status"] = status
+    run["seconds"] = round(time.perf_counter() - run.pop("_start"), 6)
+    peak = run.pop("_peak_rss_mb")
+    # Without resets, the samples may have missed the peak the kernel kept
+    run["peak_rss_mb"] = round(peak if _resets_peak else max(peak, _peak_rss_mb()), 1)
+
+    line = json.dumps(run, default=str)
+    if output == "stdout":
+        print(line, file=sys.stdout, flush=True)
+    elif output:
+        with open(output, "a") as f:
+            f.write(line + "\n")
+
+    return run
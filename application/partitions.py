@@ -0,0 +1,395 @@
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, List, Optional
+import logging
+import os
+import re
+import sqlite3
+
+from sqlalchemy import Engine, text
+from sqlalchemy.engine.base import Connection
+
+from config import SQLITE_PROFILE, SQLITE_READ_PROFILE
+from ddl import READ_INDEXES
+from init_db_connection import create_sqlite_engine
+from manifest import bump_generation, publish_generation
+from shadow import live_path
+
+# Facts land in fact_orders with the rest of a load, and route_facts_to_partitions
+# then moves them into the partition of their payment month (YYYY-MM): a SQLite file
+# next to the orders DB, attached as facts_YYYY_MM. partitioned_orders in the orders
+# DB keeps the month of every routed OrderNumber, so they stay unique across months
+MONTH = re.compile(r"^\d{4}-\d{2}$")
+
+
+def partition_path(db_path: str, month: str) -> str:
+    """
+    The file of a payment month's (YYYY-MM) partition of the orders DB. A shadow
+    copy of the orders DB (see shadow.py) shares its partitions
+    """
+
+    root, extension = os.path.splitext(live_path(db_path))
+    return f"{root}.facts-{month}{extension}"
+
+
+def _schema(month: str) -> str:
+    if not MONTH.match(month):
+        raise ValueError(f"Not a YYYY-MM month: {month!r}")
+    return "facts_" + month.replace("-", "_")
+
+
+def _date_keys(month: str) -> dict:
+    """The range of fact_orders.DateKey (yyyymmdd) in the month"""
+
+    first = int(month.replace("-", "")) * 100
+    return {"first": first, "last": first + 99}
+
+
+def _fact_columns(conn: Connection) -> str:
+    return ", ".join(row.name for row in conn.execute(text("PRAGMA main.table_info(fact_orders);")))
+
+
+def _attached(conn: Connection) -> List[str]:
+    return [row.name for row in conn.execute(text("PRAGMA database_list;")) if row.name.startswith("facts_")]
+
+
+def _attach_slots(conn: Connection) -> int:
+    """How many more databases the connection can attach (SQLite's default limit is 10)"""
+
+    limit = conn.connection.dbapi_connection.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    attached = [
+        row.name for row in conn.execute(text("PRAGMA database_list;")) if row.name not in ("main", "temp")
+    ]
+    return limit - len(attached)
+
+
+def active_partitions(
+    conn: Connection, start_month: Optional[str] = None, end_month: Optional[str] = None
+) -> List[str]:
+    """The months with a partition that isn't archived, from start_month to end_month inclusive"""
+
+    return list(
+        conn.execute(
+            text(
+                """
+                SELECT PaymentMonth
+                FROM fact_partitions
+                WHERE ArchivedAt IS NULL AND PaymentMonth BETWEEN COALESCE(:start_month, '') AND COALESCE(:end_month, '9999-99')
+                ORDER BY PaymentMonth;
+                """
+            ),
+            {"start_month": start_month, "end_month": end_month},
+        ).scalars()
+    )
+
+
+def _create_partition(conn: Connection, db_path: str, month: str):
+    """
+    Creates the month's partition file, with fact_orders as the orders DB defines it
+    and its read indexes, on a connection of its own, and adds it to fact_partitions
+    """
+
+    path = partition_path(db_path, month)
+    table_sql = conn.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'fact_orders';")
+    ).scalar()
+
+    engine = create_sqlite_engine(path, SQLITE_PROFILE)
+    try:
+        with engine.begin() as partition:
+            partition.execute(text(table_sql.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1)))
+            for name, (table, columns) in READ_INDEXES.items():
+                if table == "fact_orders":
+                    partition.execute(
+                        text(f"CREATE INDEX IF NOT EXISTS {name} ON fact_orders ({', '.join(columns)});")
+                    )
+    finally:
+        engine.dispose()
+
+    conn.execute(
+        text("INSERT OR IGNORE INTO fact_partitions (PaymentMonth, FileName) VALUES (:month, :file_name);"),
+        {"month": month, "file_name": os.path.basename(path)},
+    )
+
+
+def _in_groups(months: List[str], size: int) -> Iterable[List[str]]:
+    if size < 1:
+        raise ValueError("No databases left to attach the fact partitions to")
+    for i in range(0, len(months), size):
+        yield months[i : i + size]
+
+
+def route_facts_to_partitions(engine: Engine) -> int:
+    """
+    Moves the facts in fact_orders into the partitions of their payment months,
+    creating those as needed, and returns how many were moved. Their OrderNumbers
+    go into partitioned_orders as they leave fact_orders. Every partition is
+    committed before the facts leave fact_orders, all in one commit, as transactions
+    across attached WAL databases are only atomic per database: a crash in between
+    leaves copies, which the next run's INSERT OR IGNORE skips. Facts of archived
+    months are left in fact_orders
+    """
+
+    db_path = engine.url.database
+    moved = 0
+    with engine.connect() as conn:
+        months = [
+            f"{key // 100:04d}-{key % 100:02d}"
+            for key in conn.execute(
+                text("SELECT DISTINCT DateKey / 100 FROM fact_orders WHERE DateKey IS NOT NULL ORDER BY 1;")
+            ).scalars()
+        ]
+        archived = set(months) & set(
+            conn.execute(
+                text("SELECT PaymentMonth FROM fact_partitions WHERE ArchivedAt IS NOT NULL;")
+            ).scalars()
+        )
+        if archived:
+            logging.warning(f"Keeping the facts of archived months {sorted(archived)} in fact_orders")
+        months = [month for month in months if month not in archived]
+
+        for month in months:
+            _create_partition(conn, db_path, month)
+        conn.commit()
+
+        columns = _fact_columns(conn)
+        facts = {}
+        for group in _in_groups(months, _attach_slots(conn)):
+            for month in group:
+                conn.execute(
+                    text(f"ATTACH DATABASE :path AS {_schema(month)};"),
+                    {"path": partition_path(db_path, month)},
+                )
+            for month in group:
+                conn.execute(
+                    text(
+                        f"""
+                        INSERT OR IGNORE INTO {_schema(month)}.fact_orders ({columns})
+                        SELECT {columns} FROM main.fact_orders WHERE DateKey BETWEEN :first AND :last;
+                        """
+                    ),
+                    _date_keys(month),
+                )
+            conn.commit()
+            for month in group:
+                facts[month] = conn.execute(
+                    text(f"SELECT COUNT(*) FROM {_schema(month)}.fact_orders;")
+                ).scalar()
+                conn.execute(text(f"DETACH DATABASE {_schema(month)};"))
+
+        # Every partition is committed, so the facts leave fact_orders in one commit
+        for month in months:
+            conn.execute(
+                text(
+                    """
+                    INSERT OR IGNORE INTO partitioned_orders (OrderNumber, PaymentMonth)
+                    SELECT OrderNumber, :month FROM main.fact_orders WHERE DateKey BETWEEN :first AND :last;
+                    """
+                ),
+                {"month": month, **_date_keys(month)},
+            )
+            moved += conn.execute(
+                text("DELETE FROM main.fact_orders WHERE DateKey BETWEEN :first AND :last;"),
+                _date_keys(month),
+            ).rowcount
+            conn.execute(
+                text("UPDATE fact_partitions SET Facts = :facts WHERE PaymentMonth = :month;"),
+                {"month": month, "facts": facts[month]},
+            )
+        conn.commit()
+
+    logging.info(f"Moved {moved} facts into the partitions of {len(months)} months")
+    return moved
+
+
+def backfill_partitioned_orders(engine: Engine):
+    """
+    Fills partitioned_orders from the partitions, archived ones included, if the
+    orders DB was partitioned before it had that table. Each partition is read on a
+    read-only connection of its own
+    """
+
+    db_path = engine.url.database
+    with engine.connect() as conn:
+        if conn.execute(
+            text(
+                """
+                SELECT EXISTS (SELECT 1 FROM partitioned_orders)
+                    OR NOT EXISTS (SELECT 1 FROM fact_partitions WHERE Facts > 0);
+                """
+            )
+        ).scalar():
+            return
+
+        partitions = conn.execute(
+            text("SELECT PaymentMonth, ArchivedTo FROM fact_partitions WHERE Facts > 0;")
+        ).fetchall()
+        for month, archived_to in partitions:
+            path = archived_to or partition_path(db_path, month)
+            if not os.path.exists(path):
+                logging.warning(f"Can't index the OrderNumbers of {month}, {path} is missing")
+                continue
+            partition_engine = create_sqlite_engine(path, SQLITE_READ_PROFILE)
+            try:
+                with partition_engine.connect() as partition:
+                    order_numbers = partition.execute(
+                        text("SELECT OrderNumber FROM fact_orders;")
+                    ).scalars().all()
+            finally:
+                partition_engine.dispose()
+            if not order_numbers:
+                continue
+            conn.execute(
+                text(
+                    """
+                    INSERT OR IGNORE INTO partitioned_orders (OrderNumber, PaymentMonth)
+                    VALUES (:OrderNumber, :PaymentMonth);
+                    """
+                ),
+                [{"OrderNumber": order, "PaymentMonth": month} for order in order_numbers],
+            )
+        conn.commit()
+
+    logging.info(f"Indexed the OrderNumbers of {len(partitions)} fact partitions")
+
+
+def _point_view_at(conn: Connection, db_path: str, months: List[str], unrouted: bool = True):
+    """
+    Attaches the partitions of the months, detaching the others, and points the TEMP
+    view named fact_orders at them and, if unrouted, at the facts not routed yet
+    """
+
+    attached = _attached(conn)
+    has_view = conn.execute(
+        text("SELECT 1 FROM sqlite_temp_master WHERE type = 'view' AND name = 'fact_orders';")
+    ).scalar()
+    if not months and not attached and not has_view:
+        return
+
+    wanted = {_schema(month): month for month in months}
+    for schema in set(attached) - set(wanted):
+        conn.execute(text(f"DETACH DATABASE {schema};"))
+    missing = [schema for schema in wanted if schema not in attached]
+    if len(missing) > _attach_slots(conn):
+        raise ValueError(
+            f"Reading the {len(months)} fact partitions from {months[0]} to {months[-1]} "
+            "needs more databases than SQLite can attach at once: read them with "
+            "iter_fact_partition_groups"
+        )
+    for schema in missing:
+        conn.execute(
+            text(f"ATTACH DATABASE :path AS {schema};"),
+            {"path": partition_path(db_path, wanted[schema])},
+        )
+
+    columns = _fact_columns(conn)
+    union = " UNION ALL ".join(
+        f"SELECT {columns} FROM {schema}.fact_orders"
+        for schema in (["main"] if unrouted else []) + list(wanted)
+    )
+    # The view only lives in this connection's memory, but query_only blocks it too
+    query_only = conn.execute(text("PRAGMA query_only;")).scalar()
+    conn.execute(text("PRAGMA query_only = OFF;"))
+    try:
+        conn.execute(text("DROP VIEW IF EXISTS temp.fact_orders;"))
+        conn.execute(text(f"CREATE TEMP VIEW fact_orders AS {union};"))
+    finally:
+        if query_only:
+            conn.execute(text("PRAGMA query_only = ON;"))
+
+
+def attach_fact_partitions(
+    conn: Connection,
+    db_path: str,
+    start_month: Optional[str] = None,
+    end_month: Optional[str] = None,
+) -> List[str]:
+    """
+    Attaches the partitions of the months from start_month to end_month (all of them
+    if not given) to the connection, and points a TEMP view named fact_orders at
+    them and the facts not routed yet, so queries over fact_orders on this
+    connection only read those months. Detaches the partitions of an earlier call
+    that aren't needed. Raises if there are more than SQLite can attach at once
+    (see iter_fact_partition_groups). Returns the months attached
+    """
+
+    months = active_partitions(conn, start_month, end_month)
+    _point_view_at(conn, db_path, months)
+    return months
+
+
+def iter_fact_partition_groups(
+    conn: Connection,
+    db_path: str,
+    start_month: Optional[str] = None,
+    end_month: Optional[str] = None,
+) -> Iterator[List[str]]:
+    """
+    attach_fact_partitions for any number of months: attaches their partitions as
+    many at a time as SQLite allows, points the fact_orders view at each group in
+    turn (the facts not routed yet are in the first) and yields the group's months.
+    A query run for every group reads each fact once, and its results need merging
+    """
+
+    months = active_partitions(conn, start_month, end_month)
+    slots = _attach_slots(conn) + len(_attached(conn))  # The attached partitions can go
+    for i, group in enumerate(list(_in_groups(months, slots)) or [[]]):
+        _point_view_at(conn, db_path, group, unrouted=i == 0)
+        yield group
+
+
+def archive_partitions(db_path: str, before_month: str, archive_dir: str) -> List[str]:
+    """
+    Moves the partitions of the payment months before before_month into archive_dir,
+    as self-contained files, and drops them from the fact_orders view. Only their
+    rows in fact_partitions change in the orders DB, and the rollups keep their
+    totals. Publishes a new ingest generation, so query caches drop their results.
+    Returns the months archived
+    """
+
+    os.makedirs(archive_dir, exist_ok=True)
+    engine = create_sqlite_engine(db_path, SQLITE_PROFILE)
+    archived = []
+    try:
+        with engine.connect() as conn:
+            months = active_partitions(conn, end_month=before_month)
+            for month in [month for month in months if month < before_month]:
+                path = partition_path(db_path, month)
+                target = os.path.join(archive_dir, os.path.basename(path))
+
+                # A consistent copy, WAL included, even while queries have it attached
+                source, archive = sqlite3.connect(path), sqlite3.connect(target)
+                try:
+                    source.backup(archive)
+                finally:
+                    source.close()
+                    archive.close()
+
+                conn.execute(
+                    text(
+                        """
+                        UPDATE fact_partitions
+                        SET ArchivedTo = :target, ArchivedAt = :archived_at
+                        WHERE PaymentMonth = :month;
+                        """
+                    ),
+                    {
+                        "month": month,
+                        "target": target,
+                        "archived_at": datetime.now(timezone.utc).isoformat(),
+                    },
+                )
+                conn.commit()
+                for file in [path, f"{path}-wal", f"{path}-shm"]:  # Once nothing points at it
+                    if os.path.exists(file):
+                        os.remove(file)
+                archived.append(month)
+
+            if archived:
+                generation = bump_generation(conn)
+                conn.commit()
+                publish_generation(db_path, generation)
+    finally:
+        engine.dispose()
+
+    logging.info(f"Archived the fact partitions of {archived} to {archive_dir}")
+    return archived
@@ -0,0 +1,355 @@
+from typing import Dict, Generator, Iterable, List, Optional, Set
+import contextlib
+import logging
+import os
+import sqlite3
+
+from sqlalchemy import Engine, bindparam, create_engine, text
+from sqlalchemy.engine.base import Connection
+import pandas as pd
+
+from config import INCREMENTAL_INGEST, MAX_REJECTED_FRACTION, SQLITE_READ_PROFILE
+from data_quality_checks import (
+    data_quality_check,
+    iter_valid_rows,
+    loaded_order_numbers,
+    run_vectorized_data_quality_checks,
+)
+from ddl import create_orders_tables, normalize_key
+from ingest_orders_dml import delivery_details_changes
+from init_db_connection import (
+    concat_chunks,
+    create_sqlite_engine,
+    file_fingerprint,
+    iter_cached_input_chunks,
+)
+from manifest import is_file_ingested, iter_new_rows
+
+# An ingest plan works out what ingesting a file would change in the orders DB, from
+# the parsed file and batched probes of the DB's natural key indexes on a read-only
+# connection, without staging the file or running the DML. The columns of its
+# row-level diff
+DIFF_COLUMNS = ["File", "Table", "Change", "Key", "Before", "After"]
+
+DELIVERY_COLUMNS = [
+    "ClientName",
+    "DeliveryAddress",
+    "DeliveryPostcode",
+    "DeliveryCity",
+    "DeliveryCountry",
+    "DeliveryContactNumber",
+]
+# The staging columns the fact insert joins the dims on, so rows missing any of them
+# never become facts
+FACT_JOIN_COLUMNS = [
+    "ClientName",
+    "DeliveryAddress",
+    "DeliveryPostcode",
+    "ProductName",
+    "PaymentBillingCode",
+]
+
+
+def _schema(conn: Connection) -> Dict[str, Set[str]]:
+    """The columns of each table of a DB"""
+
+    tables = conn.execute(
+        text("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%';")
+    ).scalars()
+    return {
+        table: {row.name for row in conn.execute(text(f"PRAGMA table_info('{table}');"))}
+        for table in list(tables)
+    }
+
+
+def _memory_engine(source: Optional[sqlite3.Connection] = None) -> Engine:
+    """
+    An in-memory DB with the current orders schema, copied from source through
+    SQLite's backup API first if given, so create_orders_tables migrates the copy
+    """
+
+    engine = create_engine("sqlite://")  # One connection per thread, kept open
+    if source is not None:
+        copy = engine.raw_connection()
+        try:
+            source.backup(copy.driver_connection)
+        finally:
+            copy.close()
+    with engine.begin() as conn:
+        create_orders_tables(conn)
+
+    return engine
+
+
+@contextlib.contextmanager
+def _read_only(db_path: str) -> Generator[Engine, None, None]:
+    """
+    A read-only engine on the orders DB. If it has no orders tables yet, the engine
+    is on an empty in-memory copy of the schema. If it was made before some of the
+    tables or columns an ingest would add (e.g. the manifest), it is on an in-memory
+    copy of the DB migrated the way an ingest would migrate it. Either way a plan
+    never creates or writes the file
+    """
+
+    if not os.path.exists(db_path):
+        engine = _memory_engine()
+    else:
+        engine = create_sqlite_engine(db_path, SQLITE_READ_PROFILE)
+        with engine.connect() as conn:
+            live = _schema(conn)
+        if "fact_orders" not in live:
+            engine.dispose()
+            engine = _memory_engine()
+        else:
+            current = _memory_engine()
+            with current.connect() as conn:
+                expected = _schema(conn)
+            current.dispose()
+            if any(not columns <= live.get(table, set()) for table, columns in expected.items()):
+                engine.dispose()
+                source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+                try:
+                    engine = _memory_engine(source)
+                finally:
+                    source.close()
+
+    try:
+        yield engine
+    finally:
+        engine.dispose()
+
+
+def _values(series: pd.Series) -> pd.Series:
+    return series.astype(object).where(series.notna(), None)
+
+
+def _per_value(series: pd.Series, convert) -> pd.Series:
+    """The column converted with convert, called once per distinct value, None for missing values"""
+
+    codes, uniques = pd.factorize(series)
+    converted = [convert(value) for value in uniques] + [None]  # Missing values have code -1
+    return pd.Series(pd.Series(converted, dtype=object).to_numpy()[codes], index=series.index)
+
+
+def _keys(series: pd.Series) -> pd.Series:
+    """The natural keys of the column, as the DML's TRIM(LOWER()) gives them"""
+
+    return _per_value(series, normalize_key)
+
+
+def _probe(conn: Connection, sql: str, values: Iterable, batch_size: int = 500) -> list:
+    """Runs the query, whose IN list is :values, over the values in batches"""
+
+    statement = text(sql).bindparams(bindparam("values", expanding=True))
+    values = list(values)
+    rows = []
+    for i in range(0, len(values), batch_size):
+        rows.extend(conn.execute(statement, {"values": values[i : i + batch_size]}))
+
+    return rows
+
+
+def _delivery_changes(conn: Connection, staged: pd.DataFrame, diff: list) -> dict:
+    # Only the first row of each client name, address and postcode can make a change
+    deliveries = staged[DELIVERY_COLUMNS].drop_duplicates(subset=DELIVERY_COLUMNS[:3])
+    rows = _values(deliveries).itertuples(index=False, name="Row")
+    expired, new_rows = delivery_details_changes(conn, rows)
+
+    for delivery_id, keys in expired.items():
+        diff.append(("dim_delivery_details", "expire", delivery_id, " | ".join(map(str, keys)), None))
+    for _, row in new_rows:
+        diff.append(("dim_delivery_details", "insert", " | ".join(map(str, row[:3])), None, None))
+
+    return {"new": len(new_rows), "expired": len(expired)}
+
+
+def _product_changes(conn: Connection, staged: pd.DataFrame, diff: list) -> dict:
+    products = staged.assign(Key=_keys(staged["ProductName"])).dropna(subset="Key")
+    names = products.groupby("Key")["ProductName"].first()
+    prices = products.groupby("Key")["UnitPrice"].max()
+
+    existing = {
+        normalize_key(row.ProductName): row.UnitPrice
+        for row in _probe(
+            conn,
+            "SELECT ProductName, UnitPrice FROM dim_product_details WHERE TRIM(LOWER(ProductName)) IN :values;",
+            prices.index,
+        )
+    }
+    new = [key for key in prices.index if key not in existing]
+    changed = [
+        key for key in prices.index if key in existing and existing[key] != prices[key]
+    ]
+
+    for key in new:
+        diff.append(("dim_product_details", "insert", names[key], None, prices[key]))
+    for key in changed:
+        diff.append(("dim_product_details", "update", names[key], existing[key], prices[key]))
+
+    return {"new": len(new), "price_changes": len(changed)}
+
+
+def _payment_changes(conn: Connection, staged: pd.DataFrame, diff: list) -> dict:
+    # The DML inserts one row per normalized code, type and date, ignoring those whose
+    # code is already in the dim (or earlier in the file)
+    groups = pd.DataFrame(
+        {
+            "Code": _values(staged["PaymentBillingCode"]),
+            "Type": _keys(staged["PaymentType"]),
+            "Date": staged["PaymentDate"],
+        }
+    ).assign(Key=lambda df: df["Code"].map(normalize_key))
+    codes = (
+        groups.drop_duplicates(subset=["Key", "Type", "Date"])["Code"].dropna().drop_duplicates()
+    )
+
+    existing = {
+        row.PaymentBillingCode
+        for row in _probe(
+            conn,
+            "SELECT PaymentBillingCode FROM dim_payment_details WHERE PaymentBillingCode IN :values;",
+            codes,
+        )
+    }
+    new = [code for code in codes if code not in existing]
+    diff.extend(("dim_payment_details", "insert", code, None, None) for code in new)
+
+    return {"new": len(new)}
+
+
+def _loaded_orders(conn: Connection, staged: pd.DataFrame) -> set:
+    """The staged OrderNumbers that earlier ingests already loaded, as drop_loaded_orders finds them"""
+
+    return loaded_order_numbers(conn, staged["OrderNumber"].dropna().unique())
+
+
+def _fact_changes(staged: pd.DataFrame, loaded: set, diff: list) -> dict:
+    is_loaded = staged["OrderNumber"].isin(loaded)
+    already_loaded = staged.loc[is_loaded, "OrderNumber"].drop_duplicates()
+    staged = staged[~is_loaded]
+    missing_keys = staged[FACT_JOIN_COLUMNS + ["OrderNumber"]].isna().any(axis=1)
+    facts = staged[~missing_keys]
+    duplicate = facts["OrderNumber"].duplicated()
+
+    for reason, order_numbers in [
+        ("insert", facts.loc[~duplicate, "OrderNumber"]),
+        ("ignore: already loaded", already_loaded),
+        ("ignore: duplicate in file", facts.loc[duplicate, "OrderNumber"]),
+        ("ignore: missing keys", staged.loc[missing_keys, "OrderNumber"]),
+    ]:
+        diff.extend(("fact_orders", reason, order_number, None, None) for order_number in order_numbers)
+
+    return {
+        "new": int((~duplicate).sum()),
+        "already_loaded": len(already_loaded),
+        "duplicate_in_file": int(duplicate.sum()),
+        "missing_keys": int(missing_keys.sum()),
+    }
+
+
+def plan_ingest(
+    input_file: str, db_path: str = "/app/databases/orders.db", diff: Optional[list] = None
+) -> dict:
+    """
+    Works out what run_data_ingest would do with the file, without writing to the
+    orders DB: the new delivery, product and payment rows, the delivery rows expired
+    and product prices overwritten, and the new and ignored facts. The file goes
+    through the same manifest and data quality steps as an ingest. If a list is
+    passed as diff, the rows behind the counts are appended to it (see DIFF_COLUMNS)
+    """
+
+    diff = [] if diff is None else diff
+    plan = {"file": input_file, "status": "planned"}
+
+    with _read_only(db_path) as engine:
+        fingerprint = file_fingerprint(input_file)
+        with engine.connect() as conn:
+            if INCREMENTAL_INGEST and is_file_ingested(conn, fingerprint):
+                return {**plan, "status": "skipped"}
+
+        chunks = iter_cached_input_chunks(input_file)
+        report = run_vectorized_data_quality_checks(chunks)
+        plan["rows"] = {"read": report["row_counts"]["total"], "rejected": 0}
+        try:
+            data_quality_check(report, MAX_REJECTED_FRACTION)
+        except ValueError:
+            return {**plan, "status": "failed"}
+
+        rejected = []
+        chunks = iter_cached_input_chunks(input_file)
+        if MAX_REJECTED_FRACTION:
+            chunks = iter_valid_rows(chunks, rejected)
+        if INCREMENTAL_INGEST:
+            chunks = iter_new_rows(engine, chunks)
+        chunks = list(chunks)
+        plan["rows"].update(
+            rejected=sum(map(len, rejected)), staged=sum(map(len, chunks))
+        )
+
+        changes = []
+        if chunks:
+            staged = concat_chunks(chunks)
+            with engine.connect() as conn:
+                # Orders already loaded are dropped before the DML, so make no dim changes
+                loaded = _loaded_orders(conn, staged)
+                fresh = staged[~staged["OrderNumber"].isin(loaded)]
+                plan["dim_delivery_details"] = _delivery_changes(conn, fresh, changes)
+                plan["dim_product_details"] = _product_changes(conn, fresh, changes)
+                plan["dim_payment_details"] = _payment_changes(conn, fresh, changes)
+                plan["fact_orders"] = _fact_changes(staged, loaded, changes)
+        diff.extend((input_file, *change) for change in changes)
+
+    return plan
+
+
+def format_plan(plan: dict) -> str:
+    """A summary of an ingest plan, a few lines long"""
+
+    if plan["status"] == "skipped":
+        return f"{plan['file']}: already ingested, would be skipped"
+    rows = plan["rows"]
+    if plan["status"] == "failed":
+        return f"{plan['file']}: {rows['read']} rows, would fail the data quality checks"
+
+    lines = [
+        f"{plan['file']}: {rows['read']} rows, {rows['rejected']} rejected, "
+        f"{rows['staged']} new or modified"
+    ]
+    if rows["staged"]:
+        delivery, product, payment, facts = (
+            plan[table]
+            for table in ["dim_delivery_details", "dim_product_details", "dim_payment_details", "fact_orders"]
+        )
+        lines += [
+            f"  dim_delivery_details: {delivery['new']} new, {delivery['expired']} expired",
+            f"  dim_product_details: {product['new']} new, {product['price_changes']} price changes",
+            f"  dim_payment_details: {payment['new']} new",
+            f"  fact_orders: {facts['new']} new, {facts['already_loaded']} already loaded, "
+            f"{facts['duplicate_in_file']} duplicates in the file, "
+            f"{facts['missing_keys']} missing a dim key",
+        ]
+
+    return "\n".join(lines)
+
+
+def run_ingest_plan(
+    input_files: List[str],
+    db_path: str = "/app/databases/orders.db",
+    diff_path: Optional[str] = None,
+) -> List[dict]:
+    """
+    Plans the ingest of each file against the orders DB as it is now (not of the
+    files one after the other), prints their summaries and, if diff_path is given,
+    writes their row-level diff to it as a CSV file. Returns the plans
+    """
+
+    diff = []
+    plans = [plan_ingest(input_file, db_path, diff) for input_file in input_files]
+    for plan in plans:
+        print(format_plan(plan))
+
+    if diff_path:
+        pd.DataFrame(diff, columns=DIFF_COLUMNS).to_csv(diff_path, index=False)
+        logging.info(f"Wrote the {len(diff)} changes of the plan to {diff_path}")
+
+    return plans
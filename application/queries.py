@@ -0,0 +1,206 @@
+from collections import OrderedDict
+from operator import attrgetter
+from typing import List, Optional
+import os
+import threading
+
+from sqlalchemy import Row, text
+
+from config import QUERY_CACHE_MAX_ENTRIES, SQLITE_READ_PROFILE
+from init_db_connection import create_sqlite_engine
+from manifest import generation_path
+from partitions import iter_fact_partition_groups
+
+# The supported read queries, by name. Statements are kept as they are, so SQLite's
+# per-connection statement cache reuses their prepared form
+QUERIES = {
+    "orders_by_client": text(
+        """
+        SELECT f.OrderNumber, p.ProductName, p.ProductType, f.ProductQuantity, f.TotalPrice, f.Currency, pay.PaymentDate, d.DeliveryAddress, d.DeliveryPostcode
+        FROM dim_delivery_details d
+        JOIN fact_orders f ON f.DeliveryId = d.DeliveryId
+        JOIN dim_product_details p ON p.ProductId = f.ProductId
+        JOIN dim_payment_details pay ON pay.PaymentId = f.PaymentId
+        WHERE TRIM(LOWER(d.ClientName)) = TRIM(LOWER(:client_name))
+        ORDER BY pay.PaymentDate DESC, f.OrderNumber
+        LIMIT :limit;
+        """
+    ),
+    "orders_between": text(
+        """
+        SELECT f.OrderNumber, pay.PaymentDate, d.ClientName, p.ProductName, f.ProductQuantity, f.TotalPrice, f.Currency
+        FROM fact_orders f
+        JOIN dim_payment_details pay ON pay.PaymentId = f.PaymentId
+        JOIN dim_product_details p ON p.ProductId = f.ProductId
+        JOIN dim_delivery_details d ON d.DeliveryId = f.DeliveryId
+        WHERE f.DateKey BETWEEN CAST(STRFTIME('%Y%m%d', :start_date) AS INTEGER) AND CAST(STRFTIME('%Y%m%d', :end_date) AS INTEGER)
+        ORDER BY f.DateKey, f.OrderNumber
+        LIMIT :limit;
+        """
+    ),
+    "revenue_by_product": text(
+        """
+        SELECT p.ProductName, p.ProductType, SUM(r.TotalPrice) AS TotalPrice, SUM(r.ProductQuantity) AS ProductQuantity, SUM(r.Orders) AS Orders
+        FROM rollup_daily_product_revenue r
+        JOIN dim_product_details p ON p.ProductId = r.ProductId
+        WHERE r.PaymentDate BETWEEN :start_date AND :end_date
+        GROUP BY r.ProductId
+        ORDER BY TotalPrice DESC;
+        """
+    ),
+    "revenue_by_month": text(
+        """
+        SELECT PaymentMonth, SUM(TotalPrice) AS TotalPrice, SUM(ProductQuantity) AS ProductQuantity, SUM(Orders) AS Orders
+        FROM rollup_monthly_client_revenue
+        WHERE PaymentMonth BETWEEN :start_month AND :end_month
+        GROUP BY PaymentMonth
+        ORDER BY PaymentMonth;
+        """
+    ),
+    "latest_delivery_address": text(
+        """
+        SELECT ClientName, DeliveryAddress, DeliveryPostcode, DeliveryCity, DeliveryCountry, DeliveryContactNumber, ValidFrom
+        FROM dim_delivery_details
+        WHERE TRIM(LOWER(ClientName)) = TRIM(LOWER(:client_name)) AND MostRecent = 1
+        ORDER BY DeliveryId DESC
+        LIMIT 1;
+        """
+    ),
+    "delivery_address_as_of": text(
+        """
+        SELECT ClientName, DeliveryAddress, DeliveryPostcode, DeliveryCity, DeliveryCountry, DeliveryContactNumber, ValidFrom
+        FROM dim_delivery_details
+        WHERE TRIM(LOWER(ClientName)) = TRIM(LOWER(:client_name)) AND ValidFrom <= :as_of
+        ORDER BY ValidFrom DESC, DeliveryId DESC
+        LIMIT 1;
+        """
+    ),
+}
+
+# The queries that read fact_orders, with the parameters bounding their payment dates
+# if they have any, and their ORDER BY as (column, descending) pairs. With partitioned
+# facts (see partitions.py) those queries only attach the partitions of the months in
+# that period, a group at a time if there are more than SQLite can attach, and the
+# groups' results are merged in that order
+FACT_QUERIES = {
+    "orders_by_client": (None, [("PaymentDate", True), ("OrderNumber", False)]),
+    "orders_between": (("start_date", "end_date"), [("PaymentDate", False), ("OrderNumber", False)]),
+}
+
+
+def _merge(rows: List[Row], order: List[tuple], limit: int) -> List[Row]:
+    """The first limit rows of the groups' results, in the query's order"""
+
+    for column, descending in reversed(order):  # Sorts are stable
+        rows.sort(key=attrgetter(column), reverse=descending)
+    return rows[:limit]
+
+
+class OrdersQueries:
+    """
+    Read API over the star schema, for services. Queries run on a pool of read-only
+    connections, and their results are cached until the next ingest: every ingest
+    publishes a new generation to a file next to the DB, so a repeated read costs
+    one stat of that file and never touches SQLite. Safe to share between threads
+    """
+
+    def __init__(
+        self,
+        db_path: str = "/app/databases/orders.db",
+        cache_max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+    ):
+        self.db_path = db_path
+        self.engine = create_sqlite_engine(db_path, SQLITE_READ_PROFILE)
+        self.generation_path = generation_path(db_path)
+        self.cache_max_entries = cache_max_entries
+        self.hits = self.misses = 0
+        self._results = OrderedDict()
+        self._generation_stamp = None  # Of the generation file the results are from
+        self._lock = threading.Lock()
+
+    def _current_generation_stamp(self) -> Optional[tuple]:
+        # The file is replaced on every publish, so a new inode means a new generation
+        try:
+            stat = os.stat(self.generation_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _query(self, name: str, **params) -> List[Row]:
+        key = (name, tuple(sorted(params.items())))
+        stamp = self._current_generation_stamp()
+        with self._lock:
+            if stamp != self._generation_stamp:
+                self._results.clear()
+                self._generation_stamp = stamp
+                # Pooled connections keep reading the file they opened, which a
+                # shadow publish (see shadow.py) has replaced
+                self.engine.dispose()
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return list(self._results[key])
+            self.misses += 1
+
+        with self.engine.connect() as conn:
+            if name in FACT_QUERIES:
+                period, order = FACT_QUERIES[name]
+                months = [params[param][:7] for param in period or ()]
+                rows, groups = [], 0
+                for _ in iter_fact_partition_groups(conn, self.db_path, *months):
+                    rows.extend(conn.execute(QUERIES[name], params))
+                    groups += 1
+                if groups > 1:
+                    rows = _merge(rows, order, params["limit"])
+            else:
+                rows = conn.execute(QUERIES[name], params).fetchall()
+
+        with self._lock:
+            # Results read while an ingest published a generation may be from either
+            if stamp == self._generation_stamp:
+                self._results[key] = rows
+                if len(self._results) > self.cache_max_entries:
+                    self._results.popitem(last=False)
+
+        return list(rows)
+
+    def orders_by_client(self, client_name: str, limit: int = 100) -> List[Row]:
+        """The client's latest orders, with their product, payment and delivery"""
+
+        return self._query("orders_by_client", client_name=client_name, limit=limit)
+
+    def orders_between(self, start_date: str, end_date: str, limit: int = 1000) -> List[Row]:
+        """The orders paid for between the ISO dates, inclusive, oldest first"""
+
+        return self._query(
+            "orders_between", start_date=start_date, end_date=end_date, limit=limit
+        )
+
+    def revenue_by_product(self, start_date: str, end_date: str) -> List[Row]:
+        """Revenue of each product paid for between the ISO dates, inclusive"""
+
+        return self._query(
+            "revenue_by_product", start_date=start_date, end_date=end_date
+        )
+
+    def revenue_by_month(self, start_month: str, end_month: str) -> List[Row]:
+        """Revenue of each month (YYYY-MM) between the two, inclusive"""
+
+        return self._query(
+            "revenue_by_month", start_month=start_month, end_month=end_month
+        )
+
+    def latest_delivery_address(self, client_name: str) -> Optional[Row]:
+        """The client's current delivery details, if it's a known client"""
+
+        rows = self._query("latest_delivery_address", client_name=client_name)
+        return rows[0] if rows else None
+
+    def delivery_address_as_of(self, client_name: str, as_of: str) -> Optional[Row]:
+        """The client's delivery details that were valid on the ISO date, if any"""
+
+        rows = self._query("delivery_address_as_of", client_name=client_name, as_of=as_of)
+        return rows[0] if rows else None
+
+    def close(self):
+        self.engine.dispose()
@@ -0,0 +1,78 @@
+from sqlalchemy import text
+from sqlalchemy.engine.base import Connection
+
+from metrics import execute_with_plan
+import metrics
+
+# Aggregates of fact_orders kept up to date by the fact inserts, by table: the key
+# columns it's grouped by (its primary key) and the query aggregating the facts
+# with a rowid above :after_rowid by those keys
+ROLLUPS = {
+    "rollup_daily_product_revenue": (
+        ["PaymentDate", "ProductId"],
+        """
+        SELECT pay.PaymentDate, f.ProductId, SUM(f.TotalPrice), SUM(f.ProductQuantity), COUNT(*)
+        FROM fact_orders f
+        JOIN dim_payment_details pay ON pay.PaymentId = f.PaymentId
+        WHERE f.rowid > :after_rowid
+        GROUP BY pay.PaymentDate, f.ProductId
+        """,
+    ),
+    "rollup_monthly_client_revenue": (
+        ["PaymentMonth", "ClientKey"],
+        """
+        SELECT SUBSTR(pay.PaymentDate, 1, 7), TRIM(LOWER(d.ClientName)), SUM(f.TotalPrice), SUM(f.ProductQuantity), COUNT(*)
+        FROM fact_orders f
+        JOIN dim_payment_details pay ON pay.PaymentId = f.PaymentId
+        JOIN dim_delivery_details d ON d.DeliveryId = f.DeliveryId
+        WHERE f.rowid > :after_rowid
+        GROUP BY SUBSTR(pay.PaymentDate, 1, 7), TRIM(LOWER(d.ClientName))
+        """,
+    ),
+}
+
+
+def max_fact_rowid(conn: Connection) -> int:
+    """
+    The newest fact's rowid. Facts are only ever appended, so the facts inserted
+    after this is read are exactly those with a higher rowid
+    """
+
+    return conn.execute(text("SELECT COALESCE(MAX(rowid), 0) FROM fact_orders;")).scalar()
+
+
+def _update_rollup(conn: Connection, table: str, after_rowid: int):
+    keys, select = ROLLUPS[table]
+    execute_with_plan(
+        conn,
+        f"update {table}",
+        f"""
+        INSERT INTO {table} ({", ".join(keys)}, TotalPrice, ProductQuantity, Orders)
+        {select}
+        ON CONFLICT ({", ".join(keys)}) DO UPDATE SET
+            TotalPrice = TotalPrice + excluded.TotalPrice,
+            ProductQuantity = ProductQuantity + excluded.ProductQuantity,
+            Orders = Orders + excluded.Orders;
+        """,
+        {"after_rowid": after_rowid},
+    )
+
+
+def update_rollups(conn: Connection, after_rowid: int):
+    """
+    Adds the facts inserted since max_fact_rowid returned after_rowid to every rollup.
+    Run it in the transaction of the fact insert, so the rollups never drift. It's
+    recorded as a stage of its own, within the fact insert's
+    """
+
+    with metrics.stage("rollups"):
+        for table in ROLLUPS:
+            _update_rollup(conn, table, after_rowid)
+
+
+def backfill_rollups(conn: Connection):
+    """Fills the rollups that are still empty from all the facts, e.g. once created"""
+
+    for table in ROLLUPS:
+        if conn.execute(text(f"SELECT NOT EXISTS (SELECT 1 FROM {table});")).scalar():
+            _update_rollup(conn, table, 0)
@@ -0,0 +1,121 @@
+from typing import Generator
+import contextlib
+import logging
+import os
+import sqlite3
+
+import metrics
+
+# A shadow build writes an ingest into a copy of the orders DB next to it, rather than
+# into the live file, then publishes the copy with a rename. Readers keep the snapshot
+# they have open, and see the new one on their next connection. The published file is
+# in rollback journal mode: a rename must never land next to a -wal file, which
+# SQLite would replay into the new file
+
+
+def shadow_path(db_path: str) -> str:
+    """The shadow copy of the orders DB, on the same filesystem so it can be renamed over it"""
+
+    return f"{db_path}.shadow"
+
+
+def live_path(db_path: str) -> str:
+    """The orders DB that db_path is the shadow copy of, or db_path if it isn't one"""
+
+    return db_path.removesuffix(".shadow")
+
+
+def _remove(path: str):
+    for file in [path, f"{path}-wal", f"{path}-shm", f"{path}-journal"]:
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def _generation(path: str) -> int:
+    conn = sqlite3.connect(path)
+    try:
+        if not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ingest_generation';"
+        ).fetchone():
+            return 0
+        return conn.execute("SELECT COALESCE(MAX(Generation), 0) FROM ingest_generation;").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _use_rollback_journal(path: str):
+    """
+    Checkpoints a WAL DB into its file and switches it to a rollback journal, which
+    removes its -wal file. Leaving WAL mode needs the DB to itself
+    """
+
+    conn = sqlite3.connect(path)
+    try:
+        journal_mode = conn.execute("PRAGMA journal_mode = DELETE;").fetchone()[0]
+    finally:
+        conn.close()
+    if journal_mode != "delete":
+        raise RuntimeError(
+            f"Can't take {path} out of WAL mode while other connections have it open"
+        )
+
+
+def seed_shadow(db_path: str) -> str:
+    """
+    Copies the orders DB to its shadow copy through SQLite's online backup API, which
+    gives a consistent snapshot, WAL included, without blocking readers. Returns the
+    path of the copy
+    """
+
+    path = shadow_path(db_path)
+    _remove(path)  # Left by a run that crashed
+    source, shadow = sqlite3.connect(db_path), sqlite3.connect(path)
+    try:
+        source.backup(shadow)
+    finally:
+        source.close()
+        shadow.close()
+
+    return path
+
+
+def publish_shadow(path: str, db_path: str, seeded_generation: int):
+    """
+    Swaps the shadow copy in over the orders DB with an atomic rename. Raises, and
+    leaves the live file alone, if another ingest committed to it since the shadow was
+    seeded from it, as publishing would lose that ingest
+    """
+
+    _use_rollback_journal(path)
+    if _generation(db_path) != seeded_generation or os.path.exists(f"{db_path}-journal"):
+        raise RuntimeError(
+            f"{db_path} was written to since its shadow copy was seeded, not publishing it"
+        )
+    if os.path.exists(f"{db_path}-wal"):  # Only until the first shadow publish
+        _use_rollback_journal(db_path)
+
+    os.replace(path, db_path)
+
+
+@contextlib.contextmanager
+def shadow_build(db_path: str) -> Generator[str, None, None]:
+    """
+    Seeds a shadow copy of the orders DB and yields its path, for the ingest to
+    build the new state in. If the block commits a new ingest generation to it, the
+    copy is published over the orders DB when the block exits. Otherwise, e.g. if
+    the file was already ingested or the block raises, the copy is removed and the
+    orders DB is left untouched
+    """
+
+    with metrics.stage("seed_shadow"):
+        path = seed_shadow(db_path)
+    seeded_generation = _generation(path)
+    try:
+        yield path
+
+        if _generation(path) != seeded_generation:
+            with metrics.stage("publish_shadow"):
+                publish_shadow(path, db_path, seeded_generation)
+            logging.info(f"Published the shadow copy of {db_path}")
+    finally:
+        _remove(path)
@@ -0,0 +1,101 @@
+"""
+Compares the SQLite connection profiles of init_db_connection on the ingest DML
+and on a star-join read query.
+
+    PYTHONPATH=application python benchmarks/bench_connection_profiles.py [rows]
+"""
+import logging
+import sys
+import tempfile
+import time
+
+from sqlalchemy import text
+import pandas as pd
+
+import config
+
+config.LOG_QUERY_PLANS = False
+
+from ddl import create_orders_tables
+from init_db_connection import (
+    SQLITE_PROFILES,
+    create_sqlite_engine,
+    init_engine_and_load_staging,
+    optimize_database,
+    read_excel_to_dataframe,
+)
+from ingest_orders_dml import (
+    insert_into_dim_delivery_details,
+    insert_into_dim_product_details,
+    insert_into_dim_payment_details,
+    insert_into_fact_orders,
+)
+
+READ_QUERY = """
+    SELECT d.ClientName, p.ProductType, SUM(f.TotalPrice), SUM(f.ProductQuantity)
+    FROM fact_orders f
+    JOIN dim_delivery_details d ON d.DeliveryId = f.DeliveryId
+    JOIN dim_product_details p ON p.ProductId = f.ProductId
+    GROUP BY d.ClientName, p.ProductType;
+"""
+
+
+def synthetic_orders(rows: int) -> pd.DataFrame:
+    """The sample input repeated, with unique order numbers and one client per 50 rows"""
+
+    sample = read_excel_to_dataframe("input_data.xlsx")
+    df = sample.sample(rows, replace=True, random_state=0).reset_index(drop=True)
+    df["OrderNumber"] = [f"PO{i:09d}-1" for i in range(rows)]
+    df["ClientName"] = df["ClientName"] + " " + (df.index // 50).astype(str)
+
+    return df
+
+
+def bench_ingest(db_path: str, df: pd.DataFrame, profile: str) -> float:
+    start = time.perf_counter()
+    with init_engine_and_load_staging(create_sqlite_engine(db_path, profile), df) as conn:
+        create_orders_tables(conn)
+        insert_into_dim_delivery_details(conn)
+        insert_into_dim_product_details(conn)
+        insert_into_dim_payment_details(conn)
+        insert_into_fact_orders(conn)
+        conn.commit()
+        optimize_database(conn)
+        conn.commit()
+
+    return time.perf_counter() - start
+
+
+def bench_reads(db_path: str, profile: str, repeat: int = 20) -> float:
+    engine = create_sqlite_engine(db_path, profile)
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        for _ in range(repeat):
+            conn.execute(text(READ_QUERY)).fetchall()
+    engine.dispose()
+
+    return (time.perf_counter() - start) / repeat
+
+
+def main(rows: int):
+    logging.basicConfig(level=logging.WARNING)
+    df = synthetic_orders(rows)
+
+    print(f"{'profile':<16}{'ingest (s)':>12}{'rows/sec':>12}{'read query (ms)':>18}")
+    for profile in SQLITE_PROFILES:
+        if profile == "read_optimized":
+            continue  # query_only, it can't run the ingest
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = f"{tmp_dir}/orders.db"
+            ingest = bench_ingest(db_path, df, profile)
+            read_profiles = [profile, "read_optimized"]
+            reads = {p: bench_reads(db_path, p) * 1000 for p in read_profiles}
+        print(
+            f"{profile:<16}{ingest:>12.2f}{rows / ingest:>12.0f}"
+            f"{reads[profile]:>18.1f}"
+        )
+    print(f"{'read_optimized':<16}{'-':>12}{'-':>12}{reads['read_optimized']:>18.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,54 @@
+"""
+Compares the parse throughput of the input adapters of init_db_connection (xlsx,
+CSV and Parquet) on the same synthetic orders, and of reading the parse cache.
+
+    PYTHONPATH=application python benchmarks/bench_input_formats.py [rows]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from generate_orders import generate_orders, write_orders
+from init_db_connection import INPUT_ADAPTERS, iter_cached_input_chunks, iter_input_chunks
+
+
+def bench_parse(chunks) -> tuple:
+    """Returns the seconds taken to consume the chunks, and the rows in them"""
+
+    start, rows = time.perf_counter(), 0
+    for chunk in chunks:
+        rows += len(chunk)
+
+    return time.perf_counter() - start, rows
+
+
+def main(rows: int):
+    logging.basicConfig(level=logging.WARNING)
+    df = generate_orders(rows)
+
+    print(f"{'format':<16}{'size (MB)':>12}{'parse (s)':>12}{'rows/sec':>12}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for extension in INPUT_ADAPTERS:
+            path = os.path.join(tmp_dir, f"orders{extension}")
+            try:
+                write_orders(df, path)
+            except ImportError:
+                print(f"{extension[1:]:<16}{'needs pyarrow':>36}")
+                continue
+
+            seconds, parsed = bench_parse(iter_input_chunks(path))
+            assert parsed == rows
+            size = os.path.getsize(path) / 1024 / 1024
+            print(f"{extension[1:]:<16}{size:>12.1f}{seconds:>12.2f}{rows / seconds:>12.0f}")
+
+        # A second read of an unchanged file comes from the parse cache
+        cache_dir = os.path.join(tmp_dir, "parse_cache")
+        bench_parse(iter_cached_input_chunks(path, cache_dir=cache_dir))
+        seconds, _ = bench_parse(iter_cached_input_chunks(path, cache_dir=cache_dir))
+        print(f"{'parse cache':<16}{'-':>12}{seconds:>12.2f}{rows / seconds:>12.0f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
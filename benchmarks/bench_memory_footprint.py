@@ -0,0 +1,71 @@
+"""
+Reports the memory footprint of the parsed orders as the readers of
+init_db_connection type them (categorical text, downcast numbers and datetime64
+dates) against the object text, int64/float64 numbers and date objects they used
+to give, per column and in total, and the peak memory of turning each into the
+rows bound to the staging insert.
+
+    PYTHONPATH=application python benchmarks/bench_memory_footprint.py [rows]
+"""
+import logging
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import pandas as pd
+
+from generate_orders import generate_orders, write_orders
+from init_db_connection import _sql_rows, concat_chunks, iter_input_chunks
+
+
+def expand(df: pd.DataFrame) -> pd.DataFrame:
+    """The parsed orders as the readers typed them before they were compacted"""
+
+    df = df.astype({col: object for col in df.select_dtypes("category").columns})
+    df = df.astype({col: "int64" for col in df.select_dtypes("integer").columns})
+    df = df.astype({col: "float64" for col in df.select_dtypes("floating").columns})
+    return df.assign(PaymentDate=df["PaymentDate"].dt.date)
+
+
+def peak_sql_rows_mb(df: pd.DataFrame) -> float:
+    """The peak memory allocated while turning the frame into staging rows"""
+
+    tracemalloc.start()
+    rows = _sql_rows(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rows
+
+    return peak / 1024 / 1024
+
+
+def main(rows: int):
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "orders.csv")
+        write_orders(generate_orders(rows), path)
+        compact = concat_chunks(list(iter_input_chunks(path)))
+    legacy = expand(compact)
+
+    compact_usage = compact.memory_usage(deep=True, index=False) / 1024 / 1024
+    legacy_usage = legacy.memory_usage(deep=True, index=False) / 1024 / 1024
+
+    print(f"{'column':<24}{'dtype':>16}{'before (MB)':>14}{'after (MB)':>14}")
+    for col in compact.columns:
+        print(
+            f"{col:<24}{str(compact[col].dtype).split('(')[0]:>16}"
+            f"{legacy_usage[col]:>14.1f}{compact_usage[col]:>14.1f}"
+        )
+    print(
+        f"{'total':<24}{'':>16}{legacy_usage.sum():>14.1f}{compact_usage.sum():>14.1f}"
+        f"  ({legacy_usage.sum() / compact_usage.sum():.1f}x smaller)"
+    )
+    print(
+        f"{'staging rows (peak)':<24}{'':>16}"
+        f"{peak_sql_rows_mb(legacy):>14.1f}{peak_sql_rows_mb(compact):>14.1f}"
+    )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
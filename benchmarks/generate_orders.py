@@ -0,0 +1,174 @@
+"""
+Deterministic generator of synthetic orders in the input_data.xlsx layout.
+
+    python benchmarks/generate_orders.py 100000 benchmarks/data/orders.xlsx \
+        --clients 5000 --products 500 --churn 0.05 --batch 1 --seed 42
+
+Batch 0 is an initial load. Every later batch reuses the same clients and products,
+but with a --churn fraction of the clients changing their name or their address
+(both SCD2 changes for dim_delivery_details) and of the products changing their
+price (an overwrite in dim_product_details), cumulatively from one batch to the next.
+"""
+from datetime import date
+import argparse
+import os
+
+from openpyxl import Workbook
+import numpy as np
+import pandas as pd
+
+COLUMNS = [
+    "OrderNumber",
+    "ClientName",
+    "ProductName",
+    "ProductType",
+    "UnitPrice",
+    "ProductQuantity",
+    "TotalPrice",
+    "Currency",
+    "DeliveryAddress",
+    "DeliveryCity",
+    "DeliveryPostcode",
+    "DeliveryCountry",
+    "DeliveryContactNumber",
+    "PaymentType",
+    "PaymentBillingCode",
+    "PaymentDate",
+]
+
+PRODUCT_TYPES = ["Keyboard", "String", "Woodwind", "Brass", "Percussion", "Mics"]
+CITIES = ["Swindon", "Grimsby", "Guildford", "Okehampton", "Edinburgh", "YORK", "NEWPORT"]
+COUNTRIES = ["United Kingdom", "UNITED KINGDOM", "UK"]
+STREETS = ["Academy Street", "Buckingham Rd", "Boar Lane", "Park Avenue", "Gambler Lane"]
+
+
+def _clients(rng: np.random.Generator, clients: int, churn: float, batch: int) -> pd.DataFrame:
+    ids = np.arange(clients)
+    df = pd.DataFrame(
+        {
+            "ClientName": [f"Client {i} Ltd" for i in ids],
+            "DeliveryAddress": [
+                f"{n} {STREETS[i % len(STREETS)]}"
+                for i, n in zip(ids, rng.integers(1, 999, clients))
+            ],
+            "DeliveryPostcode": [f"PC{i:06d} {i % 9}AB" for i in ids],
+            "DeliveryCity": rng.choice(CITIES, clients),
+            "DeliveryCountry": rng.choice(COUNTRIES, clients),
+            "DeliveryContactNumber": [f"+44 7700 {i:06d}" for i in ids],
+        }
+    )
+
+    for b in range(1, batch + 1):
+        churned = rng.random(clients) < churn
+        renamed = churned & (rng.random(clients) < 0.5)
+        moved = churned & ~renamed
+        df.loc[renamed, "ClientName"] = df.loc[renamed, "ClientName"] + f" & Sons {b}"
+        df.loc[moved, "DeliveryAddress"] = df.loc[moved, "DeliveryAddress"] + f" Flat {b}"
+        df.loc[moved, "DeliveryPostcode"] = df.loc[moved, "DeliveryPostcode"] + f"{b}"
+
+    return df
+
+
+def _products(rng: np.random.Generator, products: int, churn: float, batch: int) -> pd.DataFrame:
+    df = pd.DataFrame(
+        {
+            "ProductName": [f"Instrument {i}" for i in range(products)],
+            "ProductType": rng.choice(PRODUCT_TYPES, products),
+            "UnitPrice": rng.integers(20, 9000, products),
+        }
+    )
+
+    for _ in range(batch):
+        repriced = rng.random(products) < churn
+        df.loc[repriced, "UnitPrice"] += rng.integers(1, 100, int(repriced.sum()))
+
+    return df
+
+
+def generate_orders(
+    rows: int,
+    clients: int = 1000,
+    products: int = 200,
+    churn: float = 0.05,
+    batch: int = 0,
+    seed: int = 42,
+) -> pd.DataFrame:
+    """Returns `rows` orders for the given batch. Same arguments, same orders"""
+
+    # The clients and products only depend on the seed, so batches share them
+    clients_df = _clients(np.random.default_rng(seed), clients, churn, batch)
+    products_df = _products(np.random.default_rng(seed + 1), products, churn, batch)
+
+    rng = np.random.default_rng([seed, batch])
+    client = rng.integers(0, clients, rows)
+    product = rng.integers(0, products, rows)
+    quantity = rng.integers(1, 10, rows)
+    payment_date = pd.Timestamp(date(2021, 1, 1)) + pd.to_timedelta(
+        rng.integers(0, 365 * 3, rows), unit="D"
+    )
+
+    df = pd.concat(
+        [
+            clients_df.iloc[client].reset_index(drop=True),
+            products_df.iloc[product].reset_index(drop=True),
+        ],
+        axis=1,
+    )
+    df["OrderNumber"] = [f"PO{batch:02d}{i:09d}-1" for i in range(rows)]
+    df["ProductQuantity"] = quantity
+    df["TotalPrice"] = df["UnitPrice"] * quantity
+    df["Currency"] = "GBP"
+    df["PaymentType"] = np.where(client % 2 == 0, "Debit", "Credit")
+    df["PaymentBillingCode"] = [
+        f"PO{c:07d}-{d:%Y%m%d}" for c, d in zip(client, payment_date)
+    ]
+    df["PaymentDate"] = payment_date
+
+    # Some rows of a client differ only in case, like in the real exports
+    shouted = rng.random(rows) < 0.05
+    df.loc[shouted, "ClientName"] = df.loc[shouted, "ClientName"].str.upper()
+
+    return df[COLUMNS]
+
+
+def write_orders(df: pd.DataFrame, path: str):
+    """Writes the orders as xlsx, CSV or Parquet, depending on the file extension"""
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if path.endswith(".csv"):
+        df.to_csv(path, index=False, date_format="%Y-%m-%d")
+        return
+    if path.endswith(".parquet"):
+        df.to_parquet(path, index=False, row_group_size=100_000)  # Needs pyarrow
+        return
+
+    # openpyxl's write-only mode streams rows out, so 1M rows fit in memory
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(list(df.columns))
+    for row in df.itertuples(index=False, name=None):
+        sheet.append(row)
+    workbook.save(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("rows", type=int)
+    parser.add_argument("path", help="Output file, .xlsx, .csv or .parquet")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--churn", type=float, default=0.05)
+    parser.add_argument("--batch", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    write_orders(
+        generate_orders(
+            args.rows, args.clients, args.products, args.churn, args.batch, args.seed
+        ),
+        args.path,
+    )
+
+
+if __name__ == "__main__":
+    main()
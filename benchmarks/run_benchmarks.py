@@ -0,0 +1,129 @@
+"""
+End-to-end benchmark of the ingest on synthetic orders (see generate_orders.py).
+
+    PYTHONPATH=application python benchmarks/run_benchmarks.py --rows 10000 100000 1000000 \
+        --compare benchmarks/results/baseline.json
+
+For every size, batch 0 is loaded into an empty DB (initial load), then batch 1, with
+its SCD churn, into the same DB (incremental load), each through main.run_data_ingest.
+The time of each stage, as the run's metrics record it (see metrics.py), is saved to
+benchmarks/results/<timestamp>.json, and compared with an earlier results file if given.
+"""
+from datetime import datetime
+import argparse
+import json
+import logging
+import os
+import platform
+import tempfile
+
+# Set before the application reads its config: the runs' metrics lines go to a file
+# for this script to read back, and every input is parsed afresh
+METRICS_PATH = os.path.join(tempfile.mkdtemp(prefix="bench-metrics-"), "metrics.jsonl")
+os.environ["METRICS_OUTPUT"] = METRICS_PATH
+os.environ["PARSE_CACHE_DIR"] = tempfile.mkdtemp(prefix="bench-parse-cache-")
+os.environ["LOG_QUERY_PLANS"] = "0"
+
+from generate_orders import generate_orders, write_orders
+from main import run_data_ingest
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def input_file(rows: int, batch: int, args) -> str:
+    """Generates the input once and keeps it in benchmarks/data for later runs"""
+
+    path = os.path.join(
+        BENCHMARK_DIR,
+        "data",
+        f"orders-{rows}-c{args.clients}-p{args.products}-ch{args.churn}-b{batch}-s{args.seed}.xlsx",
+    )
+    if not os.path.exists(path):
+        logging.warning(f"Generating {path}")
+        write_orders(
+            generate_orders(
+                rows, args.clients, args.products, args.churn, batch, args.seed
+            ),
+            path,
+        )
+
+    return path
+
+
+def run_ingest_stages(input_path: str, db_path: str) -> dict:
+    """
+    Runs main.run_data_ingest, returning the seconds each of its stages took and the
+    run's total. The parse stage overlaps the data_quality stage, which consumes it
+    """
+
+    run_data_ingest(input_path, db_path)
+    with open(METRICS_PATH) as f:
+        run = json.loads(f.readlines()[-1])
+    if run["status"] != "succeeded":
+        raise RuntimeError(f"Ingesting {input_path} {run['status']}")
+
+    timings = {record["stage"]: record["seconds"] for record in run["stages"]}
+    timings["total"] = run["seconds"]
+    return timings
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """Prints each stage's change against the baseline, flagging regressions"""
+
+    for run, stages in results.items():
+        if run not in baseline:
+            continue
+        print(f"\n{run}")
+        for name, seconds in stages.items():
+            before = baseline[run].get(name)
+            if not before:
+                continue
+            change = (seconds - before) / before
+            flag = "  REGRESSION" if change > threshold else ""
+            print(f"    {name:<22}{before:>9.2f}s ->{seconds:>9.2f}s  {change:+7.1%}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--clients", type=int, default=None, help="Default: rows / 20")
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--churn", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Regression threshold")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {}
+    for rows in args.rows:
+        size_args = argparse.Namespace(**vars(args))
+        size_args.clients = args.clients or max(rows // 20, 1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "orders.db")
+            for batch, run in enumerate(["initial", "incremental"]):
+                path = input_file(rows, batch, size_args)
+                results[f"{rows}/{run}"] = timings = run_ingest_stages(path, db_path)
+                print(f"{rows:>9} {run:<12}" + " ".join(
+                    f"{name}={seconds:.2f}s" for name, seconds in timings.items()
+                ))
+
+    os.makedirs(os.path.join(BENCHMARK_DIR, "results"), exist_ok=True)
+    results_path = os.path.join(
+        BENCHMARK_DIR, "results", f"{datetime.now():%Y%m%dT%H%M%S}.json"
+    )
+    with open(results_path, "w") as f:
+        json.dump(
+            {"python": platform.python_version(), "args": vars(args), "results": results},
+            f,
+            indent=4,
+        )
+    print(f"\nResults saved to {results_path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"], args.threshold)
+
+
+if __name__ == "__main__":
+    main()
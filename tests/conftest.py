@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# Keeps the parse cache of test runs (including the parser processes they spawn,
+# which inherit the environment) out of /app/databases
+os.environ.setdefault("PARSE_CACHE_DIR", tempfile.mkdtemp(prefix="parse_cache-"))
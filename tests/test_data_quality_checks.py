@@ -1,15 +1,21 @@
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 
 from data_quality_checks import (
+    drop_loaded_orders,
     unique_check,
     no_nulls_check,
     type_check,
     data_quality_check,
+    iter_valid_rows,
+    run_all_data_quality_checks,
+    run_vectorized_data_quality_checks,
 )
 
+from ddl import create_orders_tables, create_staging_table
 from init_db_connection import (
     init_engine_and_load_data,
+    iter_excel_chunks,
     read_excel_to_dataframe,
 )
 
@@ -60,3 +66,88 @@ def test_data_quality_check_fails_on_bad_report():
 
     with pytest.raises(ValueError, match="Data quality check failed!"):
         data_quality_check(bad_report)
+
+
+def test_vectorized_checks_match_sql_checks(set_up):
+    sql_report = run_all_data_quality_checks(set_up)
+    report = run_vectorized_data_quality_checks(
+        iter_excel_chunks("tests/test_input_data.xlsx", chunk_size=2)
+    )
+
+    assert report["all_values_unique"] == sql_report["all_values_unique"]
+    assert report["all_values_nonnull"] == sql_report["all_values_nonnull"]
+    assert report["column_is_correct_type"] == sql_report["column_is_correct_type"]
+    assert report["column_is_multiplied_correctly"] == {"TotalPrice": True}
+
+    data_quality_check(report)
+
+
+def test_vectorized_checks_count_bad_rows():
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.loc[1, "OrderNumber"] = df.loc[0, "OrderNumber"]
+    df.loc[2, "PaymentDate"] = None
+    df.loc[3, "TotalPrice"] = 1
+
+    report = run_vectorized_data_quality_checks(df)
+    counts = report["bad_row_counts"]
+
+    assert report["all_values_unique"] == {"OrderNumber": False}
+    assert counts["all_values_unique"] == {"OrderNumber": 1}
+    assert counts["all_values_nonnull"]["PaymentDate"] == 1
+    assert counts["column_is_multiplied_correctly"] == {"TotalPrice": 1}
+    assert report["column_is_correct_type"]["PaymentDate"]
+
+    with pytest.raises(ValueError, match="Data quality check failed!"):
+        data_quality_check(report)
+
+
+def test_failing_rows_are_quarantined_below_the_threshold():
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.loc[1, "OrderNumber"] = df.loc[0, "OrderNumber"]
+    df.loc[3, "TotalPrice"] = 1
+    df.loc[3, "PaymentDate"] = None
+
+    report = run_vectorized_data_quality_checks(df)
+    assert report["row_counts"] == {"total": 5, "failing": 2}
+
+    data_quality_check(report, max_rejected_fraction=0.4)
+    with pytest.raises(ValueError, match="Data quality check failed!"):
+        data_quality_check(report, max_rejected_fraction=0.3)
+
+    rejected = []
+    valid = list(iter_valid_rows([df[:2], df[2:]], rejected))
+
+    assert [len(chunk) for chunk in valid] == [1, 2]
+    assert [list(frame.index) for frame in rejected] == [[1], [3]]
+    assert rejected[0]["RejectReasons"].tolist() == ["all_values_unique:OrderNumber"]
+    assert rejected[1]["RejectReasons"].tolist() == [
+        "all_values_nonnull:PaymentDate; column_is_multiplied_correctly:TotalPrice"
+    ]
+
+
+def test_loaded_orders_are_dropped_from_staging_once():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        create_orders_tables(conn)
+        create_staging_table(conn)
+        conn.execute(
+            text(
+                """
+                INSERT INTO fact_orders (OrderNumber, DeliveryId, ProductId, PaymentId, TotalPrice, Currency, ProductQuantity, DateKey)
+                VALUES (:order, 1, 1, 1, 1, 'GBP', 1, 20210101);
+                """
+            ),
+            [{"order": "PO1"}, {"order": "PO2"}],
+        )
+        # PO2 is also in a partition, as left by a crash while routing
+        conn.execute(
+            text("INSERT INTO partitioned_orders VALUES (:order, '2021-01');"),
+            [{"order": "PO2"}, {"order": "PO3"}],
+        )
+        conn.execute(
+            text("INSERT INTO staging (OrderNumber) VALUES (:order);"),
+            [{"order": order} for order in ["PO1", "PO2", "PO3", "PO4"]],
+        )
+
+        assert drop_loaded_orders(conn) == {"PO1", "PO2", "PO3"}
+        assert conn.execute(text("SELECT OrderNumber FROM staging;")).scalars().all() == ["PO4"]
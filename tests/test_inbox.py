@@ -0,0 +1,69 @@
+import asyncio
+import glob
+import os
+import shutil
+
+from sqlalchemy import create_engine, text
+
+from inbox import settled_files, watch_inbox
+import inbox
+
+
+def test_files_settle_once_they_stop_changing(tmp_path):
+    path = tmp_path / "orders.csv"
+    path.write_text("OrderNumber\n")
+    seen = {}
+
+    assert settled_files(str(tmp_path), seen, 2, now=0) == []
+    assert settled_files(str(tmp_path), seen, 2, now=1) == []
+    with open(path, "a") as f:  # Still being written
+        f.write("PO0060504-1\n")
+    assert settled_files(str(tmp_path), seen, 2, now=2.5) == []
+    assert settled_files(str(tmp_path), seen, 2, now=4.5) == [(str(path), 0)]
+    assert settled_files(str(tmp_path), seen, 2, now=9) == []  # Only picked up once
+
+    path.unlink()
+    assert settled_files(str(tmp_path), seen, 2, now=10) == [] and seen == {}
+
+
+def test_inbox_service_ingests_arriving_files(tmp_path):
+    inbox, db_path = tmp_path / "inbox", str(tmp_path / "orders.db")
+    inbox.mkdir()
+
+    async def scenario():
+        stop = asyncio.Event()
+        service = asyncio.create_task(
+            watch_inbox(
+                str(inbox), db_path, workers=1, settle_seconds=0.2, poll_seconds=0.05, stop=stop
+            )
+        )
+        shutil.copy("tests/test_input_data.xlsx", inbox / "store_a.xlsx")
+        (inbox / "store_b.xlsx").write_text("not a workbook")
+        for _ in range(600):
+            if len(glob.glob(str(inbox / "*" / "*.xlsx"))) == 2:  # Moved to done/ or failed/
+                break
+            await asyncio.sleep(0.1)
+        stop.set()
+        return await service
+
+    results = asyncio.run(scenario())
+
+    assert sorted((os.path.basename(r["file"]), r["status"]) for r in results) == [
+        ("store_a.xlsx", "succeeded"),
+        ("store_b.xlsx", "failed"),
+    ]
+    assert all(r["latency_seconds"] >= 0.2 for r in results)
+    assert [name for name in os.listdir(inbox) if os.path.isfile(inbox / name)] == []
+    with create_engine(f"sqlite:///{db_path}").connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM fact_orders;")).scalar() == 5
+
+
+def test_inbox_service_warns_that_it_ignores_shadow_publish(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(inbox, "SHADOW_PUBLISH", True)
+    stop = asyncio.Event()
+    stop.set()
+
+    asyncio.run(watch_inbox(str(tmp_path), str(tmp_path / "orders.db"), workers=1, stop=stop))
+
+    assert "SHADOW_PUBLISH is ignored by the inbox service" in caplog.text
+    assert not os.path.exists(tmp_path / "orders.db.shadow")
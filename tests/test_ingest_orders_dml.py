@@ -1,6 +1,8 @@
 import datetime
+import logging
 
 from sqlalchemy import create_engine, MetaData, Table, text
+import pandas as pd
 import pytest
 
 from init_db_connection import (
@@ -11,9 +13,20 @@ from ingest_orders_dml import (
     insert_into_dim_delivery_details,
     insert_into_dim_product_details,
     insert_into_dim_payment_details,
+    insert_into_dim_date,
     insert_into_fact_orders,
+    insert_into_fact_orders_cached,
+)
+from key_cache import build_key_caches
+from manifest import row_hashes
+from ddl import (
+    READ_INDEXES,
+    create_orders_tables,
+    create_staging_indexes,
+    defer_read_indexes,
+    rebuild_read_indexes,
+    row_fingerprint,
 )
-from ddl import create_orders_tables
 
 
 @pytest.fixture
@@ -157,6 +170,8 @@ def test_sld_insert_into_dim_delivery_details(set_up_ddl, conn):
         row._asdict() for row in conn.execute(dim_delivery_details.select()).fetchall()
     ]
 
+    today = datetime.datetime.now(datetime.timezone.utc).date()  # CURRENT_DATE is UTC
+
     assert results_as_dicts_original != results_as_dicts_new
     assert results_as_dicts_new[1] == {
         "DeliveryId": 2,
@@ -166,9 +181,10 @@ def test_sld_insert_into_dim_delivery_details(set_up_ddl, conn):
         "DeliveryCity": "Swindon",
         "DeliveryCountry": "United Kingdom",
         "DeliveryContactNumber": "+44 7911 843910",
-        "ValidFrom": datetime.date(2023, 10, 30),
-        "ValidTo": datetime.date(2023, 10, 30),
+        "ValidFrom": today,
+        "ValidTo": today,
         "MostRecent": 0,
+        "RowHash": row_fingerprint("MacGyver Inc", "72 Academy Street", "SN4 9QP"),
     } and results_as_dicts_new[3] == {
         "DeliveryId": 4,
         "ClientName": "MacGyver & Mustard Inc",
@@ -177,9 +193,12 @@ def test_sld_insert_into_dim_delivery_details(set_up_ddl, conn):
         "DeliveryCity": "Swindon",
         "DeliveryCountry": "United Kingdom",
         "DeliveryContactNumber": "+44 7911 843910",
-        "ValidFrom": datetime.date(2023, 10, 30),
+        "ValidFrom": today,
         "ValidTo": None,
         "MostRecent": 1,
+        "RowHash": row_fingerprint(
+            "MacGyver & Mustard Inc", "72 Academy Street", "SN4 9QP"
+        ),
     }, "The SCD didn't work properly"
 
 
@@ -237,8 +256,268 @@ def test_fact_orders_consistency(set_up_ddl, conn):
         "DeliveryCity": "NEWPORT",
         "DeliveryCountry": "UK",
         "DeliveryContactNumber": "+44 7457 884830",
-        "ValidFrom": "2023-10-30",
+        "ValidFrom": datetime.datetime.now(datetime.timezone.utc).date().isoformat(),
         "ValidTo": None,
         "MostRecent": 1,
         "TotalPrice": 57880.0,
     }
+
+
+def test_rollups_match_star_join_aggregates(set_up_ddl, conn):
+    """
+    Tests that the rollups, updated with only the new facts of each load, add up to
+    the same totals as aggregating the whole star schema
+    """
+
+    def load():
+        insert_into_dim_delivery_details(conn)
+        insert_into_dim_product_details(conn)
+        insert_into_dim_payment_details(conn)
+        insert_into_fact_orders(conn)
+
+    def aggregates(select, group_by):
+        return conn.execute(
+            text(
+                f"""
+                SELECT {select}, SUM(f.TotalPrice), SUM(f.ProductQuantity), COUNT(*)
+                FROM fact_orders f
+                JOIN dim_delivery_details d ON d.DeliveryId = f.DeliveryId
+                JOIN dim_payment_details pay ON pay.PaymentId = f.PaymentId
+                GROUP BY {group_by}
+                ORDER BY 1, 2;
+                """
+            )
+        ).fetchall()
+
+    def rollup(table):
+        return conn.execute(text(f"SELECT * FROM {table} ORDER BY 1, 2;")).fetchall()
+
+    load()
+    insert_additional_data_to_stage(conn)
+    load()
+
+    assert rollup("rollup_daily_product_revenue") == aggregates(
+        "pay.PaymentDate, f.ProductId", "pay.PaymentDate, f.ProductId"
+    )
+    assert rollup("rollup_monthly_client_revenue") == aggregates(
+        "SUBSTR(pay.PaymentDate, 1, 7), TRIM(LOWER(d.ClientName))",
+        "SUBSTR(pay.PaymentDate, 1, 7), TRIM(LOWER(d.ClientName))",
+    )
+    assert conn.execute(
+        text("SELECT SUM(Orders) FROM rollup_monthly_client_revenue;")
+    ).scalar() == conn.execute(text("SELECT COUNT(*) FROM fact_orders;")).scalar()
+
+
+def test_payment_dates_are_iso_and_keyed_into_dim_date(set_up_ddl, conn):
+    """
+    Tests that payment dates are stored as ISO dates, that dim_date covers them without
+    gaps and that every fact's DateKey is its payment's day in dim_date
+    """
+
+    def load():
+        insert_into_dim_delivery_details(conn)
+        insert_into_dim_product_details(conn)
+        insert_into_dim_payment_details(conn)
+        insert_into_dim_date(conn)
+        insert_into_fact_orders(conn)
+
+    load()
+    insert_additional_data_to_stage(conn)
+    load()
+
+    assert conn.execute(
+        text(
+            "SELECT COUNT(*) FROM dim_payment_details WHERE PaymentDate NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]';"
+        )
+    ).scalar() == 0
+    assert conn.execute(
+        text(
+            """
+            SELECT COUNT(*)
+            FROM fact_orders f
+            JOIN dim_payment_details pay ON pay.PaymentId = f.PaymentId
+            LEFT JOIN dim_date dd ON dd.DateKey = f.DateKey
+            WHERE dd.Date IS NOT pay.PaymentDate;
+            """
+        )
+    ).scalar() == 0
+    days, span = conn.execute(
+        text("SELECT COUNT(*), JULIANDAY(MAX(Date)) - JULIANDAY(MIN(Date)) + 1 FROM dim_date;")
+    ).first()
+    assert days == span
+    assert conn.execute(
+        text("SELECT Year, Quarter, YearMonth, DayOfWeek, IsWeekend FROM dim_date WHERE Date = '2023-10-17';")
+    ).first() == (2023, 4, "2023-10", 2, 0)
+
+
+def test_dates_of_older_dbs_are_migrated(conn):
+    """
+    Tests that a DB from before dim_date, with dd/mm/yyyy dates and no DateKey, gets
+    ISO dates, DateKeys and rollups by ISO date when its tables are next created
+    """
+
+    conn.execute(
+        text(
+            """
+            CREATE TABLE dim_payment_details (
+                PaymentId INTEGER PRIMARY KEY AUTOINCREMENT,
+                PaymentBillingCode VARCHAR NOT NULL,
+                PaymentType VARCHAR NOT NULL,
+                PaymentDate DATE NOT NULL
+            );
+            """
+        )
+    )
+    conn.execute(
+        text(
+            """
+            CREATE TABLE fact_orders (
+                OrderNumber VARCHAR NOT NULL PRIMARY KEY,
+                DeliveryId INTEGER NOT NULL,
+                ProductId INTEGER NOT NULL,
+                PaymentId INTEGER NOT NULL,
+                TotalPrice FLOAT NOT NULL,
+                Currency VARCHAR NOT NULL,
+                ProductQuantity INTEGER NOT NULL
+            );
+            """
+        )
+    )
+    conn.execute(
+        text(
+            """
+            INSERT INTO dim_payment_details (PaymentBillingCode, PaymentType, PaymentDate)
+            VALUES ('B-1', 'Debit', '28/02/2021'), ('B-2', 'Credit', '2021-03-02');
+            """
+        )
+    )
+    conn.execute(
+        text(
+            """
+            INSERT INTO fact_orders VALUES
+            ('PO-1', 1, 1, 1, 10.0, 'GBP', 1),
+            ('PO-2', 1, 1, 2, 20.0, 'GBP', 2);
+            """
+        )
+    )
+
+    create_orders_tables(conn)
+
+    assert conn.execute(
+        text("SELECT OrderNumber, DateKey FROM fact_orders ORDER BY OrderNumber;")
+    ).fetchall() == [("PO-1", 20210228), ("PO-2", 20210302)]
+    assert conn.execute(text("SELECT COUNT(*) FROM dim_date;")).scalar() == 3
+    assert conn.execute(
+        text("SELECT PaymentDate, TotalPrice FROM rollup_daily_product_revenue ORDER BY 1;")
+    ).fetchall() == [("2021-02-28", 10.0), ("2021-03-02", 20.0)]
+
+    create_orders_tables(conn)  # Only migrates once
+    assert conn.execute(text("SELECT COUNT(*) FROM rollup_daily_product_revenue;")).scalar() == 2
+
+
+def test_read_indexes_are_deferred_for_large_batches(set_up_ddl, conn):
+    def read_indexes():
+        return set(
+            conn.execute(
+                text("SELECT name FROM sqlite_master WHERE type = 'index'")
+            ).scalars()
+        ) & set(READ_INDEXES)
+
+    assert read_indexes() == set(READ_INDEXES)
+
+    # The first batch is large next to the (no) facts already loaded
+    assert defer_read_indexes(conn, 5, ratio=0.25)
+    assert read_indexes() == set()
+    insert_into_dim_delivery_details(conn)
+    insert_into_dim_product_details(conn)
+    insert_into_dim_payment_details(conn)
+    insert_into_fact_orders(conn)
+    rebuild_read_indexes(conn)
+    assert read_indexes() == set(READ_INDEXES)
+
+    assert not defer_read_indexes(conn, 1, ratio=0.25)
+    assert not defer_read_indexes(conn, 5, ratio=0)
+    assert read_indexes() == set(READ_INDEXES)
+
+    plan = [
+        row.detail
+        for row in conn.execute(
+            text(
+                """
+                EXPLAIN QUERY PLAN
+                SELECT SUM(f.TotalPrice)
+                FROM dim_product_details p
+                JOIN fact_orders f ON f.ProductId = p.ProductId
+                WHERE p.ProductName = 'Piano';
+                """
+            )
+        )
+    ]
+    assert any("ix_fact_orders_product_id" in detail for detail in plan)
+
+
+def test_dml_lookups_use_natural_key_indexes(set_up_ddl, conn, caplog):
+    """
+    Tests that the dimension lookups are index seeks on the normalized keys
+    rather than full scans of the dimension tables
+    """
+
+    create_staging_indexes(conn)
+
+    with caplog.at_level(logging.INFO):
+        insert_into_dim_delivery_details(conn)
+        insert_into_dim_product_details(conn)
+        insert_into_dim_payment_details(conn)
+        insert_into_fact_orders(conn)
+
+    assert "SEARCH p USING INDEX ix_dim_product_details_product_key" in caplog.text
+    assert (
+        "SEARCH pay USING INDEX ix_dim_payment_details_billing_code_key"
+        in caplog.text
+    )
+
+
+@pytest.mark.parametrize("max_size", [1_000_000, 1])
+def test_cached_fact_insert_matches_sql_insert(set_up_ddl, conn, max_size):
+    """
+    Tests that resolving surrogate keys through the key caches gives the same facts
+    as the SQL join, including when the caches are too small to hold every key
+    """
+
+    key_caches = build_key_caches(conn, max_size=max_size)
+    insert_into_dim_delivery_details(conn)
+    insert_into_dim_product_details(conn)
+    insert_into_dim_payment_details(conn)
+
+    insert_into_fact_orders(conn)
+    expected = conn.execute(text("SELECT * FROM fact_orders ORDER BY OrderNumber")).fetchall()
+    conn.execute(text("DELETE FROM fact_orders"))
+
+    insert_into_fact_orders_cached(conn, key_caches, batch_size=2)
+    results = conn.execute(text("SELECT * FROM fact_orders ORDER BY OrderNumber")).fetchall()
+
+    assert results == expected
+    assert all(len(cache) <= max_size for cache in key_caches.values())
+
+
+def test_rejected_orders_of_old_dbs_get_row_hashes(conn):
+    create_orders_tables(conn)
+    conn.execute(text("DROP INDEX ux_rejected_orders_file_row;"))
+    conn.execute(text("ALTER TABLE rejected_orders DROP COLUMN RowHash;"))
+    copy = """
+        INSERT INTO rejected_orders
+        SELECT NULL, staging.*, 'reason', 'fingerprint', 'orders.xlsx', 'now'
+        FROM staging WHERE OrderNumber IN (SELECT OrderNumber FROM staging LIMIT 2);
+    """
+    conn.execute(text(copy))
+    conn.execute(text(copy))  # As a rerun of the file would quarantine them again
+
+    create_orders_tables(conn)
+
+    rows = conn.execute(
+        text("SELECT OrderNumber, RowHash FROM rejected_orders ORDER BY RejectId;")
+    ).fetchall()
+    staged = pd.read_sql(text("SELECT * FROM staging LIMIT 2;"), conn)
+    assert [tuple(row) for row in rows] == list(
+        zip(staged["OrderNumber"], row_hashes(staged).tolist())
+    )
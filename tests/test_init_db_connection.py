@@ -0,0 +1,204 @@
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+from sqlalchemy import create_engine, text
+
+from data_quality_checks import run_vectorized_data_quality_checks
+import init_db_connection
+from init_db_connection import (
+    CATEGORICAL_COLUMNS,
+    concat_chunks,
+    create_sqlite_engine,
+    init_engine_and_load_staging,
+    iter_cached_input_chunks,
+    iter_excel_chunks,
+    iter_input_chunks,
+    iter_row_ranges,
+    prune_parse_cache,
+    read_excel_to_dataframe,
+)
+
+
+def test_iter_excel_chunks_respects_chunk_size():
+    chunks = list(iter_excel_chunks("tests/test_input_data.xlsx", chunk_size=2))
+
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+
+
+def test_streamed_chunks_match_pandas_reader():
+    """
+    The streaming reader should give the same columns, values and PaymentDate
+    handling as reading the whole workbook with pandas
+    """
+
+    expected = pd.read_excel("tests/test_input_data.xlsx", engine="openpyxl")
+    expected["PaymentDate"] = pd.to_datetime(expected["PaymentDate"])
+    expected[CATEGORICAL_COLUMNS] = expected[CATEGORICAL_COLUMNS].astype("category")
+
+    assert_frame_equal(
+        read_excel_to_dataframe("tests/test_input_data.xlsx"), expected, check_dtype=False
+    )
+
+
+def test_parsed_orders_are_compact():
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+
+    assert all(isinstance(df[col].dtype, pd.CategoricalDtype) for col in CATEGORICAL_COLUMNS)
+    assert df["PaymentDate"].dtype == "datetime64[ns]"
+    assert df["ProductQuantity"].dtype == "int8"
+
+    # Prices are only downcast to float32 when every one of them stays exact
+    halves = init_db_connection._normalize_orders_chunk(df.assign(UnitPrice=df["UnitPrice"] + 0.5))
+    tenths = init_db_connection._normalize_orders_chunk(df.assign(UnitPrice=df["UnitPrice"] + 0.1))
+    assert (halves["UnitPrice"].dtype, tenths["UnitPrice"].dtype) == ("float32", "float64")
+
+
+def test_sql_rows_match_the_uncompacted_frame():
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.loc[1, "ClientName"] = None
+    legacy = df.astype(object).where(df.notna(), None)
+    legacy["PaymentDate"] = df["PaymentDate"].dt.strftime("%Y-%m-%d")
+
+    assert init_db_connection._sql_rows(df) == list(legacy.itertuples(index=False, name=None))
+
+
+@pytest.mark.parametrize("extension", [".csv", ".parquet"])
+def test_input_adapters_match_excel_reader(tmp_path, extension):
+    """
+    Every input adapter gives the same columns, types and PaymentDate handling
+    as the xlsx one, chunk by chunk
+    """
+
+    expected = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    path = str(tmp_path / f"orders{extension}")
+    if extension == ".csv":
+        expected.to_csv(path, index=False)
+    else:
+        pytest.importorskip("pyarrow")
+        expected.to_parquet(path, index=False, row_group_size=2)
+
+    chunks = list(iter_input_chunks(path, chunk_size=2))
+
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert_frame_equal(concat_chunks(chunks), expected)
+
+
+def test_csv_and_xlsx_of_the_same_data_get_the_same_checks(tmp_path):
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx").astype(object)
+    df.loc[0, "PaymentBillingCode"] = 20210321  # Numeric-looking cells
+    df.loc[1, "DeliveryPostcode"] = 12345
+    df.loc[2, "DeliveryContactNumber"] = 7911843910
+    df.to_excel(tmp_path / "orders.xlsx", index=False)
+    df.to_csv(tmp_path / "orders.csv", index=False)
+
+    xlsx, csv = (
+        run_vectorized_data_quality_checks(iter_input_chunks(str(tmp_path / name), chunk_size=2))
+        for name in ["orders.xlsx", "orders.csv"]
+    )
+
+    assert csv == xlsx
+    assert not xlsx["column_is_correct_type"]["PaymentBillingCode"]
+    assert not xlsx["column_is_correct_type"]["DeliveryPostcode"]
+
+
+def test_unsupported_input_extension():
+    with pytest.raises(ValueError, match="Unsupported input file"):
+        iter_input_chunks("orders.json")
+
+
+def test_cached_chunks_skip_parse_on_unchanged_file(tmp_path, monkeypatch):
+    first = list(
+        iter_cached_input_chunks("tests/test_input_data.xlsx", 2, str(tmp_path))
+    )
+
+    def fail_parse(*args, **kwargs):
+        raise AssertionError("An unchanged file should not be parsed again")
+
+    monkeypatch.setitem(init_db_connection.INPUT_ADAPTERS, ".xlsx", fail_parse)
+    second = list(
+        iter_cached_input_chunks("tests/test_input_data.xlsx", 2, str(tmp_path))
+    )
+
+    assert len(first) == len(second) == 3
+    for a, b in zip(first, second):
+        assert_frame_equal(a, b)
+
+
+def test_same_contents_parsed_twice_at_once_share_one_entry(tmp_path):
+    first = iter_cached_input_chunks("tests/test_input_data.xlsx", 2, str(tmp_path))
+    chunks = [next(first)]  # Mid-parse while another parser publishes the same contents
+    other = list(iter_cached_input_chunks("tests/test_input_data.xlsx", 2, str(tmp_path)))
+    chunks += list(first)
+
+    assert len(chunks) == len(other) == 3
+    entries = [path.name for path in tmp_path.iterdir() if path.is_dir()]
+    assert len(entries) == 1 and ".tmp-" not in entries[0]
+
+
+def test_only_prune_parse_cache_drops_parsed_files(tmp_path):
+    for chunk_size in [1, 2, 3]:  # A cache entry each
+        list(iter_cached_input_chunks("tests/test_input_data.xlsx", chunk_size, str(tmp_path)))
+    assert sum(path.is_dir() for path in tmp_path.iterdir()) == 3
+
+    prune_parse_cache(1, str(tmp_path))
+
+    assert [path.name.split("-")[1] for path in tmp_path.iterdir() if path.is_dir()] == ["3"]
+
+
+def test_parse_cache_entries_of_another_format_are_missed(tmp_path, monkeypatch):
+    list(iter_cached_input_chunks("tests/test_input_data.xlsx", 2, str(tmp_path)))
+    (old,) = [path for path in tmp_path.iterdir() if path.is_dir()]
+    for chunk_file in old.iterdir():  # A layout the readers no longer give
+        pd.read_pickle(chunk_file).assign(PaymentDate=None).to_pickle(chunk_file)
+
+    monkeypatch.setattr(init_db_connection, "CACHE_FORMAT_VERSION", 99)
+    chunks = list(iter_cached_input_chunks("tests/test_input_data.xlsx", 2, str(tmp_path)))
+
+    assert concat_chunks(chunks)["PaymentDate"].notna().all()
+    assert sorted(path.name.split("-")[-1] for path in tmp_path.iterdir() if path.is_dir()) == [
+        "v2",
+        "v99",
+    ]
+
+
+def test_iter_row_ranges_reslices_and_skips_rows():
+    chunks = iter_excel_chunks("tests/test_input_data.xlsx", chunk_size=2)
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+
+    ranges = list(iter_row_ranges(chunks, 3, start=1))
+
+    assert [len(rows) for rows in ranges] == [3, 1]
+    assert_frame_equal(concat_chunks(ranges), df[1:].reset_index(drop=True))
+
+
+@pytest.mark.parametrize("schema", ["temp", "memory", "main"])
+def test_staging_bulk_load(tmp_path, schema):
+    """
+    Tests that the bulk loader keeps TEMP and in-memory staging out of the DB file,
+    and loads the same data to_sql would
+    """
+
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    engine = create_engine(f"sqlite:///{tmp_path / 'orders.db'}")
+
+    with init_engine_and_load_staging(engine, iter([df[:2], df[2:]]), schema) as conn:
+        loaded = pd.read_sql(f"SELECT {', '.join(df.columns)} FROM staging", conn)
+        main_tables = conn.execute(
+            text("SELECT name FROM main.sqlite_master WHERE type = 'table'")
+        ).scalars().all()
+
+    assert ("staging" in main_tables) == (schema == "main")
+    expected = df.astype(object).where(df.notna(), None)
+    expected["PaymentDate"] = df["PaymentDate"].dt.strftime("%Y-%m-%d")
+    assert_frame_equal(loaded.astype(object), expected, check_dtype=False)
+
+
+def test_sqlite_profiles_are_applied_on_connect(tmp_path):
+    db_path = tmp_path / "orders.db"
+
+    with create_sqlite_engine(db_path, "bulk_load").connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA temp_store")).scalar() == 2  # MEMORY
+
+    with create_sqlite_engine(db_path, "read_optimized").connect() as conn:
+        assert conn.execute(text("PRAGMA query_only")).scalar() == 1
@@ -0,0 +1,184 @@
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from init_db_connection import read_excel_to_dataframe
+from main import expand_inputs, run_data_ingest, run_parallel_ingest
+import main
+import metrics
+
+
+def test_parallel_ingest_isolates_failed_files(tmp_path):
+    """
+    A file that can't be parsed is reported as failed, while the files around it
+    are still written, and a file already ingested is skipped on the next batch
+    """
+
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.to_excel(inbox / "store_a.xlsx", index=False)
+    df.assign(OrderNumber=df["OrderNumber"] + "-B").to_excel(
+        inbox / "store_b.xlsx", index=False
+    )
+    (inbox / "store_c.xlsx").write_text("not a workbook")
+
+    db_path = str(tmp_path / "orders.db")
+    results = run_parallel_ingest([str(inbox)], db_path, workers=2)
+
+    assert [(r["file"].rsplit("/", 1)[-1], r["status"]) for r in results] == [
+        ("store_a.xlsx", "succeeded"),
+        ("store_b.xlsx", "succeeded"),
+        ("store_c.xlsx", "failed"),
+    ]
+    with create_engine(f"sqlite:///{db_path}").connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM fact_orders")).scalar() == 2 * len(df)
+
+    results = run_parallel_ingest([str(inbox / "store_a.xlsx")], db_path, workers=2)
+    assert results[0]["status"] == "skipped"
+
+
+def test_expand_inputs(tmp_path):
+    for name in ["b.xlsx", "a.xlsx", "c.csv", "d.txt"]:
+        (tmp_path / name).touch()
+
+    assert expand_inputs([str(tmp_path)]) == [
+        str(tmp_path / "a.xlsx"),
+        str(tmp_path / "b.xlsx"),
+        str(tmp_path / "c.csv"),
+    ]
+    assert expand_inputs([str(tmp_path / "*.txt"), str(tmp_path / "a.xlsx")]) == [
+        str(tmp_path / "a.xlsx"),
+        str(tmp_path / "d.txt"),
+    ]
+
+
+def _table(db_path, statement):
+    with create_engine(f"sqlite:///{db_path}").connect() as conn:
+        return conn.execute(text(statement)).fetchall()
+
+
+def test_chunked_ingest_resumes_after_a_crash(tmp_path, monkeypatch):
+    """
+    A chunked ingest that crashes half way resumes from its checkpoint, ending up
+    with the same facts and SCD history as an uninterrupted one
+    """
+
+    monkeypatch.setattr(main, "INGEST_COMMIT_ROWS", 2)
+    run_data_ingest("tests/test_input_data.xlsx", str(tmp_path / "expected.db"))
+
+    insert_into_fact_orders = main.insert_into_fact_orders
+    calls = []
+
+    def crash_on_second_range(conn):
+        calls.append(conn)
+        if len(calls) == 2:
+            raise RuntimeError("Simulated crash")
+        insert_into_fact_orders(conn)
+
+    db_path = str(tmp_path / "orders.db")
+    monkeypatch.setattr(main, "insert_into_fact_orders", crash_on_second_range)
+    with pytest.raises(RuntimeError):
+        run_data_ingest("tests/test_input_data.xlsx", db_path)
+    assert _table(db_path, "SELECT InputRows FROM ingest_checkpoints") == [(2,)]
+    assert len(_table(db_path, "SELECT * FROM fact_orders")) == 2
+
+    monkeypatch.setattr(main, "insert_into_fact_orders", insert_into_fact_orders)
+    run_data_ingest("tests/test_input_data.xlsx", db_path)
+
+    assert _table(db_path, "SELECT * FROM ingest_checkpoints") == []
+    for statement in [
+        "SELECT * FROM fact_orders ORDER BY OrderNumber",
+        "SELECT * FROM dim_delivery_details ORDER BY DeliveryId",
+        "SELECT FileFingerprint, NewRows FROM ingest_manifest_files",
+    ]:
+        assert _table(db_path, statement) == _table(tmp_path / "expected.db", statement)
+
+
+def test_resent_orders_are_dropped_before_the_dims(tmp_path, caplog):
+    db_path = str(tmp_path / "orders.db")
+    run_data_ingest("tests/test_input_data.xlsx", db_path)
+    deliveries = _table(db_path, "SELECT * FROM dim_delivery_details ORDER BY DeliveryId")
+
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.loc[0, ["DeliveryAddress", "DeliveryPostcode"]] = ["1 New Road", "SN1 1AA"]  # Re-sent
+    df.loc[1, ["OrderNumber", "PaymentBillingCode"]] = ["PO0099999-1", "PO0099999-20210301"]
+    df.to_excel(tmp_path / "resent.xlsx", index=False)
+    run_data_ingest(str(tmp_path / "resent.xlsx"), db_path)
+
+    assert (
+        f"Dropping 1 orders already loaded by earlier ingests, e.g. {df.loc[0, 'OrderNumber']}"
+        in caplog.text
+    )
+    assert _table(db_path, "SELECT * FROM dim_delivery_details ORDER BY DeliveryId") == deliveries
+    assert len(_table(db_path, "SELECT * FROM dim_payment_details")) == 4
+    assert len(_table(db_path, "SELECT * FROM fact_orders")) == 6
+
+
+def test_rejected_rows_are_quarantined_once_per_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "MAX_REJECTED_FRACTION", 0.4)
+    monkeypatch.setattr(main, "INCREMENTAL_INGEST", True)
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.loc[3, "TotalPrice"] = 1
+    input_file = str(tmp_path / "orders.xlsx")
+    db_path = str(tmp_path / "orders.db")
+
+    df.to_excel(input_file, index=False)
+    run_data_ingest(input_file, db_path)
+    df.loc[1, "OrderNumber"] = "PO0099999-1"  # A changed file is ingested again
+    df.to_excel(input_file, index=False)
+    run_data_ingest(input_file, db_path)
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    with engine.connect() as conn:
+        rejects = conn.execute(
+            text("SELECT OrderNumber, RejectReasons FROM rejected_orders;")
+        ).fetchall()
+        facts = conn.execute(text("SELECT COUNT(*) FROM fact_orders;")).scalar()
+    engine.dispose()
+    assert [tuple(row) for row in rejects] == [
+        (df.loc[3, "OrderNumber"], "column_is_multiplied_correctly:TotalPrice")
+    ]
+    assert facts == 5
+
+
+class _CrashingPool:
+    """A stand-in for the parser pool whose process dies parsing crash.xlsx"""
+
+    def __init__(self, max_workers, mp_context):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, file, db_path):
+        future = Future()
+        if file.endswith("crash.xlsx"):
+            future.set_exception(BrokenProcessPool("A parser process was terminated"))
+        else:
+            future.set_result(fn(file, db_path))
+        return future
+
+
+def test_parallel_ingest_survives_a_dead_parser(tmp_path, monkeypatch):
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.to_excel(tmp_path / "a.xlsx", index=False)
+    df.to_excel(tmp_path / "crash.xlsx", index=False)
+    df.assign(OrderNumber=df["OrderNumber"] + "-D").to_excel(tmp_path / "d.xlsx", index=False)
+    finished = []
+    finish_run = metrics.finish_run
+    monkeypatch.setattr(
+        metrics, "finish_run", lambda status, **labels: finished.append(status) or finish_run(status)
+    )
+    monkeypatch.setattr(main, "ProcessPoolExecutor", _CrashingPool)
+
+    results = run_parallel_ingest([str(tmp_path / "*.xlsx")], str(tmp_path / "orders.db"))
+
+    assert [result["status"] for result in results] == ["succeeded", "failed", "succeeded"]
+    assert "BrokenProcessPool" in results[1]["error"]
+    assert finished == ["succeeded", "failed", "succeeded"]
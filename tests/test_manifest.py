@@ -0,0 +1,52 @@
+from sqlalchemy import text
+
+from ddl import create_orders_tables
+from init_db_connection import (
+    create_sqlite_engine,
+    init_engine_and_load_staging,
+    read_excel_to_dataframe,
+)
+from manifest import is_file_ingested, iter_new_rows, record_ingest, row_hashes
+
+
+def _ingest(engine, df, fingerprint) -> int:
+    """Stages the new rows of df and records them, returning how many there were"""
+
+    with init_engine_and_load_staging(engine, iter_new_rows(engine, [df])) as conn:
+        staged = conn.execute(text("SELECT COUNT(*) FROM staging;")).scalar()
+        record_ingest(conn, fingerprint, "orders.xlsx")
+        conn.commit()
+
+    return staged
+
+
+def test_only_new_or_modified_rows_are_staged(tmp_path):
+    engine = create_sqlite_engine(str(tmp_path / "orders.db"), "default")
+    with engine.begin() as conn:
+        create_orders_tables(conn)
+
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    assert _ingest(engine, df, "first") == len(df)
+    assert _ingest(engine, df, "second") == 0
+
+    modified = df.copy()
+    modified.loc[2, "ProductQuantity"] += 1
+    assert _ingest(engine, modified, "third") == 1
+
+    with engine.connect() as conn:
+        assert is_file_ingested(conn, "first")
+        assert not is_file_ingested(conn, "fourth")
+        assert conn.execute(
+            text("SELECT NewRows FROM ingest_manifest_files ORDER BY LoadedAt;")
+        ).scalars().all() == [len(df), 0, 1]
+
+
+def test_row_hashes_do_not_depend_on_the_compact_dtypes():
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.loc[4, "PaymentDate"] = None
+    # As the readers used to type it: object text, int64 numbers and date objects
+    expanded = df.astype({col: object for col in df.select_dtypes("category").columns})
+    expanded = expanded.astype({col: "int64" for col in df.select_dtypes("integer").columns})
+    expanded["PaymentDate"] = df["PaymentDate"].dt.date
+
+    assert (row_hashes(df) == row_hashes(expanded)).all()
@@ -0,0 +1,49 @@
+import json
+
+import metrics
+
+
+def test_run_is_emitted_as_one_json_line(tmp_path):
+    output = tmp_path / "metrics.jsonl"
+
+    metrics.start_run(input_file="orders.xlsx")
+    chunks = list(metrics.timed_iter("parse", iter([[1, 2], [3]])))
+    with metrics.stage("fact_orders"):
+        metrics.add_rows(5)
+        metrics.add_query_plan("insert fact_orders", ["SCAN s"])
+    metrics.finish_run(output=str(output))
+
+    run = json.loads(output.read_text())
+
+    assert chunks == [[1, 2], [3]]
+    assert run["input_file"] == "orders.xlsx"
+    assert run["status"] == "succeeded"
+    assert [stage["stage"] for stage in run["stages"]] == ["parse", "fact_orders"]
+    assert run["stages"][0]["rows"] == 3
+    assert run["stages"][1]["rows"] == 5
+    assert run["stages"][1]["query_plans"] == {"insert fact_orders": ["SCAN s"]}
+    assert run["peak_rss_mb"] > 0
+
+
+def test_stage_records_its_own_peak_memory():
+    metrics.start_run()
+    with metrics.stage("allocate_and_free"):
+        with metrics.stage("allocate"):
+            block = bytearray(64 * 1024 * 1024)
+            block[::4096] = b"x" * len(block[::4096])  # Touches every page
+        del block
+    with metrics.stage("after"):
+        pass
+    run = metrics.finish_run(output="")
+
+    outer, allocate, after = run["stages"]
+    assert allocate["peak_rss_mb"] - after["peak_rss_mb"] >= 60
+    assert outer["peak_rss_mb"] == allocate["peak_rss_mb"]
+    assert run["peak_rss_mb"] == allocate["peak_rss_mb"]
+
+
+def test_recording_is_a_no_op_outside_a_run():
+    with metrics.stage("fact_orders"):
+        metrics.add_rows(5)
+
+    assert metrics.finish_run() is None
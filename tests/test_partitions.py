@@ -0,0 +1,157 @@
+import os
+
+from sqlalchemy import text
+import pandas as pd
+import pytest
+
+from init_db_connection import create_sqlite_engine, read_excel_to_dataframe
+import main
+from main import run_data_ingest
+from partitions import archive_partitions, attach_fact_partitions, partition_path
+from queries import OrdersQueries
+
+
+@pytest.fixture
+def partitioned_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "FACT_PARTITIONS", True)
+    db_path = str(tmp_path / "orders.db")
+    run_data_ingest("tests/test_input_data.xlsx", db_path)
+    return db_path
+
+
+def scalar(db_path, sql):
+    engine = create_sqlite_engine(db_path, "default")
+    with engine.connect() as conn:
+        value = conn.execute(text(sql)).scalar()
+    engine.dispose()
+    return value
+
+
+def test_facts_are_routed_to_monthly_partitions(partitioned_db, tmp_path):
+    months = ["2021-01", "2021-02", "2021-03"]
+    assert all(os.path.exists(partition_path(partitioned_db, month)) for month in months)
+    assert scalar(partitioned_db, "SELECT COUNT(*) FROM fact_orders;") == 0
+    assert scalar(partitioned_db, "SELECT SUM(Facts) FROM fact_partitions;") == 5
+
+    unpartitioned_db = str(tmp_path / "unpartitioned.db")
+    run_data_ingest("tests/test_input_data.xlsx", unpartitioned_db)
+    queries, expected = OrdersQueries(partitioned_db), OrdersQueries(unpartitioned_db)
+    for client_name in ["Rath - Schroeder", "Quitzon, Luettgen and Waters", "MacGyver Inc"]:
+        assert queries.orders_by_client(client_name) == expected.orders_by_client(client_name)
+    assert queries.orders_between("2021-01-01", "2021-12-31") == expected.orders_between(
+        "2021-01-01", "2021-12-31"
+    )
+    queries.close()
+    expected.close()
+
+
+def test_period_queries_only_attach_their_partitions(partitioned_db):
+    queries = OrdersQueries(partitioned_db)
+
+    orders = queries.orders_between("2021-02-01", "2021-02-28")
+    assert {order.OrderNumber for order in orders} == {"PO0013360-1", "PO0013360-3"}
+
+    with queries.engine.connect() as conn:
+        assert attach_fact_partitions(conn, partitioned_db, "2021-02", "2021-02") == ["2021-02"]
+        attached = [row.name for row in conn.execute(text("PRAGMA database_list;"))]
+        assert attached == ["main", "temp", "facts_2021_02"]
+        assert conn.execute(text("SELECT COUNT(*) FROM fact_orders;")).scalar() == 2
+    queries.close()
+
+
+def test_orders_already_partitioned_are_not_counted_twice(partitioned_db, tmp_path):
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.loc[0, "DeliveryContactNumber"] = "+44 7000 000000"  # A changed row of a loaded order
+    df.loc[1, "OrderNumber"] = "PO0099999-1"  # A new order
+    df.to_excel(tmp_path / "more.xlsx", index=False)
+    run_data_ingest(str(tmp_path / "more.xlsx"), partitioned_db)
+
+    assert scalar(partitioned_db, "SELECT SUM(Facts) FROM fact_partitions;") == 6
+    assert scalar(partitioned_db, "SELECT SUM(Orders) FROM rollup_daily_product_revenue;") == 6
+
+
+def test_archived_partitions_leave_the_view_but_not_the_rollups(partitioned_db, tmp_path):
+    queries = OrdersQueries(partitioned_db)
+    assert len(queries.orders_between("2021-01-01", "2021-12-31")) == 5
+    revenue = queries.revenue_by_month("2021-01", "2021-12")
+
+    archive_dir = str(tmp_path / "archive")
+    assert archive_partitions(partitioned_db, "2021-03", archive_dir) == ["2021-01", "2021-02"]
+
+    assert not os.path.exists(partition_path(partitioned_db, "2021-01"))
+    assert os.path.exists(os.path.join(archive_dir, "orders.facts-2021-01.db"))
+    assert {order.OrderNumber for order in queries.orders_between("2021-01-01", "2021-12-31")} == {
+        "PO0060504-1"
+    }
+    assert queries.revenue_by_month("2021-01", "2021-12") == revenue
+    queries.close()
+
+
+def test_resent_order_of_another_month_is_not_counted_twice(partitioned_db, tmp_path):
+    """
+    A re-sent order whose PaymentDate moved to another month keeps the DateKey of its
+    payment row, so it must be found by OrderNumber alone, not in its new month
+    """
+
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    row = df.index[df["OrderNumber"] == "PO0060504-1"][0]
+    df.loc[row, "PaymentDate"] = df.loc[row, "PaymentDate"] - pd.DateOffset(months=1)
+    df.to_excel(tmp_path / "corrected.xlsx", index=False)
+    run_data_ingest(str(tmp_path / "corrected.xlsx"), partitioned_db)
+
+    assert scalar(partitioned_db, "SELECT SUM(Facts) FROM fact_partitions;") == 5
+    assert scalar(partitioned_db, "SELECT SUM(Orders) FROM rollup_daily_product_revenue;") == 5
+    assert scalar(partitioned_db, "SELECT COUNT(*) FROM partitioned_orders;") == 5
+
+
+def test_partitioned_orders_are_backfilled(partitioned_db):
+    engine = create_sqlite_engine(partitioned_db, "default")
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM partitioned_orders;"))
+    engine.dispose()
+
+    run_data_ingest("tests/test_input_data.xlsx", partitioned_db)  # Skipped, but runs the DDL
+
+    assert scalar(partitioned_db, "SELECT COUNT(*) FROM partitioned_orders;") == 5
+
+
+def test_queries_read_more_partitions_than_sqlite_can_attach(tmp_path, monkeypatch):
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    months = pd.date_range("2020-01-15", periods=14, freq="MS") + pd.Timedelta(days=14)
+    orders = pd.concat([df.iloc[[0, 4]]] * 7, ignore_index=True).assign(
+        OrderNumber=[f"PO{i:07d}-1" for i in range(14)],
+        PaymentBillingCode=[f"PO{i:07d}-{month:%Y%m%d}" for i, month in enumerate(months)],
+        PaymentDate=months,
+    )
+    orders.to_excel(tmp_path / "history.xlsx", index=False)
+
+    unpartitioned_db = str(tmp_path / "unpartitioned.db")
+    run_data_ingest(str(tmp_path / "history.xlsx"), unpartitioned_db)
+    monkeypatch.setattr(main, "FACT_PARTITIONS", True)
+    db_path = str(tmp_path / "orders.db")
+    run_data_ingest(str(tmp_path / "history.xlsx"), db_path)
+    assert scalar(db_path, "SELECT COUNT(*) FROM fact_partitions;") == 14
+
+    queries, expected = OrdersQueries(db_path), OrdersQueries(unpartitioned_db)
+    for client_name in ["MacGyver Inc", "Quitzon, Luettgen and Waters"]:
+        assert len(queries.orders_by_client(client_name)) == 7
+        assert queries.orders_by_client(client_name, 3) == expected.orders_by_client(client_name, 3)
+    assert len(queries.orders_between("2020-01-01", "2021-12-31")) == 14
+    assert queries.orders_between("2020-01-01", "2021-12-31", 5) == expected.orders_between(
+        "2020-01-01", "2021-12-31", 5
+    )
+    queries.close()
+    expected.close()
+
+
+def test_generation_is_published_once_the_facts_are_routed(tmp_path, monkeypatch):
+    unrouted = []
+
+    def publish(db_path, generation):
+        unrouted.append(scalar(db_path, "SELECT COUNT(*) FROM fact_orders;"))
+
+    monkeypatch.setattr(main, "FACT_PARTITIONS", True)
+    monkeypatch.setattr(main, "publish_generation", publish)
+    run_data_ingest("tests/test_input_data.xlsx", str(tmp_path / "orders.db"))
+
+    assert unrouted[-1] == 0
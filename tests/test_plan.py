@@ -0,0 +1,158 @@
+import os
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from init_db_connection import read_excel_to_dataframe
+from main import run_data_ingest
+from plan import plan_ingest, run_ingest_plan
+
+COUNTS = {
+    "deliveries": "SELECT COUNT(*) FROM dim_delivery_details;",
+    "expired": "SELECT COUNT(*) FROM dim_delivery_details WHERE MostRecent = 0;",
+    "products": "SELECT COUNT(*) FROM dim_product_details;",
+    "prices": "SELECT GROUP_CONCAT(UnitPrice) FROM (SELECT UnitPrice FROM dim_product_details ORDER BY ProductId);",
+    "payments": "SELECT COUNT(*) FROM dim_payment_details;",
+    "facts": "SELECT COUNT(*) FROM fact_orders;",
+}
+
+
+def db_counts(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return {name: conn.execute(sql).fetchone()[0] for name, sql in COUNTS.items()}
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def changed_file(tmp_path):
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.loc[0, ["OrderNumber", "DeliveryAddress", "DeliveryPostcode"]] = [
+        "PO0099999-0",
+        "1 New Road",  # Moved
+        "SN1 1AA",
+    ]
+    df.loc[2, ["OrderNumber", "UnitPrice", "TotalPrice"]] = ["PO0099999-2", 8100, 56700]  # A new price
+    df.loc[1, "PaymentBillingCode"] = "PO0099999-20210301"  # Re-sent, so no new payment
+    path = str(tmp_path / "changed.xlsx")
+    df.to_excel(path, index=False)
+    return path
+
+
+def test_plan_matches_the_ingest_it_plans(tmp_path, changed_file):
+    db_path = str(tmp_path / "orders.db")
+    assert plan_ingest("tests/test_input_data.xlsx", db_path)["fact_orders"]["new"] == 5
+    assert not os.path.exists(db_path)
+
+    run_data_ingest("tests/test_input_data.xlsx", db_path)
+    before = db_counts(db_path)
+    with open(db_path, "rb") as f:
+        contents = f.read()
+
+    diff = []
+    plan = plan_ingest(changed_file, db_path, diff)
+    with open(db_path, "rb") as f:
+        assert f.read() == contents
+
+    assert plan["rows"] == {"read": 5, "rejected": 0, "staged": 3}
+    assert plan["dim_delivery_details"] == {"new": 1, "expired": 1}
+    assert plan["dim_product_details"] == {"new": 0, "price_changes": 1}
+    assert plan["dim_payment_details"] == {"new": 0}
+    assert plan["fact_orders"] == {
+        "new": 2,
+        "already_loaded": 1,
+        "duplicate_in_file": 0,
+        "missing_keys": 0,
+    }
+    assert ("dim_product_details", "update", "Vibraphone", 8000, 8100) in [
+        change[1:] for change in diff
+    ]
+
+    run_data_ingest(changed_file, db_path)
+    after = db_counts(db_path)
+    assert after["deliveries"] - before["deliveries"] == 1
+    assert after["expired"] - before["expired"] == 1
+    assert after["products"] == before["products"]
+    assert after["prices"] != before["prices"]
+    assert after["payments"] == before["payments"]
+    assert after["facts"] - before["facts"] == 2
+    assert plan_ingest(changed_file, db_path)["status"] == "skipped"
+
+
+def test_plan_writes_a_row_level_diff(tmp_path, changed_file, capsys):
+    db_path = str(tmp_path / "orders.db")
+    run_data_ingest("tests/test_input_data.xlsx", db_path)
+
+    run_ingest_plan([changed_file], db_path, str(tmp_path / "diff.csv"))
+
+    assert "1 new, 1 expired" in capsys.readouterr().out
+    diff = pd.read_csv(tmp_path / "diff.csv")
+    assert diff.groupby(["Table", "Change"]).size().to_dict() == {
+        ("dim_delivery_details", "expire"): 1,
+        ("dim_delivery_details", "insert"): 1,
+        ("dim_product_details", "update"): 1,
+        ("fact_orders", "ignore: already loaded"): 1,
+        ("fact_orders", "insert"): 2,
+    }
+
+
+# The orders schema before the manifest, dim_date, rollups and partitions, with an
+# order loaded the way it loaded them
+BASELINE_DB = """
+CREATE TABLE dim_delivery_details (
+    DeliveryId INTEGER NOT NULL PRIMARY KEY, ClientName VARCHAR NOT NULL,
+    DeliveryAddress VARCHAR NOT NULL, DeliveryPostcode VARCHAR NOT NULL,
+    DeliveryCity VARCHAR, DeliveryCountry VARCHAR, DeliveryContactNumber VARCHAR,
+    ValidFrom DATE, ValidTo DATE, MostRecent INTEGER NOT NULL
+);
+CREATE TABLE dim_product_details (
+    ProductId INTEGER NOT NULL PRIMARY KEY, ProductName VARCHAR NOT NULL UNIQUE,
+    ProductType VARCHAR, UnitPrice FLOAT NOT NULL
+);
+CREATE TABLE dim_payment_details (
+    PaymentId INTEGER NOT NULL PRIMARY KEY, PaymentBillingCode VARCHAR NOT NULL UNIQUE,
+    PaymentType VARCHAR, PaymentDate DATE
+);
+CREATE TABLE fact_orders (
+    OrderNumber VARCHAR NOT NULL PRIMARY KEY,
+    DeliveryId INTEGER NOT NULL REFERENCES dim_delivery_details (DeliveryId),
+    ProductId INTEGER NOT NULL REFERENCES dim_product_details (ProductId),
+    PaymentId INTEGER NOT NULL REFERENCES dim_payment_details (PaymentId),
+    TotalPrice FLOAT NOT NULL, Currency VARCHAR NOT NULL, ProductQuantity INTEGER NOT NULL,
+    UNIQUE (OrderNumber)
+);
+INSERT INTO dim_delivery_details VALUES (
+    1, 'MacGyver Inc', '72 Academy Street', 'SN4 9QP', 'Swindon', 'United Kingdom',
+    '+44 7911 843910', '2021-04-01', NULL, 1
+);
+INSERT INTO dim_product_details VALUES (1, 'Piano', 'Keyboard', 4700);
+INSERT INTO dim_payment_details VALUES (1, 'PO0060504-20210321', 'Debit', '2021-03-21');
+INSERT INTO fact_orders VALUES ('PO0060504-1', 1, 1, 1, 14100, 'GBP', 3);
+"""
+
+
+def test_plan_against_a_db_made_before_the_manifest(tmp_path):
+    db_path = str(tmp_path / "orders.db")
+    conn = sqlite3.connect(db_path)
+    conn.executescript(BASELINE_DB)
+    conn.close()
+    before = db_counts(db_path)
+    with open(db_path, "rb") as f:
+        contents = f.read()
+
+    plan = plan_ingest("tests/test_input_data.xlsx", db_path)
+    with open(db_path, "rb") as f:
+        assert f.read() == contents
+
+    assert plan["status"] == "planned"
+    assert plan["fact_orders"]["new"] == 4
+    assert plan["fact_orders"]["already_loaded"] == 1
+
+    run_data_ingest("tests/test_input_data.xlsx", db_path)
+    after = db_counts(db_path)
+    assert after["deliveries"] - before["deliveries"] == plan["dim_delivery_details"]["new"]
+    assert after["products"] - before["products"] == plan["dim_product_details"]["new"]
+    assert after["payments"] - before["payments"] == plan["dim_payment_details"]["new"]
+    assert after["facts"] - before["facts"] == plan["fact_orders"]["new"]
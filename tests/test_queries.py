@@ -0,0 +1,65 @@
+import pytest
+
+from init_db_connection import read_excel_to_dataframe
+from main import run_data_ingest
+from queries import QUERIES, OrdersQueries
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / "orders.db")
+    run_data_ingest("tests/test_input_data.xlsx", db_path)
+    return db_path
+
+
+def test_queries(db_path):
+    queries = OrdersQueries(db_path)
+
+    orders = queries.orders_by_client("rath - schroeder ")
+    assert orders and {order.OrderNumber for order in orders} <= set(
+        read_excel_to_dataframe("tests/test_input_data.xlsx")["OrderNumber"]
+    )
+    assert queries.latest_delivery_address("Rath - Schroeder").DeliveryPostcode == "NP80 1OK"
+    assert queries.latest_delivery_address("Nobody") is None
+    assert sum(row.Orders for row in queries.revenue_by_product("2000-01-01", "2100-01-01")) == 5
+    assert sum(row.Orders for row in queries.revenue_by_month("2000-01", "2100-01")) == 5
+    queries.close()
+
+
+def test_delivery_address_as_of(db_path):
+    queries = OrdersQueries(db_path)
+
+    current = queries.latest_delivery_address("Rath - Schroeder")
+    assert queries.delivery_address_as_of("rath - schroeder", "2100-01-01") == current
+    assert queries.delivery_address_as_of("Rath - Schroeder", "2000-01-01") is None
+
+    with queries.engine.connect() as conn:
+        plan = conn.exec_driver_sql(
+            "EXPLAIN QUERY PLAN " + str(QUERIES["delivery_address_as_of"]),
+            {"client_name": "Rath - Schroeder", "as_of": "2100-01-01"},
+        ).fetchall()
+    assert any("ix_dim_delivery_details_client_valid_from" in row[-1] for row in plan)
+    queries.close()
+
+
+def test_results_are_cached_until_the_next_ingest(db_path, tmp_path, monkeypatch):
+    queries = OrdersQueries(db_path)
+    before = queries.revenue_by_month("2000-01", "2100-01")
+
+    def fail_connect():
+        raise AssertionError("A cached read should not touch SQLite")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(queries.engine, "connect", fail_connect)
+        assert queries.revenue_by_month("2000-01", "2100-01") == before
+    assert (queries.hits, queries.misses) == (1, 1)
+
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.assign(OrderNumber=df["OrderNumber"] + "-B").to_excel(
+        tmp_path / "more.xlsx", index=False
+    )
+    run_data_ingest(str(tmp_path / "more.xlsx"), db_path)
+
+    after = queries.revenue_by_month("2000-01", "2100-01")
+    assert sum(row.Orders for row in after) == 2 * sum(row.Orders for row in before)
+    assert queries.misses == 2
@@ -0,0 +1,110 @@
+import os
+import sqlite3
+
+import pytest
+
+from init_db_connection import read_excel_to_dataframe
+import main
+from main import run_data_ingest
+from queries import OrdersQueries
+from shadow import shadow_build, shadow_path
+
+
+@pytest.fixture
+def shadow_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "SHADOW_PUBLISH", True)
+    db_path = str(tmp_path / "orders.db")
+    run_data_ingest("tests/test_input_data.xlsx", db_path)
+    return db_path
+
+
+def scalar(db_path, sql):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(sql).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_shadow_build_is_swapped_in_atomically(shadow_db, tmp_path):
+    assert scalar(shadow_db, "PRAGMA journal_mode;") == "delete"
+    assert not any(os.path.exists(shadow_db + suffix) for suffix in ["-wal", ".shadow"])
+
+    queries = OrdersQueries(shadow_db)
+    assert len(queries.orders_between("2021-01-01", "2021-12-31")) == 5
+    reader = sqlite3.connect(shadow_db)
+    reader.execute("BEGIN;")
+    assert reader.execute("SELECT COUNT(*) FROM fact_orders;").fetchone()[0] == 5
+    inode = os.stat(shadow_db).st_ino
+
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.loc[1, "OrderNumber"] = "PO0099999-1"
+    df.to_excel(tmp_path / "more.xlsx", index=False)
+    run_data_ingest(str(tmp_path / "more.xlsx"), shadow_db)  # While the reader is open
+
+    assert reader.execute("SELECT COUNT(*) FROM fact_orders;").fetchone()[0] == 5
+    reader.close()
+    assert os.stat(shadow_db).st_ino != inode
+    assert scalar(shadow_db, "SELECT COUNT(*) FROM fact_orders;") == 6
+    assert len(queries.orders_between("2021-01-01", "2021-12-31")) == 6
+    queries.close()
+
+
+def test_failed_shadow_build_leaves_the_db_untouched(shadow_db, tmp_path, monkeypatch):
+    with open(shadow_db, "rb") as f:
+        before = f.read()
+
+    def fail(conn):
+        raise RuntimeError("DML failed")
+
+    monkeypatch.setattr(main, "insert_into_fact_orders", fail)
+    df = read_excel_to_dataframe("tests/test_input_data.xlsx")
+    df.loc[1, "OrderNumber"] = "PO0099999-1"
+    df.to_excel(tmp_path / "more.xlsx", index=False)
+    with pytest.raises(RuntimeError, match="DML failed"):
+        run_data_ingest(str(tmp_path / "more.xlsx"), shadow_db)
+
+    with open(shadow_db, "rb") as f:
+        assert f.read() == before
+    assert not os.path.exists(shadow_path(shadow_db))
+
+
+def test_shadow_is_not_published_over_a_concurrent_ingest(shadow_db):
+    bump = "UPDATE ingest_generation SET Generation = Generation + 1;"
+    with pytest.raises(RuntimeError, match="written to since its shadow copy was seeded"):
+        with shadow_build(shadow_db) as path:
+            for db_path in [path, shadow_db]:
+                conn = sqlite3.connect(db_path)
+                conn.execute(bump)
+                conn.commit()
+                conn.close()
+
+    assert scalar(shadow_db, "SELECT Generation FROM ingest_generation;") == 2
+    assert not os.path.exists(shadow_path(shadow_db))
+
+
+def test_ingested_file_is_skipped_without_seeding_a_shadow(shadow_db, monkeypatch):
+    def seed(db_path):
+        raise AssertionError("seeded a shadow copy")
+
+    monkeypatch.setattr(main, "INCREMENTAL_INGEST", True)
+    monkeypatch.setattr(main, "shadow_build", seed)
+    run_data_ingest("tests/test_input_data.xlsx", shadow_db)
+    results = main.run_parallel_ingest(["tests/test_input_data.xlsx"], shadow_db)
+
+    assert [result["status"] for result in results] == ["skipped"]
+    assert not os.path.exists(shadow_path(shadow_db))
+
+
+@pytest.mark.parametrize(
+    "setting, value", [("INGEST_COMMIT_ROWS", 2), ("FACT_PARTITIONS", True)]
+)
+def test_shadow_publish_refuses_settings_it_cant_keep(tmp_path, monkeypatch, setting, value):
+    monkeypatch.setattr(main, "SHADOW_PUBLISH", True)
+    monkeypatch.setattr(main, setting, value)
+    db_path = str(tmp_path / "orders.db")
+    with pytest.raises(ValueError, match=setting):
+        run_data_ingest("tests/test_input_data.xlsx", db_path)
+    with pytest.raises(ValueError, match=setting):
+        main.run_parallel_ingest(["tests/test_input_data.xlsx"], db_path)
+    assert not os.path.exists(db_path)